@@ -8,6 +8,8 @@ from app.bot.states import AdminFlow
 
 from zoneinfo import ZoneInfo
 
+from app.utils.time import today_msk
+
 router = Router()
 
 def is_admin(chat_id: int, settings) -> bool:
@@ -138,6 +140,47 @@ async def admins_stars_button(message: Message, repo, settings):
 
     await message.answer("\n".join(lines), reply_markup=admin_panel_keyboard())
 
+async def _usage_text(repo) -> str:
+    # расход моделей за сегодня (МСК): по моделям/режимам и топ чатов
+    day = today_msk(repo.tz)
+    by_model = await repo.usage_by_model(day)
+    top = await repo.usage_top_chats(day, limit=10)
+
+    lines = [f"📈 Usage за {day:%d.%m.%Y}\n"]
+    if by_model:
+        lines.append("По моделям (in / cached / out, avg ms):")
+        for r in by_model:
+            lines.append(
+                f"{r['model']} · {r['mode']}: {r['calls']} выз. | "
+                f"{int(r['input_tokens'])} / {int(r['cached_tokens'])} / {int(r['output_tokens'])} | "
+                f"{int(r['avg_latency_ms'] or 0)} ms"
+            )
+    else:
+        lines.append("По моделям: пока пусто")
+
+    lines.append("")
+    if top:
+        lines.append("Топ чатов по токенам:")
+        for i, r in enumerate(top, 1):
+            name = (f"@{r['username']}" if r["username"] else r["full_name"]).strip() or "—"
+            lines.append(
+                f"{i}) {r['chat_id']} | {name} | {r['calls']} выз. | "
+                f"in {int(r['input_tokens'])} (cached {int(r['cached_tokens'])}) | out {int(r['output_tokens'])}"
+            )
+    else:
+        lines.append("Топ чатов: пока пусто")
+
+    text = "\n".join(lines)
+    if len(text) > 3800:
+        text = text[:3800] + "\n…"
+    return text
+
+@router.message(F.text == "📈 Usage")
+async def admins_usage_button(message: Message, repo, settings):
+    if not is_admin(message.chat.id, settings):
+        return
+    await message.answer(await _usage_text(repo), reply_markup=admin_panel_keyboard())
+
 @router.callback_query(F.data == "adm:back")
 async def adm_back(call: CallbackQuery, settings, state: FSMContext):
     if not is_admin(call.message.chat.id, settings):
@@ -265,7 +308,7 @@ async def adm_delete_user(call: CallbackQuery, repo, settings):
     )
 
 @router.message(AdminFlow.waiting_chat_id_for_delete)
-async def adm_delete_user_input(message: Message, repo, settings, state: FSMContext):
+async def adm_delete_user_input(message: Message, repo, settings, state: FSMContext, chat_control=None):
     if not is_admin(message.chat.id, settings):
         return
 
@@ -274,6 +317,9 @@ async def adm_delete_user_input(message: Message, repo, settings, state: FSMCont
         return
 
     chat_id = int(message.text.strip())
+    # генерации и буфер логов удаляемого чата — в процессе, который его обслуживает
+    if chat_control is not None:
+        chat_control.cancel(chat_id, "admin_delete")
     await repo.admin_delete_user(chat_id)
     await state.clear()
     await message.answer(f"🗑 Пользователь {chat_id} удалён.", reply_markup=admin_panel_keyboard())
@@ -300,7 +346,7 @@ async def adm_users_page(call: CallbackQuery, repo, settings):
     )
 
 @router.callback_query(F.data.startswith("adm:pick:"))
-async def adm_pick_user(call: CallbackQuery, repo, settings):
+async def adm_pick_user(call: CallbackQuery, repo, settings, chat_control=None):
     if not is_admin(call.message.chat.id, settings):
         await call.answer("Нет доступа", show_alert=True)
         return
@@ -328,6 +374,8 @@ async def adm_pick_user(call: CallbackQuery, repo, settings):
         return
 
     if action == "delete":
+        if chat_control is not None:
+            chat_control.cancel(chat_id, "admin_delete")
         await repo.admin_delete_user(chat_id)
         await call.message.edit_text(f"🗑 Пользователь {chat_id} удалён.")
         await call.message.answer("Админ-действия:", reply_markup=admin_panel_keyboard())
@@ -403,3 +451,12 @@ async def adm_stars(call: CallbackQuery, repo, settings):
 
     await call.message.edit_text(text)
     await call.message.answer("Админ-действия:", reply_markup=admin_panel_keyboard())
+
+@router.callback_query(F.data == "adm:usage")
+async def adm_usage(call: CallbackQuery, repo, settings):
+    if not is_admin(call.message.chat.id, settings):
+        await call.answer("Нет доступа", show_alert=True)
+        return
+
+    await call.message.edit_text(await _usage_text(repo))
+    await call.message.answer("Админ-действия:", reply_markup=admin_panel_keyboard())
@@ -0,0 +1,187 @@
+# хранилище FSM aiogram в Postgres (таблица fsm_state): состояния переживают деплой
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+import logging
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger("fsm")
+
+
+def _encode(obj: Any) -> Any:
+    # в data лежат started_at и т.п. — сохраняем с тегом, чтобы читать обратно как datetime
+    if isinstance(obj, datetime):
+        return {"__datetime__": obj.isoformat()}
+    if isinstance(obj, date):
+        return {"__date__": obj.isoformat()}
+    raise TypeError(f"FSM data value of type {type(obj).__name__} is not JSON serializable")
+
+
+def _decode(obj: dict) -> Any:
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def dumps_data(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, default=_encode)
+
+
+def loads_data(raw: str | None) -> dict[str, Any]:
+    return json.loads(raw, object_hook=_decode) if raw else {}
+
+
+def _key(key: StorageKey) -> str:
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(f"t{key.thread_id}")
+    if key.business_connection_id:
+        parts.append(f"b{key.business_connection_id}")
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+@dataclass
+class _Entry:
+    state: str | None
+    data: dict[str, Any]
+
+
+class PgStorage(BaseStorage):
+    """
+    FSM-хранилище поверх Repository (fsm_state; на FakeDatabase — в памяти процесса).
+    Чтения идут из LRU-кеша, записи копятся и уходят одной пачкой раз в flush_interval:
+    set_state + update_data в одном хендлере — один запрос. close() дописывает накопленное.
+    Кеш считается источником истины, поэтому чат должен обслуживаться одним процессом:
+    один процесс или воркеры BOT_SHARDS (чат всегда в своём шарде). Несколько реплик
+    без шардинга не поддерживаются — они читали бы устаревшее состояние и перетирали чужие записи.
+    """
+
+    def __init__(
+        self,
+        repo,
+        *,
+        flush_interval: float = 0.2,
+        cache_size: int = 10_000,
+    ):
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._dirty: set[str] = set()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.counters: Counter = Counter()
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(_key(key))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry.data = dict(data)
+        self._mark_dirty(_key(key))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._entry(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    # --- кеш и запись ---
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        k = _key(key)
+        entry = self._entries.get(k)
+        if entry is not None:
+            self._entries.move_to_end(k)
+            self.counters["hits"] += 1
+            return entry
+
+        self.counters["misses"] += 1
+        row = await self.repo.fsm_load(k)
+        current = self._entries.get(k)
+        if current is not None:
+            # пока читали, ключ прочитали или записали здесь же — берём то, что уже в кеше
+            return current
+        state, raw = row if row is not None else (None, None)
+        entry = _Entry(state=state, data=loads_data(raw))
+        self._entries[k] = entry
+        self._entries.move_to_end(k)
+        self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        # вытесняем только уже записанное — несохранённые изменения держим до flush
+        while len(self._entries) > self.cache_size:
+            victim = next((k for k in self._entries if k not in self._dirty), None)
+            if victim is None:
+                return
+            del self._entries[victim]
+
+    def _mark_dirty(self, k: str) -> None:
+        self._dirty.add(k)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            # окно склейки: соседние записи того же апдейта попадут в ту же пачку
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            if not await self.flush():
+                await asyncio.sleep(5.0)
+                self._wake.set()
+
+    async def flush(self) -> bool:
+        if not self._dirty:
+            return True
+        keys, self._dirty = self._dirty, set()
+        rows = []
+        for k in keys:
+            entry = self._entries.get(k)
+            if entry is not None:
+                rows.append((k, entry.state, dumps_data(entry.data)))
+        try:
+            await self.repo.fsm_save_many(rows)
+        except asyncio.CancelledError:
+            self._dirty |= keys
+            raise
+        except Exception:
+            logger.exception("Failed to save %s FSM records, will retry", len(rows))
+            # то, что успели изменить заново, уже помечено; остальное вернём в очередь
+            self._dirty |= keys
+            self.counters["flush_errors"] += 1
+            return False
+        self.counters["flushes"] += 1
+        self.counters["writes"] += len(rows)
+        return True
+
+    def stats(self) -> dict:
+        return {"cached": len(self._entries), "dirty": len(self._dirty), **self.counters}
@@ -1,7 +1,6 @@
 # /start, кнопки, сообщения
 
 from aiogram import Router, F
-from aiogram.enums import ChatAction
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.types import FSInputFile
 from aiogram.filters import CommandStart
@@ -12,7 +11,12 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
 from decimal import Decimal
 import uuid
-from app.services.yookassa_client import YooKassaClient, YooKassaConfig
+from app.services.payments import (
+    PAYMENT_CHECK_INTERVAL,
+    PAYMENT_CHECK_JOB,
+    make_yookassa_client,
+    sync_yookassa_payment,
+)
 
 from app.bot.keyboards import (
     start_keyboard,
@@ -27,43 +31,49 @@ from app.bot.keyboards import (
 )
 from app.bot.admin_handlers import is_admin
 from app.bot.states import ChatFlow
+from app.bot.streaming import StreamingReply
 
 from datetime import datetime, date
 
 from app.utils.time import today_msk, now_msk
+from app.db.repository import FREE_LIMIT_REASON
 
 import logging
-import hashlib
 import contextlib
 import asyncio
 import re
-
-from app.services.summary import build_memory
+import time
+
+from app.services.summary import build_memory_async
+from app.services.prompts import PROMPT_HASH, PROMPT_PREVIEW, PROMPT_VERSION, SYSTEM_PROMPT
+from app.services.openai_client import LLMResult, ResponseChainExpired
+from app.services.router import ROUTE_MINI, ROUTE_TEMPLATE
+from app.services.tokens import estimate_tokens
+from app.services.generation import PROFILE_CHAT_FREE, PROFILE_CHAT_PAID
+from app.services.llm_scheduler import PRIORITY_FREE, PRIORITY_PAID
+from app.services.overload import CHAT_REPLY_JOB, OVERLOAD_DEFER, OVERLOAD_NOTIFY, format_eta
+from app.services.limits import is_paid_active
 
 logger = logging.getLogger("bot")
 
 router = Router()
 LAST_STARS_INVOICE: dict[int, int] = {}
 
-async def _typing_loop(bot, chat_id: int, interval: float = 3.5):
-    try:
-        while True:
-            await bot.send_chat_action(chat_id, ChatAction.TYPING)
-            await asyncio.sleep(interval)
-    except asyncio.CancelledError:
-        return
+# для оценки токенов запроса до вызова модели (бюджет токенов в reserve_request)
+_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+_EXPECTED_OUTPUT_TOKENS = 400
 
 async def _update_memory_bg(repo, memory_llm, chat_id: int, user_text: str, answer: str, user_memory: str | None):
     try:
         turn_text = f"USER: {user_text}\nBOT: {answer}"
-        updated_memory = await asyncio.to_thread(
-            build_memory,
+        updated_memory = await build_memory_async(
             memory_llm,
             turn_text,
             existing_memory=user_memory,
+            chat_id=chat_id,
         )
         if updated_memory and updated_memory != (user_memory or "").strip():
-            await repo.set_user_memory(chat_id, updated_memory)
+            await repo.update_user_memory_if(chat_id, updated_memory, expected=user_memory)
     except Exception:
         logger.exception("Failed to update user memory", extra={"chat_id": chat_id})
 
@@ -246,11 +256,16 @@ async def _restore_state_or_prompt(message: Message, state: FSMContext, repo, se
 # --- КНОПКИ ГЛАВНОГО МЕНЮ (reply keyboard) ---
 
 @router.message(F.text == "💬 Начать")
-async def btn_start_chat(message: Message, state: FSMContext, repo):
+async def btn_start_chat(message: Message, state: FSMContext, repo, log_writer=None, inflight=None):
     await state.clear()
     chat_id = message.chat.id
+    if inflight is not None:
+        inflight.cancel(chat_id, "start_chat")
+    await repo.jobs_cancel(CHAT_REPLY_JOB, str(chat_id))
     profile = await repo.get_user_profile(chat_id)
     if profile and profile.end_dialog == 1:
+        if log_writer is not None:
+            log_writer.forget(chat_id)
         await repo.clear_dialog_context(chat_id)
         await repo.set_end_dialog(chat_id, 0)
     if profile and profile.consented == 1:
@@ -448,8 +463,19 @@ async def onboarding_age(message: Message, state: FSMContext, repo):
     await message.answer("Ок, пишите сообщение — я отвечу 🙂", reply_markup=chat_keyboard())
 
 @router.message((F.text == "👋 Завершить диалог") | (F.text == "Завершить диалог"))
-async def btn_end_chat(message: Message, state: FSMContext, repo, settings):
+async def btn_end_chat(
+    message: Message, state: FSMContext, repo, settings, memory_coalescer=None, log_writer=None, inflight=None
+):
     await state.clear()
+    if inflight is not None:
+        # ответ на ещё генерирующееся сообщение уже не нужен — не платим за него
+        inflight.cancel(message.chat.id, "end_dialog")
+    # и отложенный из-за перегрузки ответ тоже
+    await repo.jobs_cancel(CHAT_REPLY_JOB, str(message.chat.id))
+    if memory_coalescer is not None:
+        memory_coalescer.forget(message.chat.id)
+    if log_writer is not None:
+        log_writer.break_chain(message.chat.id)
     await message.answer(
         "Диалог завершен. Можешь начать новый в любое время.",
         reply_markup=start_keyboard(is_admin=is_admin(message.chat.id, settings)),
@@ -587,10 +613,13 @@ async def cmd_limits(message: Message, repo):
     u = await repo.get_user(chat_id)
 
     left = "анлим" if u.num_request is None else str(u.num_request)
+    budget = repo.token_budget(u, today_msk(repo.tz))
+    tokens_left = "анлим" if not budget else str(max(budget - u.tokens_used, 0))
     text = (
         "📊 Лимиты:\n"
         f"🧾 Осталось запросов: {left}\n"
         f"🔢 Запросов сегодня: {u.total_requests}\n"
+        f"🪙 Осталось токенов сегодня: {tokens_left}\n"
     )
     await message.answer(text)
 
@@ -689,7 +718,7 @@ async def cb_pay_method_stars(call: CallbackQuery, repo):
     await send_stars_invoice(call.message, chat_id, stars_price=299)
 
 @router.callback_query(F.data == "pay_method:card")
-async def cb_pay_method_card(call: CallbackQuery, repo, settings):
+async def cb_pay_method_card(call: CallbackQuery, repo, settings, job_worker=None):
     chat_id = call.message.chat.id
     u = await repo.get_user(chat_id)
 
@@ -737,13 +766,7 @@ async def cb_pay_method_card(call: CallbackQuery, repo, settings):
     idem_key = str(uuid.uuid4())
     payload = make_payload(chat_id)
 
-    client = YooKassaClient(
-        YooKassaConfig(
-            shop_id=settings.yookassa_shop_id,
-            secret_key=settings.yookassa_secret_key,
-            return_url=(settings.yookassa_return_url or "https://t.me/"),
-        )
-    )
+    client = make_yookassa_client(settings)
 
     yk_payment, yk_meta = await client.create_payment(
         amount_value=amount_value,
@@ -775,6 +798,18 @@ async def cb_pay_method_card(call: CallbackQuery, repo, settings):
         raw=raw_to_store,
     )
 
+    # фоновая сверка: если пользователь не нажмёт "Я оплатил", подписку активирует очередь
+    if job_worker is not None:
+        try:
+            await job_worker.enqueue(
+                PAYMENT_CHECK_JOB,
+                {"payment_id": external_payment_id, "chat_id": chat_id},
+                dedupe_key=external_payment_id,
+                run_in=PAYMENT_CHECK_INTERVAL,
+            )
+        except Exception:
+            logger.exception("Failed to enqueue payment check", extra={"chat_id": chat_id})
+
     await call.message.answer(
         "💳 Платеж создан.\n"
         "1) Нажмите «Перейти к оплате»\n"
@@ -797,38 +832,15 @@ async def cb_yk_check(call: CallbackQuery, repo, settings):
         await call.message.answer("⚠️ Некорректный платеж.")
         return
 
-    client = YooKassaClient(
-        YooKassaConfig(
-            shop_id=settings.yookassa_shop_id,
-            secret_key=settings.yookassa_secret_key,
-            return_url=(settings.yookassa_return_url or "https://t.me/"),
-        )
-    )
-
-    yk_payment, yk_meta = await client.get_payment(payment_id)
+    client = make_yookassa_client(settings)
+    sync = await sync_yookassa_payment(repo, client, payment_id, call.message.chat.id)
 
-    status = yk_payment.get("status", "unknown")
-    paid = bool(yk_payment.get("paid", False))
+    status = sync.status
+    paid = sync.paid
+    yk_payment, yk_meta = sync.payment, sync.meta
     pm = yk_payment.get("payment_method") or {}
     cd = yk_payment.get("cancellation_details") or {}
 
-    paid_at = None
-    canceled_at = None
-    if status == "succeeded" and paid:
-        paid_at = datetime.utcnow()
-    if status == "canceled":
-        canceled_at = datetime.utcnow()
-
-    raw_to_store = {"payment": yk_payment, "_meta": yk_meta}
-
-    await repo.yk_update_payment(
-        external_payment_id=payment_id,
-        status=status,
-        raw=raw_to_store,
-        paid_at=paid_at,
-        canceled_at=canceled_at,
-    )
-
     debug_text = (
         f"status={status}\n"
         f"paid={paid}\n"
@@ -847,8 +859,8 @@ async def cb_yk_check(call: CallbackQuery, repo, settings):
         amount_value = amount_obj.get("value")
         amount_currency = amount_obj.get("currency", "RUB")
 
-        # активируем подписку
-        u = await repo.activate_paid_30d(call.message.chat.id)
+        # подписку активировал sync (или уже фоновая проверка платежа — тогда просто читаем)
+        u = sync.activated or await repo.get_user(call.message.chat.id)
 
         # удаляем сообщение со ссылкой (если хочешь)
         try:
@@ -891,89 +903,320 @@ async def cb_back(call: CallbackQuery, state: FSMContext, settings):
         "Главное меню:", reply_markup=start_keyboard(is_admin=is_admin(call.message.chat.id, settings))
     )
 
+async def _stream_answer(message: Message, llm, prompt_input, settings, burst=None, **profile_kwargs) -> str | None:
+    """
+    Стримит ответ в чат. Возвращает итоговый текст или None — тогда вызывающий
+    идёт обычным (batch) путём; уже показанные куски при этом удаляются.
+    """
+    reply = StreamingReply(message, max_len=800, edit_interval=settings.stream_edit_interval)
+    try:
+        # aclosing: при отмене задачи (новое сообщение пачки, завершение диалога) стрим к модели
+        # закрывается сразу, а не когда генератор соберёт GC
+        async with contextlib.aclosing(llm.generate_stream(prompt_input, **profile_kwargs)) as stream:
+            async for delta in stream:
+                if burst is not None and not burst.delivering and not burst.start_delivery():
+                    # пачку перебило новое сообщение до первого показанного куска
+                    raise asyncio.CancelledError
+                await reply.feed(delta)
+        answer = await reply.finish()
+    except ResponseChainExpired:
+        # цепочка у провайдера истекла — вызывающий пересоберёт контекст локально
+        await reply.discard()
+        raise
+    except Exception:
+        logger.exception("Streaming failed, falling back to batch", extra={"chat_id": message.chat.id})
+        await reply.discard()
+        return None
+    if not answer:
+        # пустой ответ — пусть batch-путь сделает ретраи
+        await reply.discard()
+        return None
+    return answer
+
+async def _generate_reply(message: Message, llm, prompt_input, settings, burst=None, **kwargs) -> tuple[LLMResult, bool]:
+    """Стрим (если включён), иначе batch. Возвращает (результат, был ли ответ уже показан стримом)."""
+    if settings.stream_replies:
+        result = LLMResult()
+        answer = await _stream_answer(message, llm, prompt_input, settings, burst=burst, result=result, **kwargs)
+        if answer is not None:
+            result.text = answer
+            return result, True
+    return await llm.generate_result(prompt_input, **kwargs), False
+
+async def _cancellable(coro, chat_id: int, burst=None, inflight=None):
+    """
+    Генерация отдельной задачей: её отменяют следующее сообщение пачки (BurstCoalescer)
+    и завершение/сброс диалога (InflightRegistry).
+    """
+    if burst is None and inflight is None:
+        return await coro
+    task = asyncio.create_task(coro)
+    if burst is not None:
+        burst.attach(task)
+    if inflight is not None:
+        inflight.track(chat_id, task)
+    return await task
+
+async def _answer_denied(message: Message, reason: str) -> None:
+    # если лимит — предлагаем оплату/подписку
+    if "закончился лимит" in (reason or "").lower():
+        await message.answer(reason, reply_markup=premium_keyboard())
+    else:
+        await message.answer(reason, reply_markup=subscription_keyboard())
+
 @router.message(ChatFlow.chatting)
-async def on_chat_message(message: Message, repo, llm, memory_llm):
+async def on_chat_message(
+    message: Message,
+    repo,
+    llm,
+    memory_llm,
+    settings,
+    log_writer=None,
+    memory_coalescer=None,
+    context_builder=None,
+    llm_router=None,
+    burst_coalescer=None,
+    inflight=None,
+    overload=None,
+    job_worker=None,
+    typing_ticker=None,
+):
     chat_id = message.chat.id
     user_text = message.text or ""
-    profile = await repo.get_user_profile(chat_id)
+    # эпоха чата до любых ожиданий: завершение/сброс диалога после этого момента отменяет ответ
+    epoch = inflight.epoch(chat_id) if inflight is not None else 0
+    extra = dict(
+        inflight=inflight, epoch=epoch, overload=overload, job_worker=job_worker, typing_ticker=typing_ticker
+    )
+
+    # профиль + ник/имя + лимиты — одним запросом
+    admission = await repo.admit_message(
+        chat_id,
+        username=message.from_user.username,
+        full_name=message.from_user.full_name,
+    )
+
+    ok, reason = admission.ok, admission.reason
+    if not ok:
+        await _answer_denied(message, reason)
+        return
+
+    # несколько сообщений подряд — один запрос к модели на всю пачку
+    if burst_coalescer is None:
+        await _answer_chat(
+            message, user_text, admission, repo, llm, memory_llm, settings,
+            log_writer, memory_coalescer, context_builder, llm_router, **extra,
+        )
+        return
+    burst = await burst_coalescer.collect(chat_id, message.message_id, user_text)
+    if burst is None:
+        # сообщение ушло в пачку более позднего
+        return
+    try:
+        await _answer_chat(
+            message, burst.text, admission, repo, llm, memory_llm, settings,
+            log_writer, memory_coalescer, context_builder, llm_router, burst, **extra,
+        )
+    finally:
+        burst_coalescer.finish(burst)
+
+async def _answer_chat(
+    message: Message,
+    user_text: str,
+    admission,
+    repo,
+    llm,
+    memory_llm,
+    settings,
+    log_writer=None,
+    memory_coalescer=None,
+    context_builder=None,
+    llm_router=None,
+    burst=None,
+    *,
+    inflight=None,
+    epoch: int = 0,
+    overload=None,
+    job_worker=None,
+    typing_ticker=None,
+):
+    chat_id = message.chat.id
+
+    def dropped() -> bool:
+        # диалог завершили/сбросили после прихода сообщения
+        return inflight is not None and not inflight.is_current(chat_id, epoch)
+
+    profile = admission.profile
     user_name = profile.name if profile else None
     user_gender = profile.gender if profile else None
     user_age = profile.age if profile else None
     user_memory = profile.memory if profile else None
 
-    await repo.touch_user_profile(
-        chat_id=chat_id,
-        username=message.from_user.username,
-        full_name=message.from_user.full_name,
+    # роутер: "ок"/"спасибо" — шаблоном (без модели и без списания запроса), лёгкое — mini-модели
+    decision = llm_router.route(user_text) if llm_router is not None else None
+    if decision is not None and decision.route == ROUTE_TEMPLATE:
+        await message.answer(decision.reply)
+        llm_router.record(decision, latency=0.0)
+        return
+    mini = decision is not None and decision.route == ROUTE_MINI
+    gen_llm = memory_llm if mini else llm
+    paid = is_paid_active(admission.subscription, today_msk(repo.tz))
+    priority = PRIORITY_PAID if paid else PRIORITY_FREE
+
+    # перегрузка: долгое ожидание модели — говорим место в очереди или откладываем ответ в очередь задач
+    if overload is not None:
+        verdict = overload.check(chat_id, gen_llm.model, priority)
+        if verdict.action == OVERLOAD_DEFER and job_worker is not None:
+            await job_worker.enqueue(
+                CHAT_REPLY_JOB,
+                {"chat_id": chat_id, "texts": [user_text], "mini": mini},
+                dedupe_key=str(chat_id),
+                merge_key="texts",
+            )
+            await message.answer(
+                "⏳ Сейчас очень много запросов. Сообщение получено — отвечу, как только освободится место "
+                f"(примерно через {format_eta(verdict.eta)})."
+            )
+            return
+        if verdict.action in (OVERLOAD_NOTIFY, OVERLOAD_DEFER):
+            await message.answer(
+                f"⏳ Сейчас много запросов: ты {verdict.position}-й в очереди, "
+                f"ответ примерно через {format_eta(verdict.eta)}."
+            )
+
+    # история диалога: продолжение серверной цепочки или окно по бюджету токенов (+ пересказ)
+    window = None
+    if context_builder is not None:
+        try:
+            window = await context_builder.build(chat_id, user_text)
+        except Exception:
+            logger.exception("Failed to build dialog context", extra={"chat_id": chat_id})
+    prompt_input = window.input if window else user_text
+
+    # оценка токенов запроса до вызова: instructions + input + ожидаемый ответ;
+    # после ответа сверяем с реальным usage (adjust_tokens)
+    est_tokens = (
+        _PROMPT_TOKENS
+        + estimate_tokens(user_memory)
+        + (window.tokens if window else estimate_tokens(user_text))
+        + _EXPECTED_OUTPUT_TOKENS
     )
 
-    ok, reason = await repo.can_make_request(chat_id)
-    if not ok:
-        # если лимит — предлагаем оплату/подписку
-        if "закончился лимит" in (reason or "").lower():
-            await message.answer(reason, reply_markup=premium_keyboard())
-        else:
-            await message.answer(reason, reply_markup=subscription_keyboard())
+    if dropped():
         return
 
-    # Router disabled: отвечаем на все запросы без отсева.
+    # списываем запрос и оценку токенов заранее (атомарно); если генерация упадёт — вернём
+    reserved = await repo.reserve_request(chat_id, tokens=est_tokens)
+    if reserved is None:
+        # параллельное сообщение успело забрать последний запрос (или сменился день)
+        ok, reason = await repo.can_make_request(chat_id)
+        if ok:
+            reserved = await repo.reserve_request(chat_id, tokens=est_tokens)
+        if reserved is None:
+            await _answer_denied(message, reason or FREE_LIMIT_REASON)
+            return
 
     # LLM
     loading_sticker = None
     loading_text = None
 
-    typing_task = None
+    typing = False
+    streamed = False
     try:
-        # 1) показываем "печатает..." + текст
-        typing_task = asyncio.create_task(_typing_loop(message.bot, chat_id))
+        # 1) показываем "печатает..." (общий TypingTicker, без своей задачи на сообщение)
+        if typing_ticker is not None:
+            typing_ticker.acquire(chat_id)
+            typing = True
         # loading_sticker = await message.answer_sticker(FSInputFile("app/assets/loader.tgs"))
         # typing indicator is enough; no extra loading message
 
         # 2) твой лог + генерация
-        prompt_text = getattr(__import__("app.services.openai_client", fromlist=["SYSTEM_PROMPT"]), "SYSTEM_PROMPT", "")
-        prompt_version = getattr(__import__("app.services.openai_client", fromlist=["PROMPT_VERSION"]), "PROMPT_VERSION", "unknown")
-
-        prompt_preview = prompt_text[:180].replace("\n", " ")
-        prompt_hash = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12]
-
+        # версия/хэш/превью промпта посчитаны один раз при импорте app.services.prompts
         logger.info(
             "chat_id=%s | prompt=%s | prompt_hash=%s | prompt_preview='%s' | user_input='%s'",
             chat_id,
-            prompt_version,
-            prompt_hash,
-            prompt_preview,
+            PROMPT_VERSION,
+            PROMPT_HASH,
+            PROMPT_PREVIEW,
             (user_text[:300].replace("\n", " ")),
         )
 
-        prompt_input = user_text
-
         logger.info(
-            "chat_id=%s | memory_len=%s | context_len=%s | prompt_preview='%s'",
+            "chat_id=%s | memory_len=%s | context_turns=%s | context_tokens=%s | chained=%s | prompt_preview='%s'",
             chat_id,
             len(user_memory or ""),
-            len(prompt_input),
-            prompt_input[:500].replace("\n", " "),
+            window.turns if window else 0,
+            window.tokens if window else 0,
+            bool(window and window.previous_response_id),
+            user_text[:500].replace("\n", " "),
         )
 
-        answer = await asyncio.to_thread(
-            llm.generate,
-            prompt_input,
+        # платным — больше reasoning и длиннее ответ (см. профили генерации в Settings)
+        profile_kwargs = dict(
             user_name=user_name,
             user_gender=user_gender,
             user_age=user_age,
             user_memory=user_memory,
+            profile=PROFILE_CHAT_PAID if paid else PROFILE_CHAT_FREE,
+            chat_id=chat_id,
+            # в очереди к модели платные идут первыми
+            priority=priority,
         )
+        started = time.monotonic()
+        try:
+            result, streamed = await _cancellable(_generate_reply(
+                message,
+                gen_llm,
+                prompt_input,
+                settings,
+                burst=burst,
+                previous_response_id=window.previous_response_id if window else None,
+                **profile_kwargs,
+            ), chat_id, burst, inflight)
+        except ResponseChainExpired:
+            logger.info("Response chain expired, rebuilding local context", extra={"chat_id": chat_id})
+            window = await context_builder.build(chat_id, user_text, use_chain=False)
+            result, streamed = await _cancellable(
+                _generate_reply(message, gen_llm, window.input, settings, burst=burst, **profile_kwargs),
+                chat_id,
+                burst,
+                inflight,
+            )
+        if decision is not None:
+            llm_router.record(
+                decision,
+                latency=time.monotonic() - started,
+                # usage от API, если он есть; иначе оценка
+                input_tokens=result.input_tokens or (window.tokens if window else estimate_tokens(user_text)),
+                output_tokens=result.output_tokens or estimate_tokens(result.text),
+            )
+        answer = result.text
+        response_id = result.response_id
         if not (answer or "").strip():
             # one retry with minimal context to avoid empty replies
+            # (ответ без истории — цепочку previous_response_id от него не продолжаем)
+            response_id = None
             retry_input = f"Коротко и по делу ответь пользователю:\n{user_text}"
-            answer = await asyncio.to_thread(
-                llm.generate,
-                retry_input,
-                user_name=user_name,
-                user_gender=user_gender,
-                user_age=user_age,
-                user_memory=None,
+            # та же модель, что выбрал роутер, и так же отменяется завершением диалога
+            retry = await _cancellable(
+                gen_llm.generate_result(
+                    retry_input,
+                    user_name=user_name,
+                    user_gender=user_gender,
+                    user_age=user_age,
+                    user_memory=None,
+                    profile=profile_kwargs["profile"],
+                    chat_id=chat_id,
+                    label="chat_retry",
+                    priority=profile_kwargs["priority"],
+                ),
+                chat_id,
+                burst,
+                inflight,
             )
+            answer = retry.text
+            result.input_tokens += retry.input_tokens
+            result.output_tokens += retry.output_tokens
         if not (answer or "").strip():
             answer = (
                 "Понял. Давай коротко и по делу:\n"
@@ -982,7 +1225,16 @@ async def on_chat_message(message: Message, repo, llm, memory_llm):
                 "Если сложно, напиши одной фразой — разберём вместе."
             )
 
+    except asyncio.CancelledError:
+        if not dropped() and (burst is None or not burst.superseded):
+            raise
+        # пачку перебило новое сообщение (ответим один раз на всё вместе)
+        # или диалог завершили/сбросили — ответ не нужен, запрос возвращаем
+        await repo.release_request(chat_id, tokens=est_tokens)
+        return
+
     except Exception as e:
+        await repo.release_request(chat_id, tokens=est_tokens)
         await message.answer(f"⚠️ Ошибка при обработке: {e}")
         return
 
@@ -994,31 +1246,202 @@ async def on_chat_message(message: Message, repo, llm, memory_llm):
                     await m.delete()
                 except Exception:
                     pass
-        if typing_task:
-            typing_task.cancel()
-            with contextlib.suppress(asyncio.CancelledError):
-                await typing_task
+        if typing:
+            typing_ticker.release(chat_id)
+
+    if dropped():
+        # генерация успела закончиться до отмены: не доставляем и не сохраняем
+        if not streamed:
+            await repo.release_request(chat_id, tokens=est_tokens)
+        return
+    if burst is not None and not burst.start_delivery():
+        # новое сообщение пришло, пока шёл ретрай — ответ уйдёт на всю пачку
+        await repo.release_request(chat_id, tokens=est_tokens)
+        return
+
+    # сначала ответ пользователю, потом уже запись в БД
+    if not streamed:
+        parts = _split_response(answer, max_len=800)
+        if not parts:
+            parts = ["Понял. Давай коротко и по делу: что случилось?"]
+        for part in parts:
+            await message.answer(part)
+
+    # сверка бюджета токенов: оценку заменяем реальным usage (если API его вернул)
+    used_tokens = result.input_tokens + result.output_tokens
+    if used_tokens:
+        try:
+            await repo.adjust_tokens(chat_id, used_tokens - est_tokens)
+        except Exception:
+            logger.exception("Failed to reconcile token usage", extra={"chat_id": chat_id})
 
-    # "Одно действие": обновили user_subscriptions + вставили requests_log
-    await repo.record_interaction_atomic(chat_id, user_text, answer)
+    if dropped():
+        # диалог завершили, пока уходил ответ — в историю и память его не пишем
+        return
+
+    # счётчики уже списаны reserve_request — тут только лог (write-behind, если есть writer)
+    chain_len = window.chain_len if (window and response_id) else 0
+    if log_writer is not None:
+        log_writer.enqueue(chat_id, user_text, answer, response_id=response_id, chain_len=chain_len)
+    else:
+        await repo.log_interaction(chat_id, user_text, answer, response_id=response_id, chain_len=chain_len)
     if _should_update_memory(user_text):
         try:
-            asyncio.create_task(
-                _update_memory_bg(repo, memory_llm, chat_id, user_text, answer, user_memory)
-            )
+            if memory_coalescer is not None:
+                # копим реплики, память обновится пачкой (N реплик или пауза)
+                memory_coalescer.add_turn(chat_id, user_text, answer)
+            else:
+                asyncio.create_task(
+                    _update_memory_bg(repo, memory_llm, chat_id, user_text, answer, user_memory)
+                )
         except Exception:
             logger.exception("Failed to schedule memory update", extra={"chat_id": chat_id})
 
-    parts = _split_response(answer, max_len=800)
-    if not parts:
-        parts = ["Понял. Давай коротко и по делу: что случилось?"]
-    for i, part in enumerate(parts):
-        if typing_task and typing_task.done() is False:
-            await message.bot.send_chat_action(chat_id, ChatAction.TYPING)
-        await message.answer(part)
+def make_chat_reply_handler(
+    repo,
+    llm,
+    memory_llm,
+    bot,
+    *,
+    context_builder=None,
+    log_writer=None,
+    memory_coalescer=None,
+    typing_ticker=None,
+    inflight=None,
+):
+    """
+    Обработчик задачи chat_reply: ответ на сообщения, отложенные из-за перегрузки (OverloadController).
+    Тот же путь, что в _answer_chat, но без стрима и без Message — ответ уходит через bot.send_message.
+    Задача выполняется в шарде чата (JobKind.sharded): генерацию отменяет завершение диалога.
+    """
+
+    async def handle(payload: dict) -> None:
+        chat_id = int(payload["chat_id"])
+        user_text = "\n".join(payload.get("texts") or [])
+        if not user_text.strip():
+            return
+        epoch = inflight.epoch(chat_id) if inflight is not None else 0
+
+        def dropped() -> bool:
+            return inflight is not None and not inflight.is_current(chat_id, epoch)
+
+        profile = await repo.get_user_profile(chat_id)
+        if profile is None or profile.end_dialog == 1:
+            # пока сообщение ждало, диалог завершили или пользователя удалили
+            return
+        gen_llm = memory_llm if payload.get("mini") else llm
+
+        window = None
+        if context_builder is not None:
+            window = await context_builder.build(chat_id, user_text)
+        est_tokens = (
+            _PROMPT_TOKENS
+            + estimate_tokens(profile.memory)
+            + (window.tokens if window else estimate_tokens(user_text))
+            + _EXPECTED_OUTPUT_TOKENS
+        )
+        reserved = await repo.reserve_request(chat_id, tokens=est_tokens)
+        if reserved is None:
+            _, reason = await repo.can_make_request(chat_id)
+            await bot.send_message(chat_id, reason or FREE_LIMIT_REASON)
+            return
+
+        paid = is_paid_active(reserved, today_msk(repo.tz))
+        kwargs = dict(
+            user_name=profile.name,
+            user_gender=profile.gender,
+            user_age=profile.age,
+            user_memory=profile.memory,
+            profile=PROFILE_CHAT_PAID if paid else PROFILE_CHAT_FREE,
+            chat_id=chat_id,
+            label="chat_deferred",
+            priority=PRIORITY_PAID if paid else PRIORITY_FREE,
+        )
+        typing = typing_ticker.typing(chat_id) if typing_ticker is not None else contextlib.nullcontext()
+        try:
+            with typing:
+                try:
+                    result = await _cancellable(
+                        gen_llm.generate_result(
+                            window.input if window else user_text,
+                            previous_response_id=window.previous_response_id if window else None,
+                            **kwargs,
+                        ),
+                        chat_id,
+                        None,
+                        inflight,
+                    )
+                except ResponseChainExpired:
+                    window = await context_builder.build(chat_id, user_text, use_chain=False)
+                    result = await _cancellable(gen_llm.generate_result(window.input, **kwargs), chat_id, None, inflight)
+            if dropped():
+                raise asyncio.CancelledError()
+            answer = (result.text or "").strip() or "Понял. Давай коротко и по делу: что случилось?"
+            parts = _split_response(answer, max_len=800)
+            await bot.send_message(chat_id, parts[0])
+        except BaseException as e:
+            # ничего не доставили (ошибка или отмена по таймауту задачи) — списанное возвращаем
+            await repo.release_request(chat_id, tokens=est_tokens)
+            if isinstance(e, asyncio.CancelledError) and dropped():
+                # диалог завершили/сбросили, пока шла генерация — ответ не нужен, повтора тоже
+                return
+            raise
+
+        # ответ уже у пользователя: дальше ни ошибка, ни отмена не должны дойти до повтора задачи
+        # (иначе ответ придёт второй раз и запрос спишется заново) — доводим отдельной задачей
+        rest = asyncio.ensure_future(
+            _finish_deferred_reply(chat_id, user_text, answer, parts[1:], result, window, est_tokens, profile.memory)
+        )
+        try:
+            await asyncio.shield(rest)
+        except asyncio.CancelledError:
+            logger.warning("Deferred reply job cancelled after delivery, finishing in background", extra={"chat_id": chat_id})
+
+    async def _finish_deferred_reply(chat_id, user_text, answer, rest_parts, result, window, est_tokens, user_memory):
+        try:
+            for part in rest_parts:
+                await bot.send_message(chat_id, part)
+        except Exception:
+            logger.exception("Failed to send deferred reply part", extra={"chat_id": chat_id})
+
+        try:
+            used_tokens = result.input_tokens + result.output_tokens
+            if used_tokens:
+                await repo.adjust_tokens(chat_id, used_tokens - est_tokens)
+            response_id = result.response_id if result.text else None
+            chain_len = window.chain_len if (window and response_id) else 0
+            if log_writer is not None:
+                log_writer.enqueue(chat_id, user_text, answer, response_id=response_id, chain_len=chain_len)
+            else:
+                await repo.log_interaction(chat_id, user_text, answer, response_id=response_id, chain_len=chain_len)
+            if _should_update_memory(user_text):
+                if memory_coalescer is not None:
+                    memory_coalescer.add_turn(chat_id, user_text, answer)
+                else:
+                    asyncio.create_task(_update_memory_bg(repo, memory_llm, chat_id, user_text, answer, user_memory))
+        except Exception:
+            logger.exception("Failed to record deferred reply", extra={"chat_id": chat_id})
+
+    return handle
 
 @router.message(F.text)
-async def fallback_message(message: Message, state: FSMContext, repo, llm, memory_llm, settings):
+async def fallback_message(
+    message: Message,
+    state: FSMContext,
+    repo,
+    llm,
+    memory_llm,
+    settings,
+    log_writer=None,
+    memory_coalescer=None,
+    context_builder=None,
+    llm_router=None,
+    burst_coalescer=None,
+    inflight=None,
+    overload=None,
+    job_worker=None,
+    typing_ticker=None,
+):
     if await state.get_state():
         return
 
@@ -1031,4 +1454,8 @@ async def fallback_message(message: Message, state: FSMContext, repo, llm, memor
 
     ready = await _restore_state_or_prompt(message, state, repo, settings)
     if ready:
-        await on_chat_message(message, repo, llm, memory_llm)
+        await on_chat_message(
+            message, repo, llm, memory_llm, settings,
+            log_writer, memory_coalescer, context_builder, llm_router, burst_coalescer, inflight,
+            overload, job_worker, typing_ticker,
+        )
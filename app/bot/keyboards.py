@@ -27,8 +27,8 @@ def admin_panel_keyboard() -> ReplyKeyboardMarkup:
         keyboard=[
             [KeyboardButton(text="👥 Все пользователи"), KeyboardButton(text="🔎 Проверить подписку (chat_id)")],
             [KeyboardButton(text="➕ Продлить/выдать +30 дней"), KeyboardButton(text="♻️ Сбросить подписку")],
-            [KeyboardButton(text="⭐️ Stars"), KeyboardButton(text="🗑 Удалить пользователя")],
-            [KeyboardButton(text="⬅️ Назад")],
+            [KeyboardButton(text="⭐️ Stars"), KeyboardButton(text="📈 Usage")],
+            [KeyboardButton(text="🗑 Удалить пользователя"), KeyboardButton(text="⬅️ Назад")],
         ],
         resize_keyboard=True,
         input_field_placeholder="Админ-действия 👇",
@@ -96,6 +96,7 @@ def admins_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="➕ Продлить/выдать +30 дней", callback_data="adm:grant_30")],
         [InlineKeyboardButton(text="♻️ Сбросить подписку", callback_data="adm:reset_sub")],
         [InlineKeyboardButton(text="⭐️ Stars", callback_data="adm:stars")],
+        [InlineKeyboardButton(text="📈 Usage", callback_data="adm:usage")],
         [InlineKeyboardButton(text="🗑 Удалить пользователя", callback_data="adm:delete_user")]
     ])
 
@@ -0,0 +1,207 @@
+# исходящие запросы к Telegram: лимиты (глобальный и на чат), flood-wait, приоритет ответов над chat action
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction
+
+logger = logging.getLogger("telegram_send")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # до какого момента бакет заморожен (retry_after от Telegram)
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """0 — токен есть прямо сейчас, иначе сколько ждать."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота (bot.session.middleware): все отправки/правки сообщений проходят
+    через токен-бакеты — глобальный (~30 msg/s у Telegram) и по чату (~1 msg/s).
+    Сообщения одного чата уходят строго по очереди; на 429 бакет чата замораживается
+    на retry_after, и запрос повторяется здесь же — хендлеры не ловят TelegramRetryAfter,
+    но ждут своей отправки (под lock'ом чата), пока flood-wait не пройдёт.
+    429 сразу в нескольких чатах — общий лимит бота: тогда замораживается и глобальный бакет.
+    chat action (typing) — fire-and-forget: уходит в фоне и только если лимиты свободны
+    и ответы не ждут очереди, иначе выбрасывается — ответы важнее индикатора.
+    Прочие методы (getUpdates, answerCallbackQuery, ...) идут мимо.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_rate: float = 28.0,
+        global_burst: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_retries: int = 3,
+        flood_window: float = 2.0,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.flood_window = flood_window
+        # последний 429 по чатам за flood_window: по ним отличаем лимит чата от общего
+        self._floods: dict[int | str, float] = {}
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._locks: dict[int | str, asyncio.Lock] = {}
+        # запросов на чат в очереди (включая отправляемый) — чтобы убирать неиспользуемые lock'и
+        self._queued: Counter = Counter()
+        self._actions: set[asyncio.Task] = set()
+        # глубина очереди: сколько запросов в очереди и сколько из них ждут токена лимита
+        self.queued = 0
+        self.waiting = 0
+        self.counters: Counter = Counter()
+
+    @staticmethod
+    def _throttled(method) -> bool:
+        name = type(method).__name__
+        return name.startswith(("Send", "Edit", "Copy", "Forward")) and getattr(method, "chat_id", None) is not None
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                self._gc()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _gc(self) -> None:
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chats.items() if b.idle(now) and c not in self._queued]:
+            del self._chats[chat_id]
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, SendChatAction):
+            self._send_action(make_request, bot, method)
+            return True
+        if not self._throttled(method):
+            return await make_request(bot, method)
+
+        chat_id = method.chat_id
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        self._queued[chat_id] += 1
+        self.queued += 1
+        try:
+            async with lock:
+                return await self._send(make_request, bot, method, chat_id)
+        finally:
+            self.queued -= 1
+            self._queued[chat_id] -= 1
+            if self._queued[chat_id] <= 0:
+                del self._queued[chat_id]
+                self._locks.pop(chat_id, None)
+
+    async def _send(self, make_request, bot, method, chat_id):
+        bucket = self._bucket(chat_id)
+        attempt = 0
+        while True:
+            await self._wait(bucket)
+            try:
+                result = await make_request(bot, method)
+                self.counters["sent"] += 1
+                return result
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self._flood(chat_id, e.retry_after)
+                logger.warning(
+                    "chat_id=%s | flood wait %ss on %s (attempt %s)",
+                    chat_id,
+                    e.retry_after,
+                    type(method).__name__,
+                    attempt,
+                )
+                if attempt > self.max_retries:
+                    self.counters["failed"] += 1
+                    raise
+
+    async def _wait(self, bucket: TokenBucket) -> None:
+        # токен нужен и в бакете чата, и в общем
+        while (d := max(bucket.delay(), self.global_bucket.delay())) > 0:
+            self.counters["limit_waits"] += 1
+            self.waiting += 1
+            try:
+                await asyncio.sleep(d)
+            finally:
+                self.waiting -= 1
+        bucket.take()
+        self.global_bucket.take()
+
+    def _flood(self, chat_id, retry_after: float) -> None:
+        self.counters["flood_waits"] += 1
+        now = time.monotonic()
+        until = now + retry_after
+        bucket = self._bucket(chat_id)
+        bucket.paused_until = max(bucket.paused_until, until)
+        # Telegram не говорит, какой лимит превышен. Если 429 пришёл и другому чату — упёрлись
+        # в общий лимит бота, и остальные чаты тоже ждут, а не получают 429 по очереди
+        self._floods = {c: t for c, t in self._floods.items() if now - t < self.flood_window}
+        self._floods[chat_id] = now
+        if len(self._floods) > 1:
+            self.counters["global_flood_waits"] += 1
+            self.global_bucket.paused_until = max(self.global_bucket.paused_until, until)
+
+    def _send_action(self, make_request, bot, method) -> None:
+        bucket = self._bucket(method.chat_id)
+        # ответы ждут лимита или лимит исчерпан — индикатор не шлём
+        if self.waiting or bucket.delay() > 0 or self.global_bucket.delay() > 0:
+            self.counters["actions_dropped"] += 1
+            return
+        # typing не расходует лимит чата на сообщения, только общий
+        self.global_bucket.take()
+        task = asyncio.create_task(self._run_action(make_request, bot, method))
+        self._actions.add(task)
+        task.add_done_callback(self._actions.discard)
+
+    async def _run_action(self, make_request, bot, method) -> None:
+        try:
+            await make_request(bot, method)
+            self.counters["actions_sent"] += 1
+        except TelegramRetryAfter as e:
+            self._flood(method.chat_id, e.retry_after)
+        except Exception:
+            self.counters["actions_failed"] += 1
+            logger.debug("chat action failed", exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "waiting": self.waiting,
+            "chats_queued": len(self._queued),
+            "actions_in_flight": len(self._actions),
+            **self.counters,
+        }
@@ -0,0 +1,227 @@
+# шардированный запуск: фронт принимает апдейты и раздаёт их воркер-процессам по chat_id
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+from collections import Counter
+from typing import Callable
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger("sharding")
+
+# пустой ответ inbox.get по таймауту: воркер заодно проверяет, жив ли фронт
+_IDLE = object()
+
+
+def shard_key(update: Update, data: dict) -> int:
+    chat = data.get("event_chat")
+    if chat is not None:
+        return chat.id
+    user = data.get("event_from_user")
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+def shard_for(key: int, shards: int) -> int:
+    return key % shards
+
+
+class ShardForwarder:
+    """
+    Outer-middleware апдейтов фронта: вместо хендлеров кладёт апдейт в очередь шарда.
+    Чат всегда попадает в один воркер — его FSM, burst, in-flight генерации и typing
+    живут в одном процессе, а апдейты чата приходят туда в порядке приёма.
+    """
+
+    def __init__(self, inboxes: list):
+        self.inboxes = inboxes
+        self.forwarded: Counter = Counter()
+
+    async def __call__(self, handler, event: Update, data: dict):
+        shard = shard_for(shard_key(event, data), len(self.inboxes))
+        self.inboxes[shard].put(event.model_dump_json(by_alias=True, exclude_unset=True))
+        self.forwarded[shard] += 1
+        return None
+
+
+# команда воркеру через его очередь: (CANCEL_CHAT, chat_id, reason)
+CANCEL_CHAT = "cancel_chat"
+
+
+class ChatControl:
+    """
+    Действия над чужим чатом (админ удаляет пользователя): отмена идущих генераций и сброс
+    буфера логов должны случиться в процессе, который обслуживает этот чат. В одном процессе —
+    сразу (local), при шардинге — командой в очередь шарда-владельца.
+    """
+
+    def __init__(self, local: Callable[[int, str], None], *, shard: int = 0, shards: int = 1, inboxes: list | None = None):
+        self.local = local
+        self.shard = shard
+        self.shards = shards
+        self.inboxes = inboxes
+
+    def cancel(self, chat_id: int, reason: str = "") -> None:
+        owner = shard_for(chat_id, self.shards)
+        if self.inboxes is None or owner == self.shard:
+            self.local(chat_id, reason)
+            return
+        self.inboxes[owner].put((CANCEL_CHAT, chat_id, reason))
+
+
+class ShardPool:
+    """Воркер-процессы и их очереди; упавший воркер перезапускается и дочитывает свою очередь."""
+
+    def __init__(self, shards: int, *, drain_timeout: float = 30.0):
+        # spawn: у воркера свой чистый интерпретатор, без унаследованного event loop и соединений
+        self._ctx = mp.get_context("spawn")
+        self.shards = shards
+        self.drain_timeout = drain_timeout
+        self.inboxes = [self._ctx.Queue() for _ in range(shards)]
+        self._procs: list = [None] * shards
+        self.restarts: Counter = Counter()
+
+    def start(self) -> None:
+        for shard in range(self.shards):
+            self._spawn(shard)
+
+    def _spawn(self, shard: int) -> None:
+        proc = self._ctx.Process(
+            target=worker_main,
+            args=(shard, self.shards, self.inboxes),
+            name=f"shard-{shard}",
+        )
+        proc.start()
+        self._procs[shard] = proc
+        logger.info("shard-%s started (pid=%s)", shard, proc.pid)
+
+    async def watch(self, interval: float = 5.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for shard, proc in enumerate(self._procs):
+                if proc is not None and not proc.is_alive():
+                    logger.error("shard-%s exited with code %s, restarting", shard, proc.exitcode)
+                    self.restarts[shard] += 1
+                    self._spawn(shard)
+
+    async def stop(self) -> None:
+        # None — команда воркеру: дообработать принятое и выйти
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for shard, proc in enumerate(self._procs):
+            if proc is None:
+                continue
+            await asyncio.to_thread(proc.join, self.drain_timeout + 30)
+            if proc.is_alive():
+                logger.warning("shard-%s did not stop in time, terminating", shard)
+                proc.terminate()
+                await asyncio.to_thread(proc.join, 5)
+        for inbox in self.inboxes:
+            inbox.close()
+
+
+async def run_sharded(settings) -> None:
+    """
+    Фронт: принимает апдейты (polling или webhook, как в обычном режиме) и раздаёт их
+    BOT_SHARDS воркерам. Хендлеров, БД и клиента модели во фронте нет.
+    """
+    from app.bot.admin_handlers import router as admin_router
+    from app.bot.handlers import router as user_router
+    from app.main import run_updates
+
+    pool = ShardPool(settings.bot_shards, drain_timeout=settings.shard_drain_timeout)
+    forwarder = ShardForwarder(pool.inboxes)
+
+    bot = Bot(token=settings.bot_token)
+    dp = Dispatcher()
+    # роутеры нужны только для allowed_updates — до хендлеров апдейт не доходит
+    dp.include_router(admin_router)
+    dp.include_router(user_router)
+    dp.update.outer_middleware(forwarder)
+
+    pool.start()
+    watcher = asyncio.create_task(pool.watch())
+    try:
+        await run_updates(bot, dp)
+    finally:
+        watcher.cancel()
+        await pool.stop()
+        logger.info("forwarded updates: %s | restarts: %s", dict(forwarder.forwarded), dict(pool.restarts))
+        await bot.session.close()
+
+
+def worker_main(shard: int, shards: int, inboxes: list) -> None:
+    from app.main import LOG_FORMAT
+
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT.replace("%(name)s", f"shard-{shard} | %(name)s"))
+    # Ctrl+C приходит всей группе процессов — воркер останавливается по команде фронта, дописав принятое
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(shard, shards, inboxes))
+
+
+def _next(inbox):
+    try:
+        return inbox.get(timeout=1.0)
+    except queue.Empty:
+        return _IDLE
+
+
+async def _process(dp: Dispatcher, bot: Bot, update: Update) -> None:
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception("Failed to process update id=%s", update.update_id)
+
+
+async def _serve(shard: int, shards: int, inboxes: list) -> None:
+    from app.config import settings
+    from app.main import build_runtime
+
+    inbox = inboxes[shard]
+    runtime = await build_runtime(shard=shard, shards=shards, inboxes=inboxes)
+    bot, dp = runtime.bot, runtime.dp
+    runtime.start()
+
+    stop = asyncio.Event()
+    with contextlib.suppress(NotImplementedError, RuntimeError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    parent = os.getppid()
+    tasks: set[asyncio.Task] = set()
+    try:
+        while not stop.is_set():
+            raw = await asyncio.to_thread(_next, inbox)
+            if raw is None:
+                break
+            if raw is _IDLE:
+                if os.getppid() != parent:
+                    logger.warning("front process is gone, stopping")
+                    break
+                continue
+            if isinstance(raw, tuple):
+                # команда от другого шарда (админ-действие над чатом этого шарда)
+                if raw[0] == CANCEL_CHAT:
+                    runtime.chat_control.local(raw[1], raw[2])
+                continue
+            update = Update.model_validate_json(raw, context={"bot": bot})
+            # как в polling: апдейты — отдельными задачами в порядке приёма
+            # (burst склеивает подряд идущие сообщения чата, завершение диалога отменяет генерацию)
+            task = asyncio.create_task(_process(dp, bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            _, pending = await asyncio.wait(set(tasks), timeout=settings.shard_drain_timeout)
+            if pending:
+                logger.warning("%s updates still in progress on shutdown, cancelling", len(pending))
+                for task in pending:
+                    task.cancel()
+        await runtime.close()
@@ -0,0 +1,107 @@
+# стриминг ответа LLM в Telegram: первый абзац — сразу, дальше редкие edit'ы
+
+from __future__ import annotations
+
+import time
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+
+class StreamingReply:
+    """
+    Принимает дельты текста и показывает их пользователю.
+    - первое сообщение уходит, как только закончился первый абзац;
+    - дальше то же сообщение редактируется не чаще, чем раз в edit_interval;
+    - когда текущее сообщение вырастает за max_len, оно "закрывается" на границе абзаца
+      (как _split_response) и продолжение идёт новым сообщением.
+    """
+
+    # Telegram режет сообщения на 4096, держим запас
+    HARD_LEN = 4000
+
+    def __init__(self, message: Message, *, max_len: int = 800, edit_interval: float = 1.5):
+        self.message = message
+        self.max_len = max_len
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.sent: list[Message] = []
+        self._seg_start = 0
+        self._current: Message | None = None
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def feed(self, delta: str) -> None:
+        self.text += delta
+        await self._pump(final=False)
+
+    async def finish(self) -> str:
+        await self._pump(final=True)
+        return self.text.strip()
+
+    async def discard(self) -> None:
+        # при фолбэке на обычный режим убираем то, что успели показать
+        for m in self.sent:
+            try:
+                await m.delete()
+            except Exception:
+                pass
+        self.sent.clear()
+
+    def _split_point(self, seg: str) -> int:
+        i = seg.rfind("\n\n", 0, self.max_len + 1)
+        if i > 0:
+            return i
+        # первый абзац сам длиннее max_len — режем после него целиком
+        i = seg.find("\n\n", self.max_len)
+        if i > 0:
+            return i
+        if len(seg) > self.HARD_LEN:
+            i = seg.rfind(" ", 0, self.HARD_LEN)
+            return i if i > 0 else self.HARD_LEN
+        return 0
+
+    async def _pump(self, final: bool) -> None:
+        while len(self.text) - self._seg_start > self.max_len:
+            seg = self.text[self._seg_start:]
+            cut = self._split_point(seg)
+            if not cut:
+                break
+            head = seg[:cut].strip()
+            if head:
+                await self._show(head, force=True)
+            self._current = None
+            self._shown = ""
+            self._seg_start += cut
+
+        seg = self.text[self._seg_start:]
+        if self._current is None and not final:
+            # новое сообщение открываем только с законченным абзацем
+            i = seg.rfind("\n\n")
+            visible = seg[:i].strip() if i > 0 else ""
+            if visible:
+                await self._show(visible, force=True)
+            return
+        visible = seg.strip()
+        if visible:
+            await self._show(visible, force=final)
+
+    async def _show(self, text: str, force: bool) -> None:
+        if text == self._shown:
+            return
+        if self._current is None:
+            self._current = await self.message.answer(text)
+            self.sent.append(self._current)
+            self._shown = text
+            self._last_edit = time.monotonic()
+            return
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.edit_interval:
+            return
+        try:
+            await self._current.edit_text(text)
+        except TelegramBadRequest:
+            # "message is not modified" и т.п. — не критично
+            pass
+        self._shown = text
+        self._last_edit = now
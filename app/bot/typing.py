@@ -0,0 +1,88 @@
+# индикатор "печатает..." для всех чатов с идущей генерацией — один таймер на процесс
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections import Counter
+
+from aiogram.enums import ChatAction
+
+logger = logging.getLogger("typing")
+
+
+class TypingTicker:
+    """
+    Держит набор чатов, где сейчас генерируется ответ (со счётчиком ссылок: у чата может быть
+    несколько ждущих сообщений), и одной фоновой задачей шлёт каждому не больше одного
+    typing раз в interval. Первый typing — сразу при входе чата в набор.
+    chat action идут через SendScheduler: при нагрузке он их выбрасывает, ответы важнее.
+    """
+
+    def __init__(self, bot, *, interval: float = 4.0):
+        self.bot = bot
+        # Telegram показывает действие ~5 секунд — обновляем чуть раньше
+        self.interval = interval
+        self._refs: Counter = Counter()
+        self._due: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def acquire(self, chat_id: int) -> None:
+        self._refs[chat_id] += 1
+        if self._refs[chat_id] == 1:
+            self._due[chat_id] = time.monotonic()
+            self._wake.set()
+
+    def release(self, chat_id: int) -> None:
+        self._refs[chat_id] -= 1
+        if self._refs[chat_id] <= 0:
+            del self._refs[chat_id]
+            self._due.pop(chat_id, None)
+
+    @contextlib.contextmanager
+    def typing(self, chat_id: int):
+        self.acquire(chat_id)
+        try:
+            yield
+        finally:
+            self.release(chat_id)
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            due = [c for c, t in self._due.items() if t <= now]
+            for chat_id in due:
+                self._due[chat_id] = now + self.interval
+            if due:
+                results = await asyncio.gather(
+                    *(self.bot.send_chat_action(chat_id, ChatAction.TYPING) for chat_id in due),
+                    return_exceptions=True,
+                )
+                self.sent += len(due)
+                for chat_id, r in zip(due, results):
+                    if isinstance(r, Exception):
+                        logger.debug("typing failed for chat_id=%s: %s", chat_id, r)
+
+            # спим до ближайшего срока или до нового чата
+            self._wake.clear()
+            timeout = (min(self._due.values()) - time.monotonic()) if self._due else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+
+    def stats(self) -> dict:
+        return {"chats": len(self._refs), "refs": sum(self._refs.values()), "sent": self.sent}
@@ -0,0 +1,96 @@
+# приём апдейтов вебхуком: aiohttp-сервер + SimpleRequestHandler aiogram
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger("webhook")
+
+
+def webhook_secret(settings) -> str:
+    # Telegram допускает A-Z a-z 0-9 _ - до 256 символов; sha256 от токена подходит и совпадает у реплик
+    if settings.webhook_secret:
+        return settings.webhook_secret
+    return hashlib.sha256(f"webhook:{settings.bot_token}".encode("utf-8")).hexdigest()
+
+
+async def _healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, settings) -> None:
+    """
+    Поднимает aiohttp-сервер на WEBHOOK_HOST:WEBHOOK_PORT и регистрирует вебхук в Telegram.
+    Апдейт подтверждается 200 сразу, обработка идёт в фоне (handle_in_background),
+    запросы без верного секрета отклоняются. Работает до SIGTERM/SIGINT: при остановке
+    перестаёт принимать запросы и ждёт фоновые апдейты до shard_drain_timeout, остаток отменяет.
+    Вебхук при остановке не снимаем: остальные реплики продолжают принимать апдейты.
+    """
+    if not settings.webhook_base_url:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_BASE_URL")
+    secret = webhook_secret(settings)
+
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,
+        handle_in_background=True,
+    )
+    handler.register(app, path=settings.webhook_path)
+    app.router.add_get("/healthz", _healthz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.webhook_host, port=settings.webhook_port)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s%s", settings.webhook_host, settings.webhook_port, settings.webhook_path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await bot.set_webhook(
+            settings.webhook_url,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=settings.webhook_max_connections,
+        )
+        logger.info("Webhook set to %s", settings.webhook_url)
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                loop.remove_signal_handler(sig)
+        # новые апдейты не принимаем (Telegram повторит их на другой реплике или после рестарта),
+        # принятые и уже подтверждённые 200 дорабатываем — иначе они потеряются
+        await site.stop()
+        await _drain(handler, settings.shard_drain_timeout)
+        # cleanup дождётся shutdown-хуков диспетчера
+        await runner.cleanup()
+
+
+async def _drain(handler: SimpleRequestHandler, timeout: float) -> None:
+    # задачи handle_in_background aiogram держит в handler._background_feed_update_tasks
+    tasks = set(handler._background_feed_update_tasks)
+    if not tasks:
+        return
+    logger.info("Waiting for %s updates in progress", len(tasks))
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        logger.warning("%s updates still in progress on shutdown, cancelling", len(pending))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -13,13 +13,88 @@ class Settings:
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
     openai_model: str = os.getenv("OPENAI_MODEL", "gpt-5")
     openai_memory_model: str = os.getenv("OPENAI_MEMORY_MODEL", "gpt-5-mini")
+    # сколько одновременных запросов держим к каждой модели (остальные ждут в очереди)
+    openai_max_concurrency: int = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+    openai_memory_max_concurrency: int = int(os.getenv("OPENAI_MEMORY_MAX_CONCURRENCY", "4"))
+    # очередь к моделям под нагрузкой: доли слотов по классам и после скольких секунд ожидания
+    # запрос идёт вне очереди (защита бесплатных и фона от голодания)
+    llm_weight_paid: float = float(os.getenv("LLM_WEIGHT_PAID", "4"))
+    llm_weight_free: float = float(os.getenv("LLM_WEIGHT_FREE", "2"))
+    llm_weight_background: float = float(os.getenv("LLM_WEIGHT_BACKGROUND", "1"))
+    llm_max_queue_wait: float = float(os.getenv("LLM_MAX_QUEUE_WAIT", "10"))
+    # перегрузка: ожидаемое ожидание модели дольше SLO — сообщаем место в очереди,
+    # дольше OVERLOAD_DEFER_SEC — откладываем ответ в очередь задач (0 — не откладывать)
+    overload_enabled: bool = os.getenv("OVERLOAD_ENABLED", "1") == "1"
+    overload_slo_sec: float = float(os.getenv("OVERLOAD_SLO_SEC", "20"))
+    overload_defer_sec: float = float(os.getenv("OVERLOAD_DEFER_SEC", "60"))
+    overload_notify_cooldown: float = float(os.getenv("OVERLOAD_NOTIFY_COOLDOWN", "60"))
+    openai_max_retries: int = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+    # память: обновляем раз в N реплик или после паузы в N секунд
+    memory_update_turns: int = int(os.getenv("MEMORY_UPDATE_TURNS", "3"))
+    memory_update_idle_sec: float = float(os.getenv("MEMORY_UPDATE_IDLE_SEC", "90"))
+    # профили генерации (reasoning effort / потолок выходных токенов / verbosity); пусто или 0 — дефолт API
+    gen_chat_free_effort: str = os.getenv("GEN_CHAT_FREE_EFFORT", "low")
+    gen_chat_free_max_tokens: int = int(os.getenv("GEN_CHAT_FREE_MAX_TOKENS", "1500"))
+    gen_chat_free_verbosity: str = os.getenv("GEN_CHAT_FREE_VERBOSITY", "low")
+    gen_chat_paid_effort: str = os.getenv("GEN_CHAT_PAID_EFFORT", "medium")
+    gen_chat_paid_max_tokens: int = int(os.getenv("GEN_CHAT_PAID_MAX_TOKENS", "3000"))
+    gen_chat_paid_verbosity: str = os.getenv("GEN_CHAT_PAID_VERBOSITY", "medium")
+    gen_memory_effort: str = os.getenv("GEN_MEMORY_EFFORT", "minimal")
+    gen_memory_max_tokens: int = int(os.getenv("GEN_MEMORY_MAX_TOKENS", "600"))
+    gen_memory_verbosity: str = os.getenv("GEN_MEMORY_VERBOSITY", "low")
+    gen_summary_effort: str = os.getenv("GEN_SUMMARY_EFFORT", "minimal")
+    gen_summary_max_tokens: int = int(os.getenv("GEN_SUMMARY_MAX_TOKENS", "800"))
+    gen_summary_verbosity: str = os.getenv("GEN_SUMMARY_VERBOSITY", "low")
+    # контекст диалога: последние реплики в пределах бюджета токенов, старые сворачиваются в пересказ
+    context_budget_tokens: int = int(os.getenv("CONTEXT_BUDGET_TOKENS", "1500"))
+    context_max_turns: int = int(os.getenv("CONTEXT_MAX_TURNS", "20"))
+    context_fold_min_turns: int = int(os.getenv("CONTEXT_FOLD_MIN_TURNS", "4"))
+    # цепочка previous_response_id: до N реплик подряд без пересылки истории (0 — выключено)
+    context_chain_max_turns: int = int(os.getenv("CONTEXT_CHAIN_MAX_TURNS", "10"))
+    # стриминг ответа в чат (первый абзац сразу, дальше edit'ы не чаще раза в N секунд)
+    stream_replies: bool = os.getenv("STREAM_REPLIES", "1") == "1"
+    stream_edit_interval: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+    # пачка сообщений подряд — один запрос: ждём BURST_WINDOW секунд после каждого сообщения чата
+    burst_enabled: bool = os.getenv("BURST_ENABLED", "1") == "1"
+    burst_window: float = float(os.getenv("BURST_WINDOW", "1.5"))
+    burst_max_parts: int = int(os.getenv("BURST_MAX_PARTS", "10"))
+    # исходящие в Telegram: общий лимит и лимит на чат (сообщений в секунду), повторы на 429
+    tg_global_rate: float = float(os.getenv("TG_GLOBAL_RATE", "28"))
+    tg_chat_rate: float = float(os.getenv("TG_CHAT_RATE", "1"))
+    tg_chat_burst: float = float(os.getenv("TG_CHAT_BURST", "3"))
+    tg_max_retries: int = int(os.getenv("TG_MAX_RETRIES", "3"))
+    # как часто обновлять "печатает..." в чатах с идущей генерацией
+    typing_interval: float = float(os.getenv("TYPING_INTERVAL", "4"))
     # Optional: отдельная модель для роутера/классификатора (можно дешевле)
+    # роутер локальный (эвристики + лексическая модель): "ок/спасибо" — шаблоном, лёгкое — openai_memory_model
+    router_enabled: bool = os.getenv("ROUTER_ENABLED", "1") == "1"
+    router_mini_threshold: float = float(os.getenv("ROUTER_MINI_THRESHOLD", "0.75"))
+    router_mini_max_chars: int = int(os.getenv("ROUTER_MINI_MAX_CHARS", "280"))
+    # доля решений роутера, попадающих в лог
+    router_log_sample: float = float(os.getenv("ROUTER_LOG_SAMPLE", "0.1"))
     free_limit: int = int(os.getenv("FREE_LIMIT", "5"))
     daily_hard_limit: int = int(os.getenv("DAILY_HARD_LIMIT", "30"))
+    # дневной бюджет токенов (input + output по usage) для free / paid; 0 — без ограничения
+    free_token_budget: int = int(os.getenv("FREE_TOKEN_BUDGET", "20000"))
+    paid_token_budget: int = int(os.getenv("PAID_TOKEN_BUDGET", "300000"))
     use_fake_db: bool = os.getenv("USE_FAKE_DB", "1") == "1"
+    # write-behind для requests_log: пачка до N строк или раз в N секунд
+    log_batch_size: int = int(os.getenv("LOG_BATCH_SIZE", "200"))
+    log_flush_interval: float = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
     tz: str = os.getenv("TZ", "Europe/Moscow")
+    # сколько дневных выжимок считаем параллельно
+    summary_concurrency: int = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+    # при старте догоняем незавершённые прогоны выжимки за последние N дней
+    summary_resume_days: int = int(os.getenv("SUMMARY_RESUME_DAYS", "2"))
     admin_ids: set[int] = field(default_factory=lambda: _parse_admin_ids(os.getenv("ADMIN_IDS", "")))
 
+    # фоновая очередь задач (таблица jobs): опрос и параллелизм по видам задач
+    jobs_poll_interval: float = float(os.getenv("JOBS_POLL_INTERVAL", "1.0"))
+    jobs_memory_concurrency: int = int(os.getenv("JOBS_MEMORY_CONCURRENCY", "4"))
+    jobs_payment_concurrency: int = int(os.getenv("JOBS_PAYMENT_CONCURRENCY", "2"))
+    # отложенные из-за перегрузки ответы: сколько генерируем параллельно
+    jobs_chat_concurrency: int = int(os.getenv("JOBS_CHAT_CONCURRENCY", "4"))
+
     # Postgres
     pg_host: str = os.getenv("PG_HOST", "localhost")
     pg_port: int = int(os.getenv("PG_PORT", "5432"))
@@ -36,6 +111,30 @@ class Settings:
     # card_price_rub: str = os.getenv("CARD_PRICE_RUB", "299.00")
     card_price_rub: str = os.getenv("CARD_PRICE_RUB", "299.00")
 
+    # приём апдейтов: polling или webhook (aiohttp-сервер); на несколько ядер — BOT_SHARDS, а не реплики (FSM в кеше процесса)
+    bot_mode: str = os.getenv("BOT_MODE", "polling")
+    # публичный адрес, на который Telegram шлёт апдейты: WEBHOOK_BASE_URL + WEBHOOK_PATH
+    webhook_base_url: str = os.getenv("WEBHOOK_BASE_URL", "")
+    webhook_path: str = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+    webhook_host: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    webhook_port: int = int(os.getenv("WEBHOOK_PORT", "8000"))
+    # X-Telegram-Bot-Api-Secret-Token; пусто — выводим из токена бота (одинаковый у всех реплик)
+    webhook_secret: str = os.getenv("WEBHOOK_SECRET", "")
+    webhook_max_connections: int = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+    # FSM в Postgres: окно склейки записей и размер кеша чтений
+    fsm_flush_interval: float = float(os.getenv("FSM_FLUSH_INTERVAL", "0.2"))
+    fsm_cache_size: int = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+
+    # воркеров-процессов с хендлерами; 1 — всё в одном процессе, >1 — фронт раздаёт апдейты по chat_id
+    bot_shards: int = int(os.getenv("BOT_SHARDS", "1"))
+    # сколько воркер шарда или вебхук при остановке ждёт уже принятые апдейты
+    shard_drain_timeout: float = float(os.getenv("SHARD_DRAIN_TIMEOUT", "30"))
+
+    @property
+    def webhook_url(self) -> str:
+        return self.webhook_base_url.rstrip("/") + self.webhook_path
+
     @property
     def pg_dsn(self) -> str:
         return (
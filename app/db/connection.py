@@ -1,8 +1,9 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Dict, List, Union, Any
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Dict, List, Union, Any, Tuple
 
-from app.db.models import RequestLog, UserSubscription, UserProfile
+from app.db.models import RequestLog, UserSubscription, UserProfile, SummaryRun, Job, DialogSummary, LLMUsage
 
 @dataclass
 class FakeDatabase:
@@ -10,11 +11,21 @@ class FakeDatabase:
     user_subscriptions: Dict[int, UserSubscription]  # key = chat_id
     users: Dict[int, UserProfile]  # key = chat_id
     _request_id_seq: int = 0
+    summary_runs: Dict[Tuple[date, int], SummaryRun] = field(default_factory=dict)  # key = (day, chat_id)
+    jobs: Dict[int, Job] = field(default_factory=dict)  # key = job id
+    _job_id_seq: int = 0
+    dialog_summaries: Dict[int, DialogSummary] = field(default_factory=dict)  # key = chat_id
+    llm_usage: List[LLMUsage] = field(default_factory=list)
+    fsm_states: Dict[str, Tuple[Any, str]] = field(default_factory=dict)  # key = ключ FSM, (state, data json)
 
     def next_request_id(self) -> int:
         self._request_id_seq += 1
         return self._request_id_seq
 
+    def next_job_id(self) -> int:
+        self._job_id_seq += 1
+        return self._job_id_seq
+
 async def get_db(use_fake: bool, dsn: str):
     """
     Если use_fake=True -> FakeDatabase.
@@ -12,6 +12,9 @@ class RequestLog:
     input: str
     output: str
     summary: Optional[str] = None  # раз в сутки в 00:00 МСК
+    # id ответа в Responses API и номер реплики в цепочке previous_response_id (1 — начало цепочки)
+    response_id: Optional[str] = None
+    chain_len: int = 0
 
 @dataclass
 class UserSubscription:
@@ -38,6 +41,9 @@ class UserSubscription:
     username: str | None = None
     full_name: str | None = None
 
+    # tokens_used — сколько токенов (оценка + сверка по usage) потрачено за сутки
+    tokens_used: int = 0
+
 @dataclass
 class UserProfile:
     chat_id: int
@@ -48,3 +54,56 @@ class UserProfile:
     consented: int = 0
     memory: str | None = None
     end_dialog: int = 0
+
+@dataclass
+class DialogSummary:
+    # сжатый пересказ старой части диалога: всё до requests_log.id <= upto_id уже внутри summary
+    chat_id: int
+    summary: str
+    upto_id: int = 0
+    updated_at: Optional[datetime] = None
+
+@dataclass
+class Admission:
+    # результат admit_message: можно ли отвечать + всё, что нужно хендлеру
+    ok: bool
+    reason: str
+    subscription: UserSubscription
+    profile: UserProfile | None = None
+
+@dataclass
+class SummaryRun:
+    # прогресс дневной выжимки по одному чату (таблица summary_runs)
+    day: date
+    chat_id: int
+    status: str = "pending"  # pending | done | failed
+    attempts: int = 0
+    summary: Optional[str] = None
+    error: Optional[str] = None
+
+@dataclass
+class Job:
+    # фоновая задача из таблицы jobs
+    id: int
+    kind: str
+    payload: dict
+    dedupe_key: Optional[str] = None
+    status: str = "queued"  # queued | running | failed
+    attempts: int = 0
+    max_attempts: int = 5
+    run_at: Optional[datetime] = None
+    locked_until: Optional[datetime] = None
+    last_error: Optional[str] = None
+
+@dataclass
+class LLMUsage:
+    # один вызов модели (таблица llm_usage): токены и время ответа API
+    ts: datetime
+    chat_id: Optional[int]
+    model: str
+    mode: str  # chat | chat_retry | memory | summary | context ...
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+    latency_ms: int = 0
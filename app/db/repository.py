@@ -5,7 +5,7 @@ from datetime import datetime, date, time, timedelta
 from zoneinfo import ZoneInfo
 from typing import Optional, Tuple, Any, List
 
-from app.db.models import RequestLog, UserSubscription, UserProfile
+from app.db.models import RequestLog, UserSubscription, UserProfile, Admission, SummaryRun, Job, DialogSummary, LLMUsage
 from app.utils.time import today_msk, now_msk
 from app.services.limits import is_paid_active, is_banned
 
@@ -19,12 +19,95 @@ def _day_bounds(tz_name: str, day: date) -> tuple[datetime, datetime]:
     return start, end
 
 
+BANNED_REASON = "⛔️ Вы временно забанены на сутки за превышение лимита. Напишите в поддержку: test@gmail.com"
+HARD_LIMIT_REASON = "⛔️ Слишком много запросов за сутки. Напишите в поддержку: test@gmail.com"
+FREE_LIMIT_REASON = (
+    "У вас закончился лимит! Предлагаем вам купить нашу подписку!\n\n"
+    "Вот основные преимущества подписки:\n"
+    "✨ Безлимитные сообщения\n"
+    "🤖 Улучшенная модель\n"
+    "🖼 Понимание фото\n"
+    "💡 Глубокий анализ проблемы\n"
+    "🔒 Повышенная анонимность\n"
+    "🚀 Высокая скорость работы\n\n"
+    "Выбери способ оплаты:"
+)
+TOKEN_LIMIT_REASON = (
+    "⏳ На сегодня закончился лимит по объёму сообщений. "
+    "Он обновится завтра, а с подпиской лимит намного больше."
+)
+PAID_TOKEN_LIMIT_REASON = "⏳ На сегодня исчерпан дневной объём сообщений. Лимит обновится завтра."
+
+
+def _admission_decision(
+    u: UserSubscription, today: date, daily_hard_limit: int, token_budget: int = 0
+) -> Tuple[bool, str, bool]:
+    """
+    Решение по лимитам для уже нормализованной подписки (сброс дня/истечение paid сделаны).
+    token_budget — дневной бюджет токенов для тарифа пользователя (0 — без ограничения).
+    Returns: (ok, reason, need_ban) — need_ban=True, если надо проставить ban_until=today.
+    """
+    if is_banned(u, today):
+        return False, BANNED_REASON, False
+    if u.total_requests >= daily_hard_limit:
+        return False, HARD_LIMIT_REASON, True
+    if is_paid_active(u, today):
+        if token_budget and u.tokens_used >= token_budget:
+            return False, PAID_TOKEN_LIMIT_REASON, False
+        return True, "", False
+    if (u.num_request is not None) and (u.num_request <= 0):
+        return False, FREE_LIMIT_REASON, False
+    if token_budget and u.tokens_used >= token_budget:
+        return False, TOKEN_LIMIT_REASON, False
+    return True, "", False
+
+
+def _row_to_log(row: Any) -> RequestLog:
+    return RequestLog(
+        id=row["id"],
+        date=row["date"],
+        chat_id=row["chat_id"],
+        input=row["input"],
+        output=row["output"],
+        summary=row["summary"],
+        response_id=row["response_id"],
+        chain_len=row["chain_len"] or 0,
+    )
+
+
+def _row_to_profile(row: Any) -> UserProfile:
+    return UserProfile(
+        chat_id=row["chat_id"],
+        started_at=row["started_at"],
+        name=row["name"],
+        gender=row["gender"],
+        age=row["age"],
+        consented=row["consented"] or 0,
+        memory=row["memory"],
+        end_dialog=row["end_dialog"] or 0,
+    )
+
+
 class Repository:
-    def __init__(self, db, tz: str, free_limit: int, daily_hard_limit: int):
+    def __init__(
+        self,
+        db,
+        tz: str,
+        free_limit: int,
+        daily_hard_limit: int,
+        free_token_budget: int = 0,
+        paid_token_budget: int = 0,
+    ):
         self.db = db  # FakeDatabase или asyncpg.Pool
         self.tz = tz
         self.free_limit = free_limit
         self.daily_hard_limit = daily_hard_limit
+        # дневные бюджеты токенов по тарифу (0 — без ограничения), в дополнение к лимитам сообщений
+        self.free_token_budget = free_token_budget
+        self.paid_token_budget = paid_token_budget
+
+    def token_budget(self, u: UserSubscription, today: date) -> int:
+        return self.paid_token_budget if is_paid_active(u, today) else self.free_token_budget
 
     def _is_fake(self) -> bool:
         return hasattr(self.db, "user_subscriptions") and hasattr(self.db, "requests_log")
@@ -48,6 +131,7 @@ class Repository:
         if u.date != today:
             u.date = today
             u.total_requests = 0
+            u.tokens_used = 0
             u.ban_until = None
             u.num_request = self.free_limit if u.subscribe == 0 else None
 
@@ -73,6 +157,7 @@ class Repository:
             ban_until=row["ban_until"],
             username=row["username"],
             full_name=row["full_name"],
+            tokens_used=row["tokens_used"] or 0,
         )
 
     async def _ensure_user_pg(self, conn, chat_id: int) -> UserSubscription:
@@ -80,7 +165,7 @@ class Repository:
 
         row = await conn.fetchrow(
             """
-            SELECT date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+            SELECT date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
             FROM user_subscriptions
             WHERE chat_id=$1
             FOR UPDATE
@@ -93,7 +178,7 @@ class Repository:
                 """
                 INSERT INTO user_subscriptions (chat_id, date, num_request, subscribe, total_requests)
                 VALUES ($1, $2, $3, 0, 0)
-                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
                 """,
                 chat_id,
                 today,
@@ -111,10 +196,11 @@ class Repository:
                 UPDATE user_subscriptions
                 SET date=$2,
                     total_requests=0,
+                    tokens_used=0,
                     ban_until=NULL,
                     num_request=$3
                 WHERE chat_id=$1
-                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
                 """,
                 chat_id,
                 today,
@@ -132,7 +218,7 @@ class Repository:
                     end_payment_date=NULL,
                     num_request=$2
                 WHERE chat_id=$1
-                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
                 """,
                 chat_id,
                 self.free_limit,
@@ -164,85 +250,139 @@ class Repository:
 
         async with self.db.acquire() as conn:
             async with conn.transaction():
-                await self._ensure_user_pg(conn, chat_id)
-                row = await conn.fetchrow(
-                    """
-                    UPDATE user_subscriptions
-                    SET subscribe=1,
-                        payment_date=$2,
-                        end_payment_date=$3,
-                        num_request=NULL
-                    WHERE chat_id=$1
-                    RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
-                    """,
-                    chat_id,
-                    today,
-                    today + timedelta(days=30),
-                )
-                return self._row_to_user(row)
+                return await self._activate_paid_30d_pg(conn, chat_id, today)
+
+    async def _activate_paid_30d_pg(self, conn, chat_id: int, today: date) -> UserSubscription:
+        await self._ensure_user_pg(conn, chat_id)
+        row = await conn.fetchrow(
+            """
+            UPDATE user_subscriptions
+            SET subscribe=1,
+                payment_date=$2,
+                end_payment_date=$3,
+                num_request=NULL
+            WHERE chat_id=$1
+            RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
+            """,
+            chat_id,
+            today,
+            today + timedelta(days=30),
+        )
+        return self._row_to_user(row)
 
     async def can_make_request(self, chat_id: int) -> Tuple[bool, str]:
         today = today_msk(self.tz)
 
         if self._is_fake():
             u = await self._ensure_user_fake(chat_id)
-            if is_banned(u, today):
-                return False, "⛔️ Вы временно забанены на сутки за превышение лимита. Напишите в поддержку: test@gmail.com"
-            paid = is_paid_active(u, today)
-            if u.total_requests >= self.daily_hard_limit:
+            ok, reason, need_ban = _admission_decision(
+                u, today, self.daily_hard_limit, self.token_budget(u, today)
+            )
+            if need_ban:
                 u.ban_until = today
-                return False, "⛔️ Слишком много запросов за сутки. Напишите в поддержку: test@gmail.com"
-            if paid:
-                return True, ""
-            if (u.num_request is not None) and (u.num_request <= 0):
-                return False, (
-                    "У вас закончился лимит! Предлагаем вам купить нашу подписку!\n\n"
-                    "Вот основные преимущества подписки:\n"
-                    "✨ Безлимитные сообщения\n"
-                    "🤖 Улучшенная модель\n"
-                    "🖼 Понимание фото\n"
-                    "💡 Глубокий анализ проблемы\n"
-                    "🔒 Повышенная анонимность\n"
-                    "🚀 Высокая скорость работы\n\n"
-                    "Выбери способ оплаты:"
-                )
-            return True, ""
+            return ok, reason
 
         async with self.db.acquire() as conn:
             async with conn.transaction():
                 u = await self._ensure_user_pg(conn, chat_id)
-
-                if is_banned(u, today):
-                    return False, "⛔️ Вы временно забанены на сутки за превышение лимита. Напишите в поддержку: test@gmail.com"
-
-                paid = is_paid_active(u, today)
+                ok, reason, need_ban = _admission_decision(
+                    u, today, self.daily_hard_limit, self.token_budget(u, today)
+                )
 
                 # hard-limit
-                if u.total_requests >= self.daily_hard_limit:
+                if need_ban:
                     await conn.execute(
                         "UPDATE user_subscriptions SET ban_until=$2 WHERE chat_id=$1",
                         chat_id,
                         today,
                     )
-                    return False, "⛔️ Слишком много запросов за сутки. Напишите в поддержку: test@gmail.com"
+                return ok, reason
 
-                if paid:
-                    return True, ""
-
-                if (u.num_request is not None) and (u.num_request <= 0):
-                    return False, (
-                        "У вас закончился лимит! Предлагаем вам купить нашу подписку!\n\n"
-                        "Вот основные преимущества подписки:\n"
-                        "✨ Безлимитные сообщения\n"
-                        "🤖 Улучшенная модель\n"
-                        "🖼 Понимание фото\n"
-                        "💡 Глубокий анализ проблемы\n"
-                        "🔒 Повышенная анонимность\n"
-                        "🚀 Высокая скорость работы\n\n"
-                        "Выбери способ оплаты:"
-                    )
+    async def admit_message(self, chat_id: int, username: str | None, full_name: str | None) -> Admission:
+        """
+        Быстрый путь для каждого сообщения в чате: вместо get_user_profile + touch_user_profile
+        + can_make_request (три транзакции и два FOR UPDATE) — один upsert, который сам делает
+        сброс дня / истечение paid, обновляет ник/имя и сразу отдаёт профиль из users.
+        """
+        today = today_msk(self.tz)
+
+        if self._is_fake():
+            u = await self._ensure_user_fake(chat_id)
+            u.username = username
+            u.full_name = full_name
+            ok, reason, need_ban = _admission_decision(
+                u, today, self.daily_hard_limit, self.token_budget(u, today)
+            )
+            if need_ban:
+                u.ban_until = today
+            return Admission(ok=ok, reason=reason, subscription=u, profile=self.db.users.get(chat_id))
 
-                return True, ""
+        async with self.db.acquire() as conn:
+            # new_day / expired считаем по старым значениям строки (us.*), как в _ensure_user_pg
+            row = await conn.fetchrow(
+                """
+                WITH s AS (
+                    INSERT INTO user_subscriptions AS us
+                        (chat_id, date, num_request, subscribe, total_requests, username, full_name)
+                    VALUES ($1, $2, $3, 0, 0, $4, $5)
+                    ON CONFLICT (chat_id) DO UPDATE
+                    SET date=EXCLUDED.date,
+                        total_requests = CASE WHEN us.date <> EXCLUDED.date THEN 0 ELSE us.total_requests END,
+                        tokens_used = CASE WHEN us.date <> EXCLUDED.date THEN 0 ELSE us.tokens_used END,
+                        ban_until = CASE WHEN us.date <> EXCLUDED.date THEN NULL ELSE us.ban_until END,
+                        num_request = CASE
+                            WHEN us.subscribe = 1 AND us.end_payment_date IS NOT NULL
+                                 AND EXCLUDED.date > us.end_payment_date THEN $3
+                            WHEN us.date <> EXCLUDED.date THEN
+                                CASE WHEN us.subscribe = 0 THEN $3 ELSE NULL END
+                            ELSE us.num_request
+                        END,
+                        subscribe = CASE
+                            WHEN us.subscribe = 1 AND us.end_payment_date IS NOT NULL
+                                 AND EXCLUDED.date > us.end_payment_date THEN 0
+                            ELSE us.subscribe
+                        END,
+                        payment_date = CASE
+                            WHEN us.subscribe = 1 AND us.end_payment_date IS NOT NULL
+                                 AND EXCLUDED.date > us.end_payment_date THEN NULL
+                            ELSE us.payment_date
+                        END,
+                        end_payment_date = CASE
+                            WHEN us.subscribe = 1 AND us.end_payment_date IS NOT NULL
+                                 AND EXCLUDED.date > us.end_payment_date THEN NULL
+                            ELSE us.end_payment_date
+                        END,
+                        username=EXCLUDED.username,
+                        full_name=EXCLUDED.full_name
+                    RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
+                )
+                SELECT s.*,
+                       u.chat_id IS NOT NULL AS has_profile,
+                       u.started_at, u.name, u.gender, u.age, u.consented, u.memory, u.end_dialog
+                FROM s
+                LEFT JOIN users u ON u.chat_id = s.chat_id
+                """,
+                chat_id,
+                today,
+                self.free_limit,
+                username,
+                full_name,
+            )
+            u = self._row_to_user(row)
+            profile = _row_to_profile(row) if row["has_profile"] else None
+
+            ok, reason, need_ban = _admission_decision(
+                u, today, self.daily_hard_limit, self.token_budget(u, today)
+            )
+            if need_ban:
+                # редкий путь: упёрлись в hard-limit
+                await conn.execute(
+                    "UPDATE user_subscriptions SET ban_until=$2 WHERE chat_id=$1",
+                    chat_id,
+                    today,
+                )
+                u.ban_until = today
+            return Admission(ok=ok, reason=reason, subscription=u, profile=profile)
 
     async def record_interaction_atomic(self, chat_id: int, user_input: str, model_output: str) -> RequestLog:
         today = today_msk(self.tz)
@@ -313,6 +453,218 @@ class Repository:
                     summary=row["summary"],
                 )
 
+    async def reserve_request(self, chat_id: int, tokens: int = 0) -> UserSubscription | None:
+        """
+        Атомарно "забирает" один запрос из лимита: total_requests + 1, для free ещё num_request - 1,
+        и оценку токенов (tokens) из дневного бюджета тарифа.
+        Проверка и списание — один условный UPDATE, поэтому параллельные сообщения одного чата
+        не могут вместе проскочить free_limit/daily_hard_limit/бюджет токенов.
+        Returns: подписку после списания или None, если запрос не разрешён.
+        Если генерация не удалась — вернуть через release_request, после ответа — сверить через adjust_tokens.
+        """
+        today = today_msk(self.tz)
+        tokens = max(int(tokens), 0)
+
+        if self._is_fake():
+            u = await self._ensure_user_fake(chat_id)
+            ok, _, need_ban = _admission_decision(u, today, self.daily_hard_limit, self.token_budget(u, today))
+            if need_ban:
+                u.ban_until = today
+            if not ok:
+                return None
+            u.total_requests += 1
+            u.tokens_used += tokens
+            if not is_paid_active(u, today) and u.num_request is not None:
+                u.num_request -= 1
+            return u
+
+        async with self.db.acquire() as conn:
+            # бюджет проверяем по уже потраченному: последний запрос может немного выйти за него
+            row = await conn.fetchrow(
+                """
+                UPDATE user_subscriptions
+                SET total_requests = total_requests + 1,
+                    tokens_used = tokens_used + $4,
+                    num_request = CASE
+                        WHEN num_request IS NULL THEN NULL
+                        WHEN subscribe = 1 AND end_payment_date IS NOT NULL AND end_payment_date >= $2 THEN num_request
+                        ELSE num_request - 1
+                    END
+                WHERE chat_id=$1
+                  AND date = $2
+                  AND (ban_until IS NULL OR ban_until < $2)
+                  AND total_requests < $3
+                  AND (
+                      (subscribe = 1 AND end_payment_date IS NOT NULL AND end_payment_date >= $2)
+                      OR num_request IS NULL
+                      OR num_request > 0
+                  )
+                  AND (
+                      CASE WHEN subscribe = 1 AND end_payment_date IS NOT NULL AND end_payment_date >= $2
+                           THEN $6 ELSE $5 END = 0
+                      OR tokens_used < CASE WHEN subscribe = 1 AND end_payment_date IS NOT NULL AND end_payment_date >= $2
+                                            THEN $6 ELSE $5 END
+                  )
+                RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
+                """,
+                chat_id,
+                today,
+                self.daily_hard_limit,
+                tokens,
+                self.free_token_budget,
+                self.paid_token_budget,
+            )
+            return self._row_to_user(row) if row else None
+
+    async def release_request(self, chat_id: int, tokens: int = 0) -> None:
+        """
+        Возврат запроса (и оценки токенов), забранного reserve_request (LLM упал / ответ не доставлен).
+        Возвращаем только в пределах того же дня — после сброса счётчиков возвращать нечего.
+        """
+        today = today_msk(self.tz)
+        tokens = max(int(tokens), 0)
+
+        if self._is_fake():
+            u = self.db.user_subscriptions.get(chat_id)
+            if u is None or u.date != today:
+                return
+            u.total_requests = max(u.total_requests - 1, 0)
+            u.tokens_used = max(u.tokens_used - tokens, 0)
+            if not is_paid_active(u, today) and u.num_request is not None:
+                u.num_request += 1
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE user_subscriptions
+                SET total_requests = GREATEST(total_requests - 1, 0),
+                    tokens_used = GREATEST(tokens_used - $3, 0),
+                    num_request = CASE
+                        WHEN num_request IS NULL THEN NULL
+                        WHEN subscribe = 1 AND end_payment_date IS NOT NULL AND end_payment_date >= $2 THEN num_request
+                        ELSE num_request + 1
+                    END
+                WHERE chat_id=$1 AND date = $2
+                """,
+                chat_id,
+                today,
+                tokens,
+            )
+
+    async def adjust_tokens(self, chat_id: int, delta: int) -> None:
+        """
+        Сверка оценки с реальным usage ответа: delta = факт - оценка (может быть отрицательной).
+        Только в пределах того же дня, ниже нуля не опускаем.
+        """
+        if not delta:
+            return
+        today = today_msk(self.tz)
+
+        if self._is_fake():
+            u = self.db.user_subscriptions.get(chat_id)
+            if u is None or u.date != today:
+                return
+            u.tokens_used = max(u.tokens_used + delta, 0)
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                "UPDATE user_subscriptions SET tokens_used = GREATEST(tokens_used + $3, 0) WHERE chat_id=$1 AND date = $2",
+                chat_id,
+                today,
+                int(delta),
+            )
+
+    async def log_interaction(
+        self,
+        chat_id: int,
+        user_input: str,
+        model_output: str,
+        *,
+        response_id: str | None = None,
+        chain_len: int = 0,
+    ) -> RequestLog:
+        """
+        Только запись в requests_log, без счётчиков (их уже списал reserve_request).
+        """
+        if self._is_fake():
+            row = RequestLog(
+                id=self.db.next_request_id(),
+                date=now_msk(self.tz),
+                chat_id=chat_id,
+                input=user_input,
+                output=model_output,
+                summary=None,
+                response_id=response_id,
+                chain_len=chain_len,
+            )
+            self.db.requests_log.append(row)
+            return row
+
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                INSERT INTO requests_log (date, chat_id, input, output, summary, response_id, chain_len)
+                VALUES ($1, $2, $3, $4, NULL, $5, $6)
+                RETURNING id, date, chat_id, input, output, summary, response_id, chain_len
+                """,
+                now_msk(self.tz),
+                chat_id,
+                user_input,
+                model_output,
+                response_id,
+                chain_len,
+            )
+            return _row_to_log(row)
+
+    async def log_interactions_bulk(self, rows: List[RequestLog]) -> None:
+        """
+        Пачка строк requests_log одним COPY (для RequestLogWriter).
+        Если COPY упал (например, пользователя успели удалить и FK не пускает) —
+        пишем multi-row INSERT только для тех chat_id, что ещё есть.
+        """
+        if not rows:
+            return
+
+        if self._is_fake():
+            for r in rows:
+                if r.chat_id not in self.db.user_subscriptions:
+                    continue
+                self.db.requests_log.append(
+                    RequestLog(
+                        id=self.db.next_request_id(),
+                        date=r.date,
+                        chat_id=r.chat_id,
+                        input=r.input,
+                        output=r.output,
+                        summary=None,
+                        response_id=r.response_id,
+                        chain_len=r.chain_len,
+                    )
+                )
+            return
+
+        records = [(r.date, r.chat_id, r.input, r.output, r.response_id, r.chain_len) for r in rows]
+        async with self.db.acquire() as conn:
+            try:
+                await conn.copy_records_to_table(
+                    "requests_log",
+                    records=records,
+                    columns=["date", "chat_id", "input", "output", "response_id", "chain_len"],
+                )
+            except Exception:
+                await conn.execute(
+                    """
+                    INSERT INTO requests_log (date, chat_id, input, output, summary, response_id, chain_len)
+                    SELECT r.date, r.chat_id, r.input, r.output, NULL, r.response_id, r.chain_len
+                    FROM unnest($1::timestamptz[], $2::bigint[], $3::text[], $4::text[], $5::text[], $6::int[])
+                         AS r(date, chat_id, input, output, response_id, chain_len)
+                    WHERE EXISTS (SELECT 1 FROM user_subscriptions us WHERE us.chat_id = r.chat_id)
+                    """,
+                    *[[rec[i] for rec in records] for i in range(6)],
+                )
+
     async def get_recent_user_inputs(self, chat_id: int, limit: int = 5) -> List[str]:
         if limit <= 0:
             return []
@@ -364,8 +716,102 @@ class Repository:
             )
             return [(r["input"], r["output"]) for r in reversed(rows)]
 
-    async def get_day_dialog_text(self, chat_id: int) -> str:
-        day = today_msk(self.tz)
+    async def get_dialog_turns(
+        self,
+        chat_id: int,
+        *,
+        after_id: int = 0,
+        upto_id: int | None = None,
+        limit: int = 20,
+        oldest: bool = False,
+    ) -> List[RequestLog]:
+        """
+        Реплики диалога с after_id < id <= upto_id в хронологическом порядке.
+        По умолчанию последние limit штук; oldest=True — первые limit (для свёртки в summary).
+        """
+        if limit <= 0:
+            return []
+        if self._is_fake():
+            items = [
+                r for r in self.db.requests_log
+                if r.chat_id == chat_id and r.id > after_id and (upto_id is None or r.id <= upto_id)
+            ]
+            items.sort(key=lambda r: r.id)
+            return items[:limit] if oldest else items[-limit:]
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                SELECT id, date, chat_id, input, output, summary, response_id, chain_len
+                FROM requests_log
+                WHERE chat_id=$1 AND id > $2 AND ($3::bigint IS NULL OR id <= $3)
+                ORDER BY id {"ASC" if oldest else "DESC"}
+                LIMIT $4
+                """,
+                chat_id,
+                after_id,
+                upto_id,
+                limit,
+            )
+            items = [_row_to_log(r) for r in rows]
+            return items if oldest else items[::-1]
+
+    async def get_dialog_summary(self, chat_id: int) -> DialogSummary | None:
+        if self._is_fake():
+            return self.db.dialog_summaries.get(chat_id)
+
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT chat_id, summary, upto_id, updated_at FROM dialog_summaries WHERE chat_id=$1",
+                chat_id,
+            )
+            if not row:
+                return None
+            return DialogSummary(
+                chat_id=int(row["chat_id"]),
+                summary=row["summary"],
+                upto_id=int(row["upto_id"]),
+                updated_at=row["updated_at"],
+            )
+
+    async def save_dialog_summary(self, chat_id: int, summary: str, upto_id: int, expected_upto_id: int) -> bool:
+        """
+        Сохраняет новый пересказ, только если его никто не сдвинул (upto_id == expected_upto_id)
+        и строка upto_id ещё существует — после clear_dialog_context старый пересказ не воскресает.
+        """
+        if self._is_fake():
+            cur = self.db.dialog_summaries.get(chat_id)
+            if (cur.upto_id if cur else 0) != expected_upto_id:
+                return False
+            if not any(r.id == upto_id and r.chat_id == chat_id for r in self.db.requests_log):
+                return False
+            self.db.dialog_summaries[chat_id] = DialogSummary(
+                chat_id=chat_id, summary=summary, upto_id=upto_id, updated_at=now_msk(self.tz)
+            )
+            return True
+
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                INSERT INTO dialog_summaries (chat_id, summary, upto_id, updated_at)
+                SELECT $1, $2, $3, NOW()
+                WHERE EXISTS (SELECT 1 FROM requests_log WHERE id=$3 AND chat_id=$1)
+                ON CONFLICT (chat_id) DO UPDATE
+                SET summary=EXCLUDED.summary,
+                    upto_id=EXCLUDED.upto_id,
+                    updated_at=EXCLUDED.updated_at
+                WHERE dialog_summaries.upto_id = $4
+                RETURNING chat_id
+                """,
+                chat_id,
+                summary,
+                upto_id,
+                expected_upto_id,
+            )
+            return row is not None
+
+    async def get_day_dialog_text(self, chat_id: int, day: date | None = None) -> str:
+        day = day or today_msk(self.tz)
         start, end = _day_bounds(self.tz, day)
 
         if self._is_fake():
@@ -389,8 +835,8 @@ class Repository:
             )
             return "\n\n".join([f"USER: {r['input']}\nBOT: {r['output']}" for r in rows])
 
-    async def save_daily_summary(self, chat_id: int, summary_text: str) -> None:
-        day = today_msk(self.tz)
+    async def save_daily_summary(self, chat_id: int, summary_text: str, day: date | None = None) -> None:
+        day = day or today_msk(self.tz)
         start, end = _day_bounds(self.tz, day)
 
         if self._is_fake():
@@ -429,7 +875,7 @@ class Repository:
         async with self.db.acquire() as conn:
             rows = await conn.fetch(
                 """
-                SELECT date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+                SELECT date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
                 FROM user_subscriptions
                 ORDER BY chat_id
                 """
@@ -444,6 +890,124 @@ class Repository:
             rows = await conn.fetch("SELECT chat_id FROM user_subscriptions")
             return [int(r["chat_id"]) for r in rows]
 
+    async def list_active_chat_ids(self, day: date) -> List[int]:
+        """chat_id, у которых за этот день есть строки в requests_log (для дневной выжимки)."""
+        start, end = _day_bounds(self.tz, day)
+
+        if self._is_fake():
+            return sorted({r.chat_id for r in self.db.requests_log if start <= r.date < end})
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT DISTINCT chat_id
+                FROM requests_log
+                WHERE date >= $1 AND date < $2
+                """,
+                start,
+                end,
+            )
+            return [int(r["chat_id"]) for r in rows]
+
+    async def summary_runs_plan(self, day: date, max_attempts: int = 3) -> List[int]:
+        """
+        Готовит прогон выжимки за day: заводит pending-строки для активных за день чатов
+        (уже существующие не трогаем) и возвращает chat_id, которые ещё не done.
+        Повторный вызов после падения процесса продолжает с того же места.
+        """
+        start, end = _day_bounds(self.tz, day)
+
+        if self._is_fake():
+            for chat_id in await self.list_active_chat_ids(day):
+                self.db.summary_runs.setdefault((day, chat_id), SummaryRun(day=day, chat_id=chat_id))
+            return sorted(
+                r.chat_id
+                for (d, _), r in self.db.summary_runs.items()
+                if d == day and r.status != "done" and r.attempts < max_attempts
+            )
+
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO summary_runs (day, chat_id)
+                SELECT DISTINCT $1::date, chat_id
+                FROM requests_log
+                WHERE date >= $2 AND date < $3
+                ON CONFLICT (day, chat_id) DO NOTHING
+                """,
+                day,
+                start,
+                end,
+            )
+            rows = await conn.fetch(
+                """
+                SELECT chat_id
+                FROM summary_runs
+                WHERE day=$1 AND status <> 'done' AND attempts < $2
+                ORDER BY chat_id
+                """,
+                day,
+                max_attempts,
+            )
+            return [int(r["chat_id"]) for r in rows]
+
+    async def summary_run_mark(
+        self,
+        day: date,
+        chat_id: int,
+        status: str,
+        *,
+        summary: str | None = None,
+        error: str | None = None,
+    ) -> None:
+        if self._is_fake():
+            r = self.db.summary_runs.setdefault((day, chat_id), SummaryRun(day=day, chat_id=chat_id))
+            r.status = status
+            r.attempts += 1
+            r.summary = summary if summary is not None else r.summary
+            r.error = error
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO summary_runs (day, chat_id, status, attempts, summary, error, updated_at)
+                VALUES ($1, $2, $3, 1, $4, $5, NOW())
+                ON CONFLICT (day, chat_id) DO UPDATE
+                SET status=EXCLUDED.status,
+                    attempts=summary_runs.attempts + 1,
+                    summary=COALESCE(EXCLUDED.summary, summary_runs.summary),
+                    error=EXCLUDED.error,
+                    updated_at=NOW()
+                """,
+                day,
+                chat_id,
+                status,
+                summary,
+                error,
+            )
+
+    async def summary_runs_unfinished_days(self, since: date, max_attempts: int = 3) -> List[date]:
+        """Дни начиная с since, где остались не done чаты (для догона после рестарта)."""
+        if self._is_fake():
+            return sorted({
+                d for (d, _), r in self.db.summary_runs.items()
+                if d >= since and r.status != "done" and r.attempts < max_attempts
+            })
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT DISTINCT day
+                FROM summary_runs
+                WHERE day >= $1 AND status <> 'done' AND attempts < $2
+                ORDER BY day
+                """,
+                since,
+                max_attempts,
+            )
+            return [r["day"] for r in rows]
+
     async def get_user_profile(self, chat_id: int) -> UserProfile | None:
         if self._is_fake():
             return self.db.users.get(chat_id)
@@ -459,16 +1023,7 @@ class Repository:
             )
             if not row:
                 return None
-            return UserProfile(
-                chat_id=row["chat_id"],
-                started_at=row["started_at"],
-                name=row["name"],
-                gender=row["gender"],
-                age=row["age"],
-                consented=row["consented"] or 0,
-                memory=row["memory"],
-                end_dialog=row["end_dialog"] or 0,
-            )
+            return _row_to_profile(row)
         
     async def log_payment_stars(self, chat_id: int, sp: Any) -> None:
         """
@@ -573,6 +1128,121 @@ class Repository:
                 limit,
             )
 
+    async def log_usage_bulk(self, rows: List[LLMUsage]) -> None:
+        """Пачка строк llm_usage одним COPY (для UsageWriter)."""
+        if not rows:
+            return
+        if self._is_fake():
+            self.db.llm_usage.extend(rows)
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.copy_records_to_table(
+                "llm_usage",
+                records=[
+                    (
+                        r.ts, r.chat_id, r.model, r.mode, r.input_tokens,
+                        r.cached_tokens, r.output_tokens, r.reasoning_tokens, r.latency_ms,
+                    )
+                    for r in rows
+                ],
+                columns=[
+                    "ts", "chat_id", "model", "mode", "input_tokens",
+                    "cached_tokens", "output_tokens", "reasoning_tokens", "latency_ms",
+                ],
+            )
+
+    async def usage_by_model(self, day: date) -> List[dict]:
+        """Итоги за день по (модель, режим): вызовы, токены, средняя задержка."""
+        start, end = _day_bounds(self.tz, day)
+        if self._is_fake():
+            agg: dict[tuple[str, str], dict] = {}
+            for u in self.db.llm_usage:
+                if not (start <= u.ts < end):
+                    continue
+                a = agg.setdefault((u.model, u.mode), {
+                    "model": u.model, "mode": u.mode, "calls": 0, "input_tokens": 0,
+                    "cached_tokens": 0, "output_tokens": 0, "latency_ms": 0,
+                })
+                a["calls"] += 1
+                a["input_tokens"] += u.input_tokens
+                a["cached_tokens"] += u.cached_tokens
+                a["output_tokens"] += u.output_tokens
+                a["latency_ms"] += u.latency_ms
+            out = []
+            for a in agg.values():
+                a["avg_latency_ms"] = a.pop("latency_ms") // a["calls"]
+                out.append(a)
+            return sorted(out, key=lambda a: (a["model"], a["mode"]))
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT model, mode,
+                       COUNT(*) AS calls,
+                       SUM(input_tokens) AS input_tokens,
+                       SUM(cached_tokens) AS cached_tokens,
+                       SUM(output_tokens) AS output_tokens,
+                       AVG(latency_ms)::int AS avg_latency_ms
+                FROM llm_usage
+                WHERE ts >= $1 AND ts < $2
+                GROUP BY model, mode
+                ORDER BY model, mode
+                """,
+                start,
+                end,
+            )
+            return [dict(r) for r in rows]
+
+    async def usage_top_chats(self, day: date, limit: int = 10) -> List[dict]:
+        """Чаты с наибольшим расходом токенов за день."""
+        start, end = _day_bounds(self.tz, day)
+        if self._is_fake():
+            agg: dict[int, dict] = {}
+            for u in self.db.llm_usage:
+                if u.chat_id is None or not (start <= u.ts < end):
+                    continue
+                us = self.db.user_subscriptions.get(u.chat_id)
+                a = agg.setdefault(u.chat_id, {
+                    "chat_id": u.chat_id,
+                    "username": (us.username if us else None) or "",
+                    "full_name": (us.full_name if us else None) or "",
+                    "calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0,
+                })
+                a["calls"] += 1
+                a["input_tokens"] += u.input_tokens
+                a["cached_tokens"] += u.cached_tokens
+                a["output_tokens"] += u.output_tokens
+            out = sorted(agg.values(), key=lambda a: a["input_tokens"] + a["output_tokens"], reverse=True)
+            return out[:limit]
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT u.chat_id,
+                       COALESCE(us.username, '') AS username,
+                       COALESCE(us.full_name, '') AS full_name,
+                       u.calls, u.input_tokens, u.cached_tokens, u.output_tokens
+                FROM (
+                    SELECT chat_id,
+                           COUNT(*) AS calls,
+                           SUM(input_tokens) AS input_tokens,
+                           SUM(cached_tokens) AS cached_tokens,
+                           SUM(output_tokens) AS output_tokens
+                    FROM llm_usage
+                    WHERE ts >= $1 AND ts < $2 AND chat_id IS NOT NULL
+                    GROUP BY chat_id
+                ) u
+                LEFT JOIN user_subscriptions us ON us.chat_id = u.chat_id
+                ORDER BY u.input_tokens + u.output_tokens DESC
+                LIMIT $3
+                """,
+                start,
+                end,
+                limit,
+            )
+            return [dict(r) for r in rows]
+
     async def yk_insert_payment(
         self,
         *,
@@ -655,6 +1325,51 @@ class Repository:
                 canceled_at,
             )
 
+    async def yk_succeed_and_activate(
+        self,
+        *,
+        external_payment_id: str,
+        chat_id: int,
+        raw: dict,
+        paid_at: datetime,
+    ) -> UserSubscription | None:
+        """
+        Переводит платёж в succeeded и активирует подписку одной транзакцией.
+        Возвращает подписку, если активировали сейчас; None — платёж уже был succeeded
+        (повторная проверка кнопкой или фоновой задачей не продлевает подписку второй раз).
+        """
+        if self._is_fake():
+            return await self.activate_paid_30d(chat_id)
+
+        today = today_msk(self.tz)
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                # FOR UPDATE: кнопка и фоновая проверка не активируют один платёж дважды
+                prev = await conn.fetchval(
+                    """
+                    SELECT status FROM payments
+                    WHERE provider='yookassa' AND external_payment_id=$1
+                    FOR UPDATE
+                    """,
+                    external_payment_id,
+                )
+                if prev == "succeeded":
+                    return None
+                await conn.execute(
+                    """
+                    UPDATE payments
+                    SET status='succeeded',
+                        raw=$2::jsonb,
+                        paid_at=$3,
+                        updated_at=NOW()
+                    WHERE provider='yookassa' AND external_payment_id=$1
+                    """,
+                    external_payment_id,
+                    json.dumps(raw, ensure_ascii=False),
+                    paid_at,
+                )
+                return await self._activate_paid_30d_pg(conn, chat_id, today)
+
     async def yk_get_payment(self, external_payment_id: str) -> dict | None:
         if self._is_fake():
             return None
@@ -701,6 +1416,353 @@ class Repository:
             )
             return dict(row) if row else None
 
+    # --- jobs (фоновая очередь) ---
+
+    def _row_to_job(self, row: Any) -> Job:
+        payload = row["payload"]
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        return Job(
+            id=row["id"],
+            kind=row["kind"],
+            payload=payload or {},
+            dedupe_key=row["dedupe_key"],
+            status=row["status"],
+            attempts=row["attempts"],
+            max_attempts=row["max_attempts"],
+            run_at=row["run_at"],
+            locked_until=row["locked_until"],
+            last_error=row["last_error"],
+        )
+
+    async def jobs_enqueue(
+        self,
+        kind: str,
+        payload: dict,
+        *,
+        dedupe_key: str | None = None,
+        run_in: float = 0.0,
+        max_attempts: int = 5,
+        merge_key: str | None = None,
+    ) -> int | None:
+        """
+        Ставит задачу в очередь. Если с тем же (kind, dedupe_key) уже есть queued-задача:
+        без merge_key — новая не создаётся; с merge_key — список payload[merge_key]
+        дописывается в существующую (так копятся реплики для памяти).
+        Returns: id задачи (или None, если задачу отбросили как дубль).
+        """
+        if self._is_fake():
+            now = now_msk(self.tz)
+            if dedupe_key is not None:
+                for j in self.db.jobs.values():
+                    if j.kind == kind and j.dedupe_key == dedupe_key and j.status == "queued":
+                        if merge_key is None:
+                            return None
+                        j.payload[merge_key] = list(j.payload.get(merge_key) or []) + list(payload.get(merge_key) or [])
+                        return j.id
+            job = Job(
+                id=self.db.next_job_id(),
+                kind=kind,
+                payload=dict(payload),
+                dedupe_key=dedupe_key,
+                max_attempts=max_attempts,
+                run_at=now + timedelta(seconds=run_in),
+            )
+            self.db.jobs[job.id] = job
+            return job.id
+
+        async with self.db.acquire() as conn:
+            return await conn.fetchval(
+                """
+                INSERT INTO jobs (kind, payload, dedupe_key, max_attempts, run_at)
+                VALUES ($1, $2::jsonb, $3, $4, NOW() + ($5::float8 * INTERVAL '1 second'))
+                ON CONFLICT (kind, dedupe_key) WHERE status = 'queued' AND dedupe_key IS NOT NULL
+                DO UPDATE SET
+                    payload = CASE
+                        WHEN $6::text IS NULL THEN jobs.payload
+                        ELSE jsonb_set(
+                            jobs.payload,
+                            ARRAY[$6::text],
+                            COALESCE(jobs.payload -> $6::text, '[]'::jsonb)
+                                || COALESCE(EXCLUDED.payload -> $6::text, '[]'::jsonb)
+                        )
+                    END,
+                    updated_at = NOW()
+                WHERE $6::text IS NOT NULL
+                RETURNING id
+                """,
+                kind,
+                json.dumps(payload, ensure_ascii=False),
+                dedupe_key,
+                max_attempts,
+                float(run_in),
+                merge_key,
+            )
+
+    async def jobs_claim(
+        self,
+        kind: str,
+        limit: int,
+        visibility_sec: int,
+        worker_id: str,
+        shard: tuple[int, int] | None = None,
+    ) -> List[Job]:
+        """
+        Забирает до limit готовых задач kind. Задача, которую взяли и не закрыли за visibility_sec
+        (воркер умер), снова становится доступна. Задачи с одинаковым dedupe_key
+        одновременно не выполняются. Несколько реплик делят очередь через SKIP LOCKED.
+        shard=(номер, всего): только задачи, чей dedupe_key (chat_id) относится к этому шарду.
+        """
+        if limit <= 0:
+            return []
+
+        if self._is_fake():
+            now = now_msk(self.tz)
+            busy = {
+                j.dedupe_key for j in self.db.jobs.values()
+                if j.kind == kind and j.status == "running" and j.dedupe_key is not None
+                and j.locked_until is not None and j.locked_until > now
+            }
+            ready = [
+                j for j in self.db.jobs.values()
+                if j.kind == kind
+                and (
+                    (j.status == "queued" and j.run_at <= now)
+                    or (j.status == "running" and j.locked_until is not None and j.locked_until <= now)
+                )
+                and (j.dedupe_key is None or j.dedupe_key not in busy)
+                and (shard is None or (j.dedupe_key is not None and int(j.dedupe_key) % shard[1] == shard[0]))
+            ]
+            ready.sort(key=lambda j: j.run_at)
+            claimed = []
+            for j in ready:
+                if len(claimed) >= limit:
+                    break
+                if j.dedupe_key is not None:
+                    if j.dedupe_key in busy:
+                        continue
+                    busy.add(j.dedupe_key)
+                j.status = "running"
+                j.attempts += 1
+                j.locked_until = now + timedelta(seconds=visibility_sec)
+                claimed.append(j)
+            return claimed
+
+        # условие по шарду добавляем только для шардированных видов: у прочих dedupe_key не число
+        shard_filter = ""
+        shard_args: list = []
+        if shard is not None:
+            shard_filter = "AND mod(mod(j.dedupe_key::bigint, $6::bigint) + $6::bigint, $6::bigint) = $5"
+            shard_args = [shard[0], shard[1]]
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                WITH c AS (
+                    SELECT id
+                    FROM jobs j
+                    WHERE j.kind = $1
+                      {shard_filter}
+                      AND (
+                          (j.status = 'queued' AND j.run_at <= NOW())
+                          OR (j.status = 'running' AND j.locked_until <= NOW())
+                      )
+                      AND (
+                          j.dedupe_key IS NULL
+                          OR NOT EXISTS (
+                              SELECT 1 FROM jobs r
+                              WHERE r.kind = j.kind
+                                AND r.dedupe_key = j.dedupe_key
+                                AND r.id <> j.id
+                                AND r.status = 'running'
+                                AND r.locked_until > NOW()
+                          )
+                      )
+                    ORDER BY j.run_at
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE jobs
+                SET status = 'running',
+                    attempts = jobs.attempts + 1,
+                    locked_until = NOW() + ($3::int * INTERVAL '1 second'),
+                    locked_by = $4,
+                    updated_at = NOW()
+                FROM c
+                WHERE jobs.id = c.id
+                RETURNING jobs.id, jobs.kind, jobs.payload, jobs.dedupe_key, jobs.status, jobs.attempts,
+                          jobs.max_attempts, jobs.run_at, jobs.locked_until, jobs.last_error
+                """,
+                kind,
+                limit,
+                visibility_sec,
+                worker_id,
+                *shard_args,
+            )
+            return [self._row_to_job(r) for r in rows]
+
+    async def jobs_complete(self, job_id: int) -> None:
+        # выполненные задачи не храним — таблица остаётся маленькой
+        if self._is_fake():
+            self.db.jobs.pop(job_id, None)
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.execute("DELETE FROM jobs WHERE id=$1", job_id)
+
+    async def jobs_fail(self, job_id: int, error: str, retry_in: float, merge_key: str | None = None) -> None:
+        """
+        Ошибка: снова queued через retry_in секунд, или failed, если попытки кончились.
+        Если пока задача выполнялась, с тем же (kind, dedupe_key) поставили новую queued-задачу,
+        вернуть эту в queued нельзя (uq_jobs_queued_dedupe): её payload[merge_key] дописывается
+        в начало новой (более ранние реплики — первыми), а сама задача удаляется.
+        """
+        if self._is_fake():
+            j = self.db.jobs.get(job_id)
+            if j is None:
+                return
+            j.last_error = error
+            j.locked_until = None
+            if j.attempts >= j.max_attempts:
+                j.status = "failed"
+                return
+            newer = next(
+                (
+                    o for o in self.db.jobs.values()
+                    if o.id != j.id and o.kind == j.kind and o.dedupe_key is not None
+                    and o.dedupe_key == j.dedupe_key and o.status == "queued"
+                ),
+                None,
+            )
+            if newer is not None:
+                if merge_key is not None:
+                    newer.payload[merge_key] = list(j.payload.get(merge_key) or []) + list(newer.payload.get(merge_key) or [])
+                del self.db.jobs[j.id]
+                return
+            j.status = "queued"
+            j.run_at = now_msk(self.tz) + timedelta(seconds=retry_in)
+            return
+
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                try:
+                    # savepoint: конфликт по uq_jobs_queued_dedupe не должен ронять всю транзакцию
+                    async with conn.transaction():
+                        await conn.execute(
+                            """
+                            UPDATE jobs
+                            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                                run_at = NOW() + ($3::float8 * INTERVAL '1 second'),
+                                locked_until = NULL,
+                                locked_by = NULL,
+                                last_error = $2,
+                                updated_at = NOW()
+                            WHERE id=$1
+                            """,
+                            job_id,
+                            error,
+                            float(retry_in),
+                        )
+                    return
+                except Exception as e:
+                    if getattr(e, "sqlstate", None) != "23505":  # unique_violation
+                        raise
+
+                # уже есть новая queued-задача с тем же ключом — сливаемся в неё
+                if merge_key is not None:
+                    await conn.execute(
+                        """
+                        UPDATE jobs AS q
+                        SET payload = jsonb_set(
+                                q.payload,
+                                ARRAY[$2::text],
+                                COALESCE(f.payload -> $2::text, '[]'::jsonb)
+                                    || COALESCE(q.payload -> $2::text, '[]'::jsonb)
+                            ),
+                            updated_at = NOW()
+                        FROM jobs AS f
+                        WHERE f.id = $1
+                          AND q.kind = f.kind
+                          AND q.dedupe_key = f.dedupe_key
+                          AND q.status = 'queued'
+                        """,
+                        job_id,
+                        merge_key,
+                    )
+                await conn.execute("DELETE FROM jobs WHERE id=$1", job_id)
+
+    async def jobs_cancel(self, kind: str, dedupe_key: str) -> None:
+        """Убирает ещё не начатую задачу (например, память после завершения диалога)."""
+        if self._is_fake():
+            for job_id in [
+                j.id for j in self.db.jobs.values()
+                if j.kind == kind and j.dedupe_key == dedupe_key and j.status == "queued"
+            ]:
+                self.db.jobs.pop(job_id, None)
+            return
+
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM jobs WHERE kind=$1 AND dedupe_key=$2 AND status='queued'",
+                kind,
+                dedupe_key,
+            )
+
+    async def jobs_stats(self) -> List[dict]:
+        if self._is_fake():
+            counts: dict[tuple[str, str], int] = {}
+            for j in self.db.jobs.values():
+                counts[(j.kind, j.status)] = counts.get((j.kind, j.status), 0) + 1
+            return [{"kind": k, "status": st, "n": n} for (k, st), n in sorted(counts.items())]
+
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status ORDER BY kind, status"
+            )
+            return [dict(r) for r in rows]
+
+    # --- FSM (aiogram) ---
+
+    async def fsm_load(self, key: str) -> tuple[str | None, str] | None:
+        """Состояние и данные FSM (data — JSON-текст) или None, если записи нет."""
+        if self._is_fake():
+            return self.db.fsm_states.get(key)
+
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow("SELECT state, data::text AS data FROM fsm_state WHERE key=$1", key)
+            return (row["state"], row["data"]) if row else None
+
+    async def fsm_save_many(self, rows: List[tuple[str, str | None, str]]) -> None:
+        """Пачка записей FSM (key, state, data json) одним запросом; пустые записи удаляются."""
+        if not rows:
+            return
+        keep = [r for r in rows if r[1] is not None or r[2] != "{}"]
+        drop = [r[0] for r in rows if r[1] is None and r[2] == "{}"]
+        if self._is_fake():
+            for key, state, data in keep:
+                self.db.fsm_states[key] = (state, data)
+            for key in drop:
+                self.db.fsm_states.pop(key, None)
+            return
+
+        async with self.db.acquire() as conn:
+            async with conn.transaction():
+                if keep:
+                    await conn.execute(
+                        """
+                        INSERT INTO fsm_state (key, state, data, updated_at)
+                        SELECT k, s, d::jsonb, NOW()
+                        FROM unnest($1::text[], $2::text[], $3::text[]) AS t(k, s, d)
+                        ON CONFLICT (key) DO UPDATE
+                        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW()
+                        """,
+                        [r[0] for r in keep],
+                        [r[1] for r in keep],
+                        [r[2] for r in keep],
+                    )
+                if drop:
+                    await conn.execute("DELETE FROM fsm_state WHERE key = ANY($1::text[])", drop)
+
     # --- admin methods ---
 
     async def admin_extend_paid_30d(self, chat_id: int) -> UserSubscription:
@@ -728,7 +1790,7 @@ class Repository:
                         end_payment_date=NULL,
                         num_request=$2
                     WHERE chat_id=$1
-                    RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name
+                    RETURNING date, chat_id, num_request, subscribe, total_requests, payment_date, end_payment_date, ban_until, username, full_name, tokens_used
                     """,
                     chat_id,
                     self.free_limit,
@@ -857,9 +1919,45 @@ class Repository:
                 memory,
             )
 
+    async def update_user_memory_if(self, chat_id: int, memory: str, expected: str | None) -> bool:
+        """
+        Запись памяти после фонового пересчёта: только если диалог не завершён и память
+        не менялась с момента чтения (expected). Иначе пока модель думала, диалог завершили
+        или очистили — старые реплики не должны вернуть сброшенную память.
+        """
+        memory = (memory or "").strip()
+        expected = (expected or "").strip()
+        if self._is_fake():
+            u = self.db.users.get(chat_id)
+            if u is None or u.end_dialog == 1 or (u.memory or "").strip() != expected:
+                return False
+            u.memory = memory
+            return True
+
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                UPDATE users
+                SET memory=$2
+                WHERE chat_id=$1
+                  AND COALESCE(end_dialog, 0) = 0
+                  AND BTRIM(COALESCE(memory, '')) = $3
+                RETURNING chat_id
+                """,
+                chat_id,
+                memory,
+                expected,
+            )
+            return row is not None
+
     async def set_end_dialog(self, chat_id: int, value: int) -> None:
+        """end_dialog=1 заодно обрывает цепочку previous_response_id: новый диалог начнётся с чистого контекста."""
         val = 1 if value else 0
         if self._is_fake():
+            if val:
+                for r in self.db.requests_log:
+                    if r.chat_id == chat_id:
+                        r.response_id = None
             existing = self.db.users.get(chat_id)
             if existing:
                 existing.end_dialog = val
@@ -885,14 +1983,22 @@ class Repository:
                 now_msk(self.tz),
                 val,
             )
+            if val:
+                await conn.execute(
+                    "UPDATE requests_log SET response_id=NULL WHERE chat_id=$1 AND response_id IS NOT NULL",
+                    chat_id,
+                )
 
     async def clear_dialog_context(self, chat_id: int) -> None:
         if self._is_fake():
             self.db.requests_log = [r for r in self.db.requests_log if r.chat_id != chat_id]
+            self.db.dialog_summaries.pop(chat_id, None)
             return
 
         async with self.db.acquire() as conn:
-            await conn.execute("DELETE FROM requests_log WHERE chat_id=$1", chat_id)
+            async with conn.transaction():
+                await conn.execute("DELETE FROM requests_log WHERE chat_id=$1", chat_id)
+                await conn.execute("DELETE FROM dialog_summaries WHERE chat_id=$1", chat_id)
 
     async def admin_delete_user(self, chat_id: int) -> None:
         """
@@ -901,6 +2007,7 @@ class Repository:
         if self._is_fake():
             self.db.user_subscriptions.pop(chat_id, None)
             self.db.requests_log = [r for r in self.db.requests_log if r.chat_id != chat_id]
+            self.db.dialog_summaries.pop(chat_id, None)
             return
 
         async with self.db.acquire() as conn:
@@ -9,7 +9,10 @@ CREATE TABLE IF NOT EXISTS user_subscriptions (
   total_requests INTEGER NOT NULL DEFAULT 0,
   payment_date DATE,
   end_payment_date DATE,
-  ban_until DATE
+  ban_until DATE,
+  username TEXT,
+  full_name TEXT,
+  tokens_used INTEGER NOT NULL DEFAULT 0
 );
 
 -- table #3
@@ -31,7 +34,78 @@ CREATE TABLE IF NOT EXISTS requests_log (
   chat_id BIGINT NOT NULL REFERENCES user_subscriptions(chat_id),
   input TEXT NOT NULL,
   output TEXT NOT NULL,
-  summary TEXT
+  summary TEXT,
+  response_id TEXT,
+  chain_len INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE INDEX IF NOT EXISTS idx_requests_log_chat_day ON requests_log(chat_id, date);
+CREATE INDEX IF NOT EXISTS idx_requests_log_chat_id ON requests_log(chat_id, id);
+
+-- скользящий пересказ старой части диалога (контекст для модели): строки requests_log с id <= upto_id уже в summary
+CREATE TABLE IF NOT EXISTS dialog_summaries (
+  chat_id BIGINT PRIMARY KEY REFERENCES user_subscriptions(chat_id) ON DELETE CASCADE,
+  summary TEXT NOT NULL DEFAULT '',
+  upto_id BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- прогресс дневных выжимок: по строке на (день, чат), чтобы прерванный прогон продолжался
+CREATE TABLE IF NOT EXISTS summary_runs (
+  day DATE NOT NULL,
+  chat_id BIGINT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  summary TEXT,
+  error TEXT,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (day, chat_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_summary_runs_status ON summary_runs(status, day);
+
+-- фоновые задачи (память, выжимки, проверка платежей); забираются через FOR UPDATE SKIP LOCKED
+CREATE TABLE IF NOT EXISTS jobs (
+  id BIGSERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,
+  payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+  dedupe_key TEXT,
+  status TEXT NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  max_attempts INTEGER NOT NULL DEFAULT 5,
+  run_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  locked_until TIMESTAMPTZ,
+  locked_by TEXT,
+  last_error TEXT,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_jobs_queued_dedupe ON jobs(kind, dedupe_key)
+  WHERE status = 'queued' AND dedupe_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(kind, run_at) WHERE status IN ('queued', 'running');
+
+-- учёт вызовов моделей: по строке на вызов, пишется пачками (UsageWriter)
+CREATE TABLE IF NOT EXISTS llm_usage (
+  id BIGSERIAL PRIMARY KEY,
+  ts TIMESTAMPTZ NOT NULL,
+  chat_id BIGINT,
+  model TEXT NOT NULL,
+  mode TEXT NOT NULL,
+  input_tokens INTEGER NOT NULL DEFAULT 0,
+  cached_tokens INTEGER NOT NULL DEFAULT 0,
+  output_tokens INTEGER NOT NULL DEFAULT 0,
+  reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+  latency_ms INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_usage_ts ON llm_usage(ts);
+CREATE INDEX IF NOT EXISTS idx_llm_usage_chat_ts ON llm_usage(chat_id, ts);
+
+-- состояния FSM aiogram (PgStorage): переживают рестарт; писатель чата — один процесс (или его шард)
+CREATE TABLE IF NOT EXISTS fsm_state (
+  key TEXT PRIMARY KEY,
+  state TEXT,
+  data JSONB NOT NULL DEFAULT '{}'::jsonb,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
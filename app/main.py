@@ -1,74 +1,350 @@
 import asyncio
 import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable
 from aiogram import Bot, Dispatcher
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from openai import AsyncOpenAI
 
 from app.config import settings
 from app.db.connection import get_db
 from app.db.repository import Repository
-from app.bot.handlers import router as user_router
+from app.bot.handlers import make_chat_reply_handler, router as user_router
 from app.bot.admin_handlers import router as admin_router
-from app.services.openai_client import OpenAIClient
-from app.services.summary import build_summary
+from app.bot.fsm_storage import PgStorage
+from app.bot.send_scheduler import SendScheduler
+from app.bot.sharding import ChatControl, run_sharded
+from app.bot.typing import TypingTicker
+from app.bot.webhook import run_webhook
+from app.services.openai_client import AsyncOpenAIClient
+from app.services.generation import profiles_from_settings
+from app.services.llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_FREE, PRIORITY_PAID, LLMScheduler
+from app.services.log_writer import RequestLogWriter, UsageWriter
+from app.services.memory import MEMORY_JOB, MemoryCoalescer
+from app.services.context import ContextBuilder
+from app.services.router import MessageRouter
+from app.services.burst import BurstCoalescer
+from app.services.inflight import InflightRegistry
+from app.services.overload import CHAT_REPLY_JOB, OverloadController
+from app.services.daily_summary import (
+    DAILY_SUMMARY_JOB,
+    enqueue_daily_summary,
+    make_daily_summary_handler,
+    resume_daily_summaries,
+)
+from app.services.jobs import JobKind, JobWorker
+from app.services.payments import PAYMENT_CHECK_JOB, PAYMENT_CHECK_MAX_ATTEMPTS, make_payment_check_handler
+from app.utils.time import today_msk
 
 
-async def main():
-    # если кто-то вебхуком начнет поллинг ронять - раскоментить
-    # bot = Bot(token=settings.bot_token)
-    # await bot.delete_webhook(drop_pending_updates=True)
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    )
+LOG_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
 
-    bot = Bot(token=settings.bot_token)
-    dp = Dispatcher()
 
-    # Подключаем роутеры (админ первым)
-    dp.include_router(admin_router)
-    dp.include_router(user_router)
+@dataclass
+class Runtime:
+    bot: Bot
+    dp: Dispatcher
+    # запуск фоновых задач (очередь задач, cron) и их остановка с дописыванием буферов
+    start: Callable[[], None]
+    close: Callable[[], Awaitable[None]]
+    # отмена генераций/логов чата в процессе-владельце (админ-удаление)
+    chat_control: ChatControl
 
+
+async def build_runtime(*, shard: int = 0, shards: int = 1, inboxes: list | None = None) -> Runtime:
+    """
+    Собирает бота, диспетчер с хендлерами и все сервисы процесса (пул БД, клиент модели, очереди).
+    В шардированном режиме (BOT_SHARDS > 1) так собирается каждый воркер: общие лимиты
+    (Telegram, параллельность модели) делятся между воркерами, cron-задачи — только в шарде 0.
+    """
+    if shards > 1 and settings.use_fake_db:
+        raise RuntimeError("BOT_SHARDS > 1 requires Postgres (USE_FAKE_DB=0): workers do not share memory")
+
+    bot = Bot(token=settings.bot_token)
+    # все исходящие сообщения — через лимиты Telegram (глобальный + на чат) и повторы на flood-wait
+    send_scheduler = SendScheduler(
+        global_rate=settings.tg_global_rate / shards,
+        chat_rate=settings.tg_chat_rate,
+        chat_burst=settings.tg_chat_burst,
+        max_retries=settings.tg_max_retries,
+    )
+    bot.session.middleware(send_scheduler)
+    # "печатает..." для всех чатов с идущей генерацией — одна задача на процесс
+    typing_ticker = TypingTicker(bot, interval=settings.typing_interval)
+    typing_ticker.start()
     db = await get_db(use_fake=settings.use_fake_db, dsn=settings.pg_dsn)
     repo = Repository(
         db=db,
         tz=settings.tz,
         free_limit=settings.free_limit,
         daily_hard_limit=settings.daily_hard_limit,
+        free_token_budget=settings.free_token_budget,
+        paid_token_budget=settings.paid_token_budget,
+    )
+
+    # состояния FSM в БД: переживают деплой, не нужен повторный подъём состояния из профиля
+    fsm_storage = PgStorage(
+        repo,
+        flush_interval=settings.fsm_flush_interval,
+        cache_size=settings.fsm_cache_size,
     )
+    dp = Dispatcher(storage=fsm_storage)
 
-    llm = OpenAIClient(
+    # Подключаем роутеры (админ первым)
+    dp.include_router(admin_router)
+    dp.include_router(user_router)
+
+    log_writer = RequestLogWriter(
+        repo,
+        max_batch=settings.log_batch_size,
+        flush_interval=settings.log_flush_interval,
+    )
+    log_writer.start()
+    # учёт токенов/задержек по каждому вызову модели (llm_usage), тоже пачками
+    usage_writer = UsageWriter(repo)
+    usage_writer.start()
+
+    # один AsyncOpenAI на процесс = один пул HTTP-соединений на обе модели
+    openai_client = AsyncOpenAI(
         api_key=settings.openai_api_key,
+        max_retries=settings.openai_max_retries,
+    )
+    llm_scheduler = LLMScheduler(
+        limits={
+            settings.openai_model: max(1, settings.openai_max_concurrency // shards),
+            settings.openai_memory_model: max(1, settings.openai_memory_max_concurrency // shards),
+        },
+        weights={
+            PRIORITY_PAID: settings.llm_weight_paid,
+            PRIORITY_FREE: settings.llm_weight_free,
+            PRIORITY_BACKGROUND: settings.llm_weight_background,
+        },
+        max_wait=settings.llm_max_queue_wait,
+    )
+    generation_profiles = profiles_from_settings(settings)
+    llm = AsyncOpenAIClient(
+        openai_client,
         model=settings.openai_model,                 # gpt-5
+        scheduler=llm_scheduler,
+        profiles=generation_profiles,
+        usage=usage_writer,
     )
-    memory_llm = OpenAIClient(
-        api_key=settings.openai_api_key,
+    memory_llm = AsyncOpenAIClient(
+        openai_client,
         model=settings.openai_memory_model,          # gpt-5-mini
+        scheduler=llm_scheduler,
+        profiles=generation_profiles,
+        usage=usage_writer,
     )
 
+    # история диалога для модели: окно по бюджету токенов + пересказ старой части (mini-моделью)
+    context_builder = ContextBuilder(
+        repo,
+        memory_llm,
+        budget_tokens=settings.context_budget_tokens,
+        max_turns=settings.context_max_turns,
+        fold_min_turns=settings.context_fold_min_turns,
+        chain_max_turns=settings.context_chain_max_turns,
+        log_writer=log_writer,
+    )
+
+    llm_router = None
+    if settings.router_enabled:
+        llm_router = MessageRouter(
+            mini_threshold=settings.router_mini_threshold,
+            mini_max_chars=settings.router_mini_max_chars,
+            log_sample=settings.router_log_sample,
+        )
+
+    # идущие генерации по чатам: завершение/сброс диалога их отменяет
+    inflight = InflightRegistry()
+
+    def cancel_chat_local(chat_id: int, reason: str) -> None:
+        inflight.cancel(chat_id, reason)
+        log_writer.forget(chat_id)
+
+    # админ действует над чужим чатом — при шардинге команда уходит шарду этого чата
+    chat_control = ChatControl(cancel_chat_local, shard=shard, shards=shards, inboxes=inboxes)
+
+    overload = None
+    if settings.overload_enabled:
+        overload = OverloadController(
+            llm_scheduler,
+            slo_seconds=settings.overload_slo_sec,
+            defer_seconds=settings.overload_defer_sec,
+            notify_cooldown=settings.overload_notify_cooldown,
+        )
+
+    burst_coalescer = None
+    if settings.burst_enabled:
+        burst_coalescer = BurstCoalescer(window=settings.burst_window, max_parts=settings.burst_max_parts)
+
+    # долговечная очередь фоновых задач: память, дневные выжимки, сверка платежей
+    job_kinds: dict[str, JobKind] = {}
+    job_worker = JobWorker(repo, job_kinds, poll_interval=settings.jobs_poll_interval, shard=shard, shards=shards)
+
+    memory_coalescer = MemoryCoalescer(
+        repo,
+        memory_llm,
+        max_turns=settings.memory_update_turns,
+        idle_seconds=settings.memory_update_idle_sec,
+        jobs=job_worker,
+    )
+
+    job_kinds[MEMORY_JOB] = JobKind(
+        memory_coalescer.run_job,
+        concurrency=settings.jobs_memory_concurrency,
+        visibility_sec=120,
+        merge_key="turns",
+    )
+    job_kinds[DAILY_SUMMARY_JOB] = JobKind(
+        make_daily_summary_handler(repo, llm, concurrency=settings.summary_concurrency),
+        concurrency=1,
+        visibility_sec=3600,
+    )
+    job_kinds[CHAT_REPLY_JOB] = JobKind(
+        make_chat_reply_handler(
+            repo,
+            llm,
+            memory_llm,
+            bot,
+            context_builder=context_builder,
+            log_writer=log_writer,
+            memory_coalescer=memory_coalescer,
+            typing_ticker=typing_ticker,
+            inflight=inflight,
+        ),
+        concurrency=settings.jobs_chat_concurrency,
+        visibility_sec=300,
+        max_attempts=3,
+        merge_key="texts",
+        sharded=True,
+    )
+    job_kinds[PAYMENT_CHECK_JOB] = JobKind(
+        make_payment_check_handler(repo, settings, bot),
+        concurrency=settings.jobs_payment_concurrency,
+        visibility_sec=60,
+        max_attempts=PAYMENT_CHECK_MAX_ATTEMPTS,
+    )
 
     @dp.update.outer_middleware()
     async def inject(handler, event, data):
         data["repo"] = repo
         data["llm"] = llm
         data["memory_llm"] = memory_llm
+        data["llm_scheduler"] = llm_scheduler
+        data["log_writer"] = log_writer
+        data["memory_coalescer"] = memory_coalescer
+        data["context_builder"] = context_builder
+        data["llm_router"] = llm_router
+        data["burst_coalescer"] = burst_coalescer
+        data["inflight"] = inflight
+        data["chat_control"] = chat_control
+        data["overload"] = overload
+        data["typing_ticker"] = typing_ticker
+        data["job_worker"] = job_worker
         data["settings"] = settings
         return await handler(event, data)
 
     scheduler = AsyncIOScheduler(timezone=settings.tz)
 
     async def daily_job():
-        chat_ids = await repo.list_chat_ids()
-        for chat_id in chat_ids:
-            dialog = await repo.get_day_dialog_text(chat_id)
-            summary = build_summary(llm, dialog)
-            await repo.save_daily_summary(chat_id, summary)
-            # daily summary only; memory is updated per-message
+        # джоба стартует в 00:00 — выжимка за только что закончившийся день
+        # daily summary only; memory is updated per-message
+        # сама выжимка выполняется воркером очереди (переживает рестарт, делится между репликами)
+        day = today_msk(settings.tz) - timedelta(days=1)
+        await enqueue_daily_summary(job_worker, day)
+
+    async def llm_stats_job():
+        # очередь к моделям: сколько ждут, сколько в работе, время ожидания слота
+        logging.getLogger("llm").info("llm queue stats: %s", llm_scheduler.stats())
+        logging.getLogger("memory").info("memory coalescer stats: %s", memory_coalescer.stats())
+        logging.getLogger("context").info("context builder stats: %s", context_builder.stats())
+        if llm_router is not None:
+            logging.getLogger("router").info("router stats: %s", llm_router.stats())
+        logging.getLogger("telegram_send").info(
+            "telegram send queue: %s | typing: %s", send_scheduler.stats(), typing_ticker.stats()
+        )
+        logging.getLogger("fsm").info("fsm storage stats: %s", fsm_storage.stats())
+        logging.getLogger("inflight").info("in-flight generations: %s", inflight.stats())
+        if overload is not None:
+            logging.getLogger("overload").info("overload decisions: %s", overload.stats())
+        if burst_coalescer is not None:
+            logging.getLogger("burst").info("burst coalescer stats: %s", burst_coalescer.stats())
+        logging.getLogger("jobs").info("job worker stats: %s | queue: %s", job_worker.stats(), await repo.jobs_stats())
+
+    async def resume_summaries():
+        # процесс мог упасть посреди ночного прогона — дожимаем незавершённое
+        try:
+            await resume_daily_summaries(
+                repo,
+                job_worker,
+                today_msk(settings.tz),
+                lookback_days=settings.summary_resume_days,
+            )
+        except Exception:
+            logging.getLogger("daily_summary").exception("Failed to resume daily summaries")
+
+    # ночная выжимка ставится в очередь один раз, а не каждым воркером
+    if shard == 0:
+        scheduler.add_job(daily_job, CronTrigger(hour=0, minute=0))
+    scheduler.add_job(llm_stats_job, IntervalTrigger(minutes=5))
+    background: list[asyncio.Task] = []
+
+    def start() -> None:
+        scheduler.start()
+        job_worker.start()
+        if shard == 0:
+            background.append(asyncio.create_task(resume_summaries()))
+
+    async def close() -> None:
+        for task in background:
+            task.cancel()
+        scheduler.shutdown(wait=False)
+        # сначала сбрасываем накопленные реплики в очередь, потом гасим воркеры
+        await typing_ticker.stop()
+        # polling/webhook закрывают хранилище сами при shutdown диспетчера; воркеры шардов — здесь
+        await fsm_storage.close()
+        await memory_coalescer.stop()
+        await context_builder.stop()
+        await job_worker.stop()
+        # дописываем очередь requests_log до закрытия пула
+        await log_writer.stop()
+        await usage_writer.stop()
+        logging.getLogger("llm").info("llm queue stats on shutdown: %s", llm_scheduler.stats())
+        await openai_client.close()
+        await bot.session.close()
+
+    return Runtime(bot=bot, dp=dp, start=start, close=close, chat_control=chat_control)
+
+
+async def run_updates(bot: Bot, dp: Dispatcher) -> None:
+    """Приём апдейтов до остановки процесса: webhook или long polling (BOT_MODE)."""
+    if settings.bot_mode == "webhook":
+        await run_webhook(bot, dp, settings)
+    else:
+        # вебхук, оставшийся от webhook-режима, не даст getUpdates работать
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
-    scheduler.add_job(daily_job, CronTrigger(hour=0, minute=0))
-    scheduler.start()
+    if settings.bot_shards > 1:
+        # фронт принимает апдейты и раздаёт их по воркерам (chat_id -> шард)
+        await run_sharded(settings)
+        return
 
-    await dp.start_polling(bot)
+    runtime = await build_runtime()
+    runtime.start()
+    try:
+        await run_updates(runtime.bot, runtime.dp)
+    finally:
+        await runtime.close()
 
 
 if __name__ == "__main__":
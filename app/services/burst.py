@@ -0,0 +1,118 @@
+# склейка "пачки" коротких сообщений одного чата в один запрос к модели
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("burst")
+
+
+@dataclass
+class Burst:
+    chat_id: int
+    # (message_id, text): порядок восстанавливаем по message_id, а не по порядку хендлеров
+    parts: list[tuple[int, str]]
+    # задача генерации: её отменяем, если пачку перебила новая
+    task: asyncio.Task | None = None
+    superseded: bool = False
+    delivering: bool = False
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(t for _, t in sorted(self.parts))
+
+    def attach(self, task: asyncio.Task) -> None:
+        self.task = task
+        if self.superseded:
+            task.cancel()
+
+    def start_delivery(self) -> bool:
+        """Ответ начинает уходить пользователю: с этого момента пачку уже не перебить."""
+        if self.superseded:
+            return False
+        self.delivering = True
+        return True
+
+
+class BurstCoalescer:
+    """
+    Сообщения чата, пришедшие в пределах window секунд друг от друга или пока генерация
+    ответа на предыдущие ещё не начала доставляться, склеиваются в один запрос:
+    хендлер каждого сообщения ждёт window, и дальше идёт только последний — с текстом всей пачки.
+    Идущая генерация при этом отменяется (superseded), её сообщения уходят в новую пачку,
+    а вызывающий возвращает списанный запрос. Пока ответ доставляется, следующая пачка
+    ждёт его окончания — ответы не перемешиваются.
+    """
+
+    def __init__(self, *, window: float = 1.5, max_parts: int = 10):
+        self.window = window
+        # больше max_parts не копим: пачка уходит сразу
+        self.max_parts = max(1, max_parts)
+        self._pending: dict[int, list[tuple[int, str]]] = {}
+        # номер последнего сообщения чата; счётчик общий, чтобы номера не повторялись после finish()
+        self._seq: dict[int, int] = {}
+        self._counter = itertools.count(1)
+        self._inflight: dict[int, Burst] = {}
+        self.bursts = 0
+        self.merged = 0
+        self.superseded = 0
+
+    async def collect(self, chat_id: int, message_id: int, text: str) -> Burst | None:
+        """
+        Returns: пачку для ответа или None — сообщение заберёт хендлер более позднего сообщения.
+        После ответа (или отказа) пачку надо закрыть через finish().
+        """
+        pending = self._pending.setdefault(chat_id, [])
+        pending.append((message_id, text))
+        seq = self._seq[chat_id] = next(self._counter)
+
+        current = self._inflight.get(chat_id)
+        if current is not None and not current.delivering and not current.superseded:
+            # ответ ещё не начал уходить — отменяем и отвечаем на всё сразу
+            current.superseded = True
+            if current.task is not None:
+                current.task.cancel()
+            pending[:0] = current.parts
+            self.superseded += 1
+
+        if len(pending) < self.max_parts:
+            await asyncio.sleep(self.window)
+        if self._seq.get(chat_id) != seq:
+            return None
+
+        # предыдущий ответ ещё доставляется — ждём, чтобы не перемешать сообщения
+        while (current := self._inflight.get(chat_id)) is not None:
+            await current.done.wait()
+            if self._seq.get(chat_id) != seq:
+                return None
+
+        parts = self._pending.pop(chat_id, [])
+        if not parts:
+            return None
+        burst = Burst(chat_id=chat_id, parts=parts)
+        self._inflight[chat_id] = burst
+        self.bursts += 1
+        self.merged += len(parts) - 1
+        if len(parts) > 1:
+            logger.info("chat_id=%s | merged %s messages into one prompt", chat_id, len(parts))
+        return burst
+
+    def finish(self, burst: Burst) -> None:
+        if self._inflight.get(burst.chat_id) is burst:
+            del self._inflight[burst.chat_id]
+        burst.done.set()
+        if burst.chat_id not in self._pending and burst.chat_id not in self._inflight:
+            self._seq.pop(burst.chat_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "bursts": self.bursts,
+            "merged": self.merged,
+            "superseded": self.superseded,
+            "inflight": len(self._inflight),
+            "pending": sum(len(p) for p in self._pending.values()),
+        }
@@ -0,0 +1,178 @@
+# контекст диалога для модели: последние реплики в пределах бюджета токенов + пересказ более старых
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any
+
+from app.db.models import RequestLog
+from app.services.summary import build_context_summary_async
+from app.services.tokens import estimate_message_tokens
+
+logger = logging.getLogger("context")
+
+
+@dataclass
+class ContextWindow:
+    # input для Responses API: строка (нет истории) или список сообщений
+    input: str | list[dict[str, Any]]
+    turns: int
+    tokens: int
+    summary_used: bool = False
+    # продолжение серверной цепочки: история уже у провайдера, шлём только новое сообщение
+    previous_response_id: str | None = None
+    # номер этой реплики в цепочке (пишется в requests_log.chain_len)
+    chain_len: int = 1
+
+
+class ContextBuilder:
+    """
+    Собирает input для модели: пересказ старой части диалога (dialog_summaries),
+    затем последние реплики из requests_log — от новых к старым, пока влезают в budget_tokens,
+    затем текущее сообщение. Реплики, не влезшие в окно, в фоне сворачиваются в пересказ
+    (инкрементально: старый пересказ + новые реплики), так что размер input ограничен
+    независимо от длины сессии, а пересказ не пересчитывается с нуля.
+
+    Если у последней реплики есть response_id и цепочка короче chain_max_turns,
+    диалог продолжается через previous_response_id: input — только новое сообщение.
+    Цепочка начинается заново (с локально собранным контекстом) по лимиту,
+    после clear_dialog_context / set_end_dialog и если провайдер её уже не знает.
+    """
+
+    def __init__(
+        self,
+        repo,
+        summary_llm,
+        *,
+        budget_tokens: int = 1500,
+        max_turns: int = 20,
+        fold_min_turns: int = 4,
+        fold_batch: int = 40,
+        chain_max_turns: int = 0,
+        log_writer=None,
+    ):
+        self.repo = repo
+        self.summary_llm = summary_llm
+        self.budget_tokens = budget_tokens
+        self.max_turns = max_turns
+        self.fold_min_turns = max(1, fold_min_turns)
+        self.fold_batch = fold_batch
+        # 0 — не использовать previous_response_id
+        self.chain_max_turns = chain_max_turns
+        # RequestLogWriter: реплики, которые ещё не долетели до БД, тоже часть диалога
+        self.log_writer = log_writer
+        self._folding: dict[int, asyncio.Task] = {}
+        self.built = 0
+        self.chained = 0
+        self.folds = 0
+        self.tokens_total = 0
+
+    async def build(self, chat_id: int, user_text: str, *, use_chain: bool = True) -> ContextWindow:
+        # снимок очереди writer'а до чтения БД: строка, успевшая записаться, найдётся в БД
+        pending = self.log_writer.pending(chat_id) if self.log_writer is not None else []
+        state = await self.repo.get_dialog_summary(chat_id)
+        upto_id = state.upto_id if state else 0
+        summary = (state.summary if state else "").strip()
+        rows = await self.repo.get_dialog_turns(chat_id, after_id=upto_id, limit=self.max_turns)
+
+        stored = {(r.input, r.output) for r in rows}
+        turns: list[RequestLog] = list(rows)
+        turns += [r for r in pending if (r.input, r.output) not in stored]
+
+        used = estimate_message_tokens(user_text)
+        if summary:
+            used += estimate_message_tokens(summary)
+        picked: list[RequestLog] = []
+        for turn in reversed(turns):
+            cost = estimate_message_tokens(turn.input) + estimate_message_tokens(turn.output)
+            if used + cost > self.budget_tokens:
+                break
+            picked.append(turn)
+            used += cost
+        picked.reverse()
+
+        # реплики из БД, не попавшие в окно (окно набирается с конца, pending — самые новые);
+        # если выборка упёрлась в max_turns, до неё есть ещё не свёрнутые реплики
+        picked_db = max(len(picked) - (len(turns) - len(rows)), 0)
+        outside = rows[: len(rows) - picked_db]
+        truncated = len(rows) >= self.max_turns
+        if outside and (truncated or len(outside) >= self.fold_min_turns):
+            self._schedule_fold(chat_id, upto_id, summary, outside[-1].id)
+        elif truncated:
+            self._schedule_fold(chat_id, upto_id, summary, rows[0].id - 1)
+
+        self.built += 1
+        head = turns[-1] if turns else None
+        if (
+            use_chain
+            and self.chain_max_turns > 0
+            and head is not None
+            and head.response_id
+            and 0 < head.chain_len < self.chain_max_turns
+        ):
+            self.chained += 1
+            tokens = estimate_message_tokens(user_text)
+            self.tokens_total += tokens
+            return ContextWindow(
+                input=user_text,
+                turns=0,
+                tokens=tokens,
+                previous_response_id=head.response_id,
+                chain_len=head.chain_len + 1,
+            )
+
+        self.tokens_total += used
+        if not picked and not summary:
+            return ContextWindow(input=user_text, turns=0, tokens=used)
+
+        items: list[dict[str, Any]] = []
+        if summary:
+            items.append({"role": "developer", "content": f"Краткий пересказ начала разговора:\n{summary}"})
+        for turn in picked:
+            items.append({"role": "user", "content": turn.input})
+            items.append({"role": "assistant", "content": turn.output})
+        items.append({"role": "user", "content": user_text})
+        return ContextWindow(input=items, turns=len(picked), tokens=used, summary_used=bool(summary))
+
+    def _schedule_fold(self, chat_id: int, upto_id: int, summary: str, cutoff_id: int) -> None:
+        if chat_id in self._folding or cutoff_id <= upto_id:
+            return
+        task = asyncio.create_task(self._fold(chat_id, upto_id, summary, cutoff_id))
+        self._folding[chat_id] = task
+        task.add_done_callback(lambda _t, c=chat_id: self._folding.pop(c, None))
+
+    async def _fold(self, chat_id: int, upto_id: int, summary: str, cutoff_id: int) -> None:
+        try:
+            rows = await self.repo.get_dialog_turns(
+                chat_id, after_id=upto_id, upto_id=cutoff_id, limit=self.fold_batch, oldest=True
+            )
+            if not rows:
+                return
+            dialog_text = "\n\n".join(f"USER: {r.input}\nBOT: {r.output}" for r in rows)
+            updated = await build_context_summary_async(self.summary_llm, dialog_text, summary, chat_id=chat_id)
+            if not updated:
+                return
+            # не перезаписываем, если пересказ успели сдвинуть или диалог очистили
+            if await self.repo.save_dialog_summary(chat_id, updated, rows[-1].id, upto_id):
+                self.folds += 1
+        except Exception:
+            logger.exception("Failed to fold dialog context", extra={"chat_id": chat_id})
+
+    async def stop(self) -> None:
+        # недоделанные свёртки не страшны: следующий build() запустит их снова
+        tasks = list(self._folding.values())
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "built": self.built,
+            "chained": self.chained,
+            "avg_tokens": round(self.tokens_total / self.built, 1) if self.built else 0.0,
+            "folds": self.folds,
+            "folding": len(self._folding),
+        }
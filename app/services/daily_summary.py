@@ -0,0 +1,161 @@
+# дневная выжимка: только активные за день чаты, параллельно с ограничением,
+# с прогрессом в summary_runs (прерванный прогон продолжается, готовые чаты пропускаются)
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+from app.services.jobs import JobRetry
+from app.services.summary import build_summary_async
+
+logger = logging.getLogger("daily_summary")
+
+
+@dataclass
+class DailyRunStats:
+    day: date
+    chats: int = 0
+    done: int = 0
+    failed: int = 0
+    failed_chat_ids: list[int] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        # выжимок в минуту
+        return (self.done / self.elapsed * 60) if self.elapsed > 0 else 0.0
+
+
+async def run_daily_summaries(repo, llm, day: date, concurrency: int = 4) -> DailyRunStats:
+    """
+    Выжимка за day для всех чатов с сообщениями в этот день.
+    LLM-вызовы асинхронные и идут не более concurrency за раз, поллинг бота не блокируется.
+    Чаты, уже отмеченные done в summary_runs, повторно не считаются.
+    """
+    stats = DailyRunStats(day=day)
+    t0 = time.monotonic()
+
+    chat_ids = await repo.summary_runs_plan(day)
+    stats.chats = len(chat_ids)
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(chat_id: int) -> None:
+        async with sem:
+            try:
+                dialog = await repo.get_day_dialog_text(chat_id, day=day)
+                summary = await build_summary_async(llm, dialog, chat_id=chat_id)
+                await repo.save_daily_summary(chat_id, summary, day=day)
+                await repo.summary_run_mark(day, chat_id, "done", summary=summary)
+                stats.done += 1
+            except Exception as e:
+                stats.failed += 1
+                stats.failed_chat_ids.append(chat_id)
+                logger.exception("Daily summary failed", extra={"chat_id": chat_id})
+                try:
+                    await repo.summary_run_mark(day, chat_id, "failed", error=repr(e)[:500])
+                except Exception:
+                    logger.exception("Failed to mark summary run", extra={"chat_id": chat_id})
+
+    await asyncio.gather(*(one(chat_id) for chat_id in chat_ids))
+
+    stats.elapsed = time.monotonic() - t0
+    logger.info(
+        "daily summary day=%s | chats=%s | done=%s | failed=%s | elapsed=%.1fs | %.1f/min",
+        day,
+        stats.chats,
+        stats.done,
+        stats.failed,
+        stats.elapsed,
+        stats.throughput,
+    )
+    if stats.failed_chat_ids:
+        logger.warning("daily summary day=%s failed chat_ids=%s", day, stats.failed_chat_ids)
+    return stats
+
+
+DAILY_SUMMARY_JOB = "daily_summary"
+
+
+def make_daily_summary_handler(repo, llm, concurrency: int = 4):
+    """Обработчик задачи daily_summary {"day": "YYYY-MM-DD"}."""
+
+    async def handle(payload: dict) -> None:
+        stats = await run_daily_summaries(repo, llm, date.fromisoformat(payload["day"]), concurrency=concurrency)
+        if stats.failed:
+            # упавшие чаты добьём позже (лимит попыток — в summary_runs)
+            raise JobRetry(600, reason=f"{stats.failed} chats failed")
+
+    return handle
+
+
+async def enqueue_daily_summary(jobs, day: date) -> None:
+    await jobs.enqueue(DAILY_SUMMARY_JOB, {"day": day.isoformat()}, dedupe_key=day.isoformat())
+
+
+async def resume_daily_summaries(repo, jobs, today: date, lookback_days: int = 2) -> list[date]:
+    """
+    Догон после рестарта: ставит в очередь вчерашний день (если полночный прогон не успел/не стартовал)
+    и все дни за lookback_days, где в summary_runs остались незавершённые чаты.
+    Дубли между репликами отсекает dedupe_key задачи.
+    """
+    yesterday = today - timedelta(days=1)
+    days = set(await repo.summary_runs_unfinished_days(today - timedelta(days=lookback_days)))
+    days.add(yesterday)
+    days = sorted(d for d in days if d < today)
+    for day in days:
+        await enqueue_daily_summary(jobs, day)
+    return days
+
+
+async def backfill_daily_summaries(repo, llm, start: date, end: date, concurrency: int = 4) -> list[DailyRunStats]:
+    """Ручной backfill за диапазон [start, end] включительно; готовые чаты пропускаются."""
+    out = []
+    day = start
+    while day <= end:
+        out.append(await run_daily_summaries(repo, llm, day, concurrency=concurrency))
+        day += timedelta(days=1)
+    return out
+
+
+async def _backfill_cli(start: date, end: date) -> None:
+    from openai import AsyncOpenAI
+
+    from app.config import settings
+    from app.db.connection import get_db
+    from app.db.repository import Repository
+    from app.services.generation import profiles_from_settings
+    from app.services.openai_client import AsyncOpenAIClient
+
+    db = await get_db(use_fake=settings.use_fake_db, dsn=settings.pg_dsn)
+    repo = Repository(
+        db=db,
+        tz=settings.tz,
+        free_limit=settings.free_limit,
+        daily_hard_limit=settings.daily_hard_limit,
+        free_token_budget=settings.free_token_budget,
+        paid_token_budget=settings.paid_token_budget,
+    )
+    client = AsyncOpenAI(api_key=settings.openai_api_key, max_retries=settings.openai_max_retries)
+    llm = AsyncOpenAIClient(client, model=settings.openai_model, profiles=profiles_from_settings(settings))
+    try:
+        await backfill_daily_summaries(repo, llm, start, end, concurrency=settings.summary_concurrency)
+    finally:
+        await client.close()
+        if hasattr(db, "close"):
+            await db.close()
+
+
+if __name__ == "__main__":
+    # python -m app.services.daily_summary 2026-10-01 [2026-10-05]
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    parser = argparse.ArgumentParser(description="Backfill daily summaries for a date range")
+    parser.add_argument("start", type=date.fromisoformat)
+    parser.add_argument("end", type=date.fromisoformat, nargs="?")
+    args = parser.parse_args()
+    asyncio.run(_backfill_cli(args.start, args.end or args.start))
@@ -0,0 +1,65 @@
+# профили генерации: reasoning effort / max_output_tokens / verbosity для каждого вида запроса
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+
+PROFILE_CHAT_FREE = "chat_free"
+PROFILE_CHAT_PAID = "chat_paid"
+PROFILE_MEMORY = "memory"
+PROFILE_SUMMARY = "summary"
+
+# профиль по умолчанию для режима промпта (если вызывающий не указал свой)
+MODE_PROFILES = {
+    "chat": PROFILE_CHAT_FREE,
+    "memory": PROFILE_MEMORY,
+    "summary": PROFILE_SUMMARY,
+    "context": PROFILE_SUMMARY,
+}
+
+# reasoning и text.verbosity понимают только reasoning-модели; остальным их не шлём
+_REASONING_MODEL_PREFIXES = ("gpt-5", "o1", "o3", "o4")
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    reasoning_effort: str | None = None  # minimal | low | medium | high
+    max_output_tokens: int | None = None  # вместе с reasoning-токенами
+    verbosity: str | None = None  # low | medium | high
+
+    def params(self, model: str) -> dict[str, Any]:
+        out: dict[str, Any] = {}
+        if self.max_output_tokens:
+            out["max_output_tokens"] = self.max_output_tokens
+        if model.startswith(_REASONING_MODEL_PREFIXES):
+            if self.reasoning_effort:
+                out["reasoning"] = {"effort": self.reasoning_effort}
+            if self.verbosity:
+                out["text"] = {"verbosity": self.verbosity}
+        return out
+
+
+def profiles_from_settings(settings) -> dict[str, GenerationProfile]:
+    return {
+        PROFILE_CHAT_FREE: GenerationProfile(
+            reasoning_effort=settings.gen_chat_free_effort or None,
+            max_output_tokens=settings.gen_chat_free_max_tokens or None,
+            verbosity=settings.gen_chat_free_verbosity or None,
+        ),
+        PROFILE_CHAT_PAID: GenerationProfile(
+            reasoning_effort=settings.gen_chat_paid_effort or None,
+            max_output_tokens=settings.gen_chat_paid_max_tokens or None,
+            verbosity=settings.gen_chat_paid_verbosity or None,
+        ),
+        PROFILE_MEMORY: GenerationProfile(
+            reasoning_effort=settings.gen_memory_effort or None,
+            max_output_tokens=settings.gen_memory_max_tokens or None,
+            verbosity=settings.gen_memory_verbosity or None,
+        ),
+        PROFILE_SUMMARY: GenerationProfile(
+            reasoning_effort=settings.gen_summary_effort or None,
+            max_output_tokens=settings.gen_summary_max_tokens or None,
+            verbosity=settings.gen_summary_verbosity or None,
+        ),
+    }
@@ -0,0 +1,85 @@
+# генерации ответа, которые сейчас идут по чатам: завершение/сброс диалога их отменяет
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("inflight")
+
+
+@dataclass
+class _ChatState:
+    epoch: int = 0
+    # генерации: их отменяет cancel()
+    tasks: set[asyncio.Task] = field(default_factory=set)
+    # задачи, которые запомнили эпоху (хендлеры) или генерируют: пока они живы, эпоху храним
+    holders: set[asyncio.Task] = field(default_factory=set)
+
+
+class InflightRegistry:
+    """
+    Задачи генерации по chat_id. cancel() отменяет их (стрим к модели закрывается вместе с задачей)
+    и сдвигает эпоху чата: хендлер, начавший работу в старой эпохе, не доставляет
+    и не сохраняет ответ, даже если генерация успела закончиться, а списанный запрос возвращает.
+    Состояние чата живёт, пока жива хоть одна задача, взявшая его эпоху или генерирующая ответ:
+    сравнивать эпоху после этого уже некому, и запись удаляется.
+    """
+
+    def __init__(self):
+        self._chats: dict[int, _ChatState] = {}
+        self.cancelled = 0
+
+    def epoch(self, chat_id: int) -> int:
+        task = asyncio.current_task()
+        if task is None:
+            state = self._chats.get(chat_id)
+            return state.epoch if state is not None else 0
+        state = self._chats.setdefault(chat_id, _ChatState())
+        self._hold(chat_id, state, task)
+        return state.epoch
+
+    def is_current(self, chat_id: int, epoch: int) -> bool:
+        state = self._chats.get(chat_id)
+        return (state.epoch if state is not None else 0) == epoch
+
+    def track(self, chat_id: int, task: asyncio.Task) -> None:
+        state = self._chats.setdefault(chat_id, _ChatState())
+        state.tasks.add(task)
+        self._hold(chat_id, state, task)
+
+    def _hold(self, chat_id: int, state: _ChatState, task: asyncio.Task) -> None:
+        if task not in state.holders:
+            state.holders.add(task)
+            task.add_done_callback(lambda t, c=chat_id: self._discard(c, t))
+
+    def _discard(self, chat_id: int, task: asyncio.Task) -> None:
+        state = self._chats.get(chat_id)
+        if state is None:
+            return
+        state.tasks.discard(task)
+        state.holders.discard(task)
+        if not state.holders:
+            del self._chats[chat_id]
+
+    def cancel(self, chat_id: int, reason: str = "") -> int:
+        state = self._chats.get(chat_id)
+        if state is None:
+            # эпоху чата никто не держит — отменять и сравнивать нечего
+            return 0
+        state.epoch += 1
+        tasks = [t for t in state.tasks if not t.done()]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            self.cancelled += len(tasks)
+            logger.info("chat_id=%s | cancelled %s in-flight generation(s) | reason=%s", chat_id, len(tasks), reason)
+        return len(tasks)
+
+    def stats(self) -> dict:
+        return {
+            "inflight": sum(len(s.tasks) for s in self._chats.values()),
+            "chats": len(self._chats),
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,176 @@
+# долговечная очередь фоновых задач поверх БД (таблица jobs) + пул воркеров
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from app.db.models import Job
+
+logger = logging.getLogger("jobs")
+
+JobHandler = Callable[[dict], Awaitable[Any]]
+
+
+class JobRetry(Exception):
+    """Не ошибка, а "попробуй позже" (например, платёж ещё pending)."""
+
+    def __init__(self, delay: float, reason: str = "retry"):
+        super().__init__(reason)
+        self.delay = delay
+
+
+@dataclass
+class JobKind:
+    handler: JobHandler
+    concurrency: int = 1
+    # сколько задача может выполняться, прежде чем её заберёт другой воркер
+    visibility_sec: int = 300
+    max_attempts: int = 5
+    # список payload, который enqueue дописывает в queued-дубль (turns, texts): при повторе после
+    # ошибки задача сливается в новую queued-задачу того же dedupe_key, а не теряет payload
+    merge_key: str | None = None
+    # dedupe_key — chat_id: при BOT_SHARDS > 1 задачу берёт только воркер шарда этого чата
+    # (там его in-flight генерации, typing и порядок сообщений)
+    sharded: bool = False
+
+
+class JobWorker:
+    """
+    Для каждого вида задач свой цикл: забирает готовые задачи (не больше свободных слотов),
+    выполняет, при ошибке ставит повтор с экспоненциальной задержкой.
+    Несколько процессов/реплик безопасно крутят воркеры над одной таблицей.
+    """
+
+    def __init__(
+        self,
+        repo,
+        kinds: dict[str, JobKind],
+        *,
+        poll_interval: float = 1.0,
+        backoff_base: float = 5.0,
+        backoff_max: float = 600.0,
+        shard: int = 0,
+        shards: int = 1,
+    ):
+        self.repo = repo
+        self.shard = shard
+        self.shards = shards
+        self.kinds = kinds
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._loops: list[asyncio.Task] = []
+        self._running: set[asyncio.Task] = set()
+        # kinds можно дополнять до start() (обработчикам бывает нужен сам воркер)
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._in_flight: dict[str, int] = {}
+        self.done = 0
+        self.failed = 0
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: dict,
+        *,
+        dedupe_key: str | None = None,
+        run_in: float = 0.0,
+        merge_key: str | None = None,
+    ) -> int | None:
+        spec = self.kinds.get(kind)
+        job_id = await self.repo.jobs_enqueue(
+            kind,
+            payload,
+            dedupe_key=dedupe_key,
+            run_in=run_in,
+            max_attempts=spec.max_attempts if spec else 5,
+            merge_key=merge_key,
+        )
+        if run_in <= 0 and kind in self._wakeups:
+            # своя задача — не ждём следующего опроса
+            self._wakeups[kind].set()
+        return job_id
+
+    def start(self) -> None:
+        for kind, spec in self.kinds.items():
+            self._wakeups[kind] = asyncio.Event()
+            self._in_flight[kind] = 0
+            self._loops.append(asyncio.create_task(self._loop(kind, spec), name=f"jobs-{kind}"))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        for t in self._loops:
+            t.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        self._loops.clear()
+        # даём уже начатым задачам доделаться; не успевшие заберёт другой воркер после visibility
+        if self._running:
+            await asyncio.wait(list(self._running), timeout=timeout)
+
+    async def _loop(self, kind: str, spec: JobKind) -> None:
+        wakeup = self._wakeups[kind]
+        while True:
+            free = max(spec.concurrency, 1) - self._in_flight[kind]
+            jobs: list[Job] = []
+            if free > 0:
+                try:
+                    jobs = await self.repo.jobs_claim(
+                        kind,
+                        free,
+                        spec.visibility_sec,
+                        self.worker_id,
+                        shard=(self.shard, self.shards) if spec.sharded and self.shards > 1 else None,
+                    )
+                except Exception:
+                    logger.exception("Failed to claim jobs", extra={"kind": kind})
+
+            for job in jobs:
+                self._in_flight[kind] += 1
+                task = asyncio.create_task(self._run_one(job, spec))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            if jobs and len(jobs) == free:
+                # забрали сколько могли — возможно, готово ещё; ждём освобождения слота
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_one(self, job: Job, spec: JobKind) -> None:
+        try:
+            await asyncio.wait_for(spec.handler(job.payload), timeout=spec.visibility_sec)
+        except JobRetry as e:
+            await self._safe_fail(job, str(e), e.delay)
+        except Exception as e:
+            self.failed += 1
+            delay = min(self.backoff_base * (2 ** max(job.attempts - 1, 0)), self.backoff_max)
+            logger.exception("Job failed: kind=%s id=%s attempt=%s", job.kind, job.id, job.attempts)
+            await self._safe_fail(job, repr(e)[:500], delay)
+        else:
+            self.done += 1
+            try:
+                await self.repo.jobs_complete(job.id)
+            except Exception:
+                logger.exception("Failed to complete job id=%s", job.id)
+        finally:
+            self._in_flight[job.kind] -= 1
+            self._wakeups[job.kind].set()
+
+    async def _safe_fail(self, job: Job, error: str, delay: float) -> None:
+        try:
+            spec = self.kinds.get(job.kind)
+            await self.repo.jobs_fail(job.id, error, delay, merge_key=spec.merge_key if spec else None)
+        except Exception:
+            logger.exception("Failed to mark job failed id=%s", job.id)
+
+    def stats(self) -> dict:
+        return {"done": self.done, "failed": self.failed, "running": len(self._running)}
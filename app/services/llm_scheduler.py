@@ -0,0 +1,236 @@
+# ограничение параллельных запросов к LLM (по моделям) + очередь с приоритетами + метрика ожидания
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+# классы приоритета: платные чаты, бесплатные чаты, фон (память, пересказы, выжимки)
+PRIORITY_PAID = "paid"
+PRIORITY_FREE = "free"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = (PRIORITY_PAID, PRIORITY_FREE, PRIORITY_BACKGROUND)
+
+# доли слотов под нагрузкой: из 7 освободившихся слотов 4 — paid, 2 — free, 1 — фон
+DEFAULT_WEIGHTS = {PRIORITY_PAID: 4, PRIORITY_FREE: 2, PRIORITY_BACKGROUND: 1}
+
+# время вызова модели, пока нет своих замеров (для оценки ожидания в очереди)
+DEFAULT_SERVICE_TIME = 15.0
+
+
+@dataclass
+class QueueStats:
+    waiting: int = 0
+    in_flight: int = 0
+    acquired: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    recent_waits: deque = field(default_factory=lambda: deque(maxlen=200))
+    # сколько слот был занят (длительность вызова модели)
+    recent_service: deque = field(default_factory=lambda: deque(maxlen=200))
+
+    def observe_wait(self, seconds: float) -> None:
+        self.acquired += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.recent_waits.append(seconds)
+
+    def service_time(self) -> float:
+        if not self.recent_service:
+            return DEFAULT_SERVICE_TIME
+        recent = sorted(self.recent_service)
+        return recent[len(recent) // 2]
+
+    def snapshot(self) -> dict:
+        recent = sorted(self.recent_waits)
+        p95 = recent[int(len(recent) * 0.95) - 1] if recent else 0.0
+        return {
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "acquired": self.acquired,
+            "wait_avg": (self.wait_total / self.acquired) if self.acquired else 0.0,
+            "wait_max": self.wait_max,
+            "wait_p95_recent": p95,
+            "service_median": self.service_time() if self.recent_service else 0.0,
+        }
+
+
+class FairQueue:
+    """
+    Слоты одной модели: limit одновременных запросов, ожидающие — по классам приоритета.
+    Освободившийся слот получает класс с наименьшим "проходом" (stride scheduling):
+    каждый выданный слот сдвигает проход класса на 1/weight, поэтому под нагрузкой слоты
+    делятся в пропорции весов, а простаивающий класс не копит кредит.
+    Защита от голодания: класс, чья голова ждёт на max_wait дольше головы класса,
+    выбранного по проходу, идёт вне очереди. Сравнение относительное: при перегрузке
+    все ждут дольше max_wait, и абсолютный порог превратил бы очередь в FIFO без приоритетов.
+    """
+
+    def __init__(self, limit: int, weights: dict[str, float], max_wait: float):
+        self.limit = max(1, limit)
+        self.weights = weights
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._queues: dict[str, deque] = {p: deque() for p in weights}
+        self._pass: dict[str, float] = {p: 0.0 for p in weights}
+        self._vtime = 0.0
+        self.aged = 0
+
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def position(self, priority: str) -> tuple[int, float]:
+        """
+        Место нового запроса класса priority в его очереди и доля пропускной способности,
+        которая ему достанется (вес класса среди классов с ожидающими).
+        (0, 1.0) — слот свободен сразу.
+        """
+        if self.in_flight < self.limit and not self.waiting():
+            return 0, 1.0
+        active = {p for p, q in self._queues.items() if q} | {priority}
+        share = self.weights[priority] / sum(self.weights[p] for p in active)
+        return len(self._queues[priority]) + 1, share
+
+    async def acquire(self, priority: str) -> None:
+        if self.in_flight < self.limit and not self.waiting():
+            self.in_flight += 1
+            return
+        q = self._queues[priority]
+        if not q:
+            # класс вернулся после простоя — без накопленного кредита
+            self._pass[priority] = max(self._pass[priority], self._vtime)
+        fut = asyncio.get_running_loop().create_future()
+        q.append((fut, time.monotonic()))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже выдали, а ожидающего отменили — отдаём следующему
+                self.release()
+            else:
+                _remove_future(q, fut)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.limit:
+            priority = self._pick()
+            if priority is None:
+                return
+            fut, _ = self._queues[priority].popleft()
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def _pick(self) -> str | None:
+        active = [p for p, q in self._queues.items() if q]
+        if not active:
+            return None
+        priority = min(active, key=lambda p: self._pass[p])
+        self._vtime = self._pass[priority]
+        oldest = min(active, key=lambda p: self._queues[p][0][1])
+        if self._queues[priority][0][1] - self._queues[oldest][0][1] >= self.max_wait:
+            self.aged += 1
+            priority = oldest
+        # внеочередной слот тоже оплачивается проходом — иначе класс получит больше своей доли
+        self._pass[priority] += 1.0 / self.weights[priority]
+        return priority
+
+
+def _remove_future(q: deque, fut: asyncio.Future) -> None:
+    for item in q:
+        if item[0] is fut:
+            q.remove(item)
+            return
+
+
+class LLMScheduler:
+    """
+    Один на процесс. Для каждой модели свой лимит одновременных запросов
+    (gpt-5 и gpt-5-mini не мешают друг другу), внутри модели — очередь по классам
+    приоритета (FairQueue): платные чаты обслуживаются первыми, бесплатные и фон не голодают.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, int],
+        default_limit: int = 8,
+        weights: dict[str, float] | None = None,
+        max_wait: float = 10.0,
+    ):
+        self._limits = dict(limits)
+        self._default_limit = default_limit
+        self._weights = {p: max(float(w), 0.01) for p, w in (weights or DEFAULT_WEIGHTS).items()}
+        self._max_wait = max_wait
+        self._queues: dict[str, FairQueue] = {}
+        self._stats: dict[str, QueueStats] = {}
+        self._class_stats: dict[str, dict[str, QueueStats]] = {}
+
+    def _queue(self, model: str) -> FairQueue:
+        fq = self._queues.get(model)
+        if fq is None:
+            fq = FairQueue(self._limits.get(model, self._default_limit), self._weights, self._max_wait)
+            self._queues[model] = fq
+            self._stats[model] = QueueStats()
+            self._class_stats[model] = {p: QueueStats() for p in self._weights}
+        return fq
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str, priority: str = PRIORITY_BACKGROUND):
+        fq = self._queue(model)
+        if priority not in self._weights:
+            priority = PRIORITY_BACKGROUND
+        st = self._stats[model]
+        cst = self._class_stats[model][priority]
+        st.waiting += 1
+        cst.waiting += 1
+        t0 = time.monotonic()
+        try:
+            await fq.acquire(priority)
+        finally:
+            st.waiting -= 1
+            cst.waiting -= 1
+        wait = time.monotonic() - t0
+        st.observe_wait(wait)
+        cst.observe_wait(wait)
+        st.in_flight += 1
+        cst.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            st.recent_service.append(time.monotonic() - started)
+            st.in_flight -= 1
+            cst.in_flight -= 1
+            fq.release()
+
+    def estimate_wait(self, model: str, priority: str = PRIORITY_BACKGROUND) -> tuple[int, float]:
+        """
+        Оценка для запроса, который встанет в очередь сейчас: (место в очереди своего класса,
+        ожидание в секундах). Слоты класса освобождаются со скоростью limit * доля / медиана
+        времени вызова по последним запросам к модели.
+        """
+        fq = self._queue(model)
+        if priority not in self._weights:
+            priority = PRIORITY_BACKGROUND
+        pos, share = fq.position(priority)
+        if pos == 0:
+            return 0, 0.0
+        per_slot = self._stats[model].service_time()
+        return pos, pos * per_slot / (fq.limit * share)
+
+    def stats(self) -> dict[str, dict]:
+        out = {}
+        for model, st in self._stats.items():
+            snap = st.snapshot()
+            snap["aged"] = self._queues[model].aged
+            snap["classes"] = {p: cst.snapshot() for p, cst in self._class_stats[model].items()}
+            out[model] = snap
+        return out
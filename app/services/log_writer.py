@@ -0,0 +1,209 @@
+# write-behind запись в БД: хендлер кладёт строку в очередь, фоновая задача пишет пачками
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List
+
+from app.db.models import LLMUsage, RequestLog
+from app.utils.time import now_msk
+
+logger = logging.getLogger("log_writer")
+
+# метка остановки в очереди: _run дописывает набранную пачку и выходит
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Копит элементы и сбрасывает их flush_fn пачкой: как только набралось max_batch
+    или прошло flush_interval секунд с первого элемента пачки. stop() дописывает всё.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[Any]], Awaitable[None]],
+        *,
+        max_batch: int = 200,
+        flush_interval: float = 1.0,
+        name: str = "batch",
+    ):
+        self._flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.name = name
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self.flushed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"{self.name}-writer")
+
+    def put(self, item: Any) -> None:
+        self._queue.put_nowait(item)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # не cancel: пачка, уже вынутая из очереди, и идущий COPY должны дописаться
+            self._queue.put_nowait(_STOP)
+            try:
+                await self._task
+            except Exception:
+                logger.exception("%s writer: worker failed", self.name)
+            self._task = None
+        # дописываем хвост (если задача не запускалась или упала)
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.max_batch:
+                await self._flush(batch)
+                batch = []
+        if batch:
+            await self._flush(batch)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Any]) -> None:
+        batch = self._filter(batch)
+        if not batch:
+            return
+        try:
+            await self._flush_fn(batch)
+            self.flushed += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("%s writer: failed to flush %s rows", self.name, len(batch))
+
+    def _filter(self, batch: List[Any]) -> List[Any]:
+        return batch
+
+
+class RequestLogWriter(BatchWriter):
+    """
+    Write-behind для requests_log. Счётчики лимитов тут не трогаем — они уже
+    списаны reserve_request до генерации, так что отложенная запись их не сбивает.
+    """
+
+    def __init__(self, repo, *, max_batch: int = 200, flush_interval: float = 1.0):
+        super().__init__(repo.log_interactions_bulk, max_batch=max_batch, flush_interval=flush_interval, name="requests_log")
+        self.tz = repo.tz
+        # chat_id, для которых контекст сбросили, пока строки ещё были в очереди
+        self._forgotten: dict[int, int] = {}
+        self._seq = 0
+        # строки, ещё не записанные в БД (для контекста диалога: ответ мог не долететь до flush)
+        self._pending: dict[int, list[RequestLog]] = {}
+
+    def enqueue(
+        self,
+        chat_id: int,
+        user_input: str,
+        model_output: str,
+        *,
+        response_id: str | None = None,
+        chain_len: int = 0,
+    ) -> None:
+        self._seq += 1
+        row = RequestLog(
+            id=self._seq,  # локальный порядковый номер, в БД id выдаст BIGSERIAL
+            date=now_msk(self.tz),
+            chat_id=chat_id,
+            input=user_input,
+            output=model_output,
+            response_id=response_id,
+            chain_len=chain_len,
+        )
+        self._pending.setdefault(chat_id, []).append(row)
+        self.put(row)
+
+    def pending(self, chat_id: int) -> List[RequestLog]:
+        return list(self._pending.get(chat_id, ()))
+
+    def forget(self, chat_id: int) -> None:
+        # clear_dialog_context / удаление пользователя: всё, что уже в очереди, не пишем
+        self._forgotten[chat_id] = self._seq
+        self._pending.pop(chat_id, None)
+
+    def break_chain(self, chat_id: int) -> None:
+        # set_end_dialog: ещё не записанные реплики тоже не должны продолжать цепочку previous_response_id
+        for r in self._pending.get(chat_id, ()):
+            r.response_id = None
+
+    async def _flush(self, batch: List[RequestLog]) -> None:
+        try:
+            await super()._flush(batch)
+        finally:
+            for r in batch:
+                rows = self._pending.get(r.chat_id)
+                if rows is None:
+                    continue
+                rows[:] = [x for x in rows if x is not r]
+                if not rows:
+                    del self._pending[r.chat_id]
+
+    def _filter(self, batch: List[RequestLog]) -> List[RequestLog]:
+        if not self._forgotten:
+            return batch
+        kept = [r for r in batch if r.id > self._forgotten.get(r.chat_id, 0)]
+        if self._queue.empty():
+            self._forgotten.clear()
+        return kept
+
+
+class UsageWriter(BatchWriter):
+    """
+    Учёт вызовов моделей (llm_usage): клиент OpenAI зовёт record() после каждого ответа,
+    строки уходят в БД пачками — на горячем пути только put в очередь.
+    """
+
+    def __init__(self, repo, *, max_batch: int = 500, flush_interval: float = 5.0):
+        super().__init__(repo.log_usage_bulk, max_batch=max_batch, flush_interval=flush_interval, name="llm_usage")
+        self.tz = repo.tz
+
+    def record(self, *, chat_id: int | None, model: str, mode: str, usage: Any, latency: float) -> None:
+        in_details = getattr(usage, "input_tokens_details", None)
+        out_details = getattr(usage, "output_tokens_details", None)
+        self.put(
+            LLMUsage(
+                ts=now_msk(self.tz),
+                chat_id=chat_id,
+                model=model,
+                mode=mode,
+                input_tokens=int(getattr(usage, "input_tokens", 0) or 0),
+                cached_tokens=int(getattr(in_details, "cached_tokens", 0) or 0),
+                output_tokens=int(getattr(usage, "output_tokens", 0) or 0),
+                reasoning_tokens=int(getattr(out_details, "reasoning_tokens", 0) or 0),
+                latency_ms=int(latency * 1000),
+            )
+        )
@@ -0,0 +1,159 @@
+# обновление памяти о пользователе: копим реплики и обновляем пачкой, не больше одного апдейта на чат
+
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from app.services.jobs import JobRetry
+from app.services.summary import build_memory_async
+
+logger = logging.getLogger("memory")
+
+MEMORY_JOB = "memory_update"
+# сколько раз пересобираем память, если её успели поменять, пока отвечала модель
+MEMORY_RACE_ATTEMPTS = 3
+MEMORY_RACE_RETRY_DELAY = 30.0
+
+
+def _log_task_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Memory background task failed", exc_info=task.exception())
+
+
+class MemoryCoalescer:
+    """
+    Реплики чата копятся в буфере; обновление памяти запускается, когда набралось
+    max_turns реплик или чат молчит idle_seconds. На чат одновременно идёт не больше
+    одного обновления, а текущая память перечитывается из БД прямо перед вызовом модели —
+    поэтому параллельные апдейты больше не затирают друг друга.
+    """
+
+    def __init__(self, repo, memory_llm, *, max_turns: int = 3, idle_seconds: float = 90.0, jobs=None):
+        self.repo = repo
+        self.memory_llm = memory_llm
+        # JobWorker: если задан, накопленные реплики уходят в долговечную очередь (memory_update),
+        # а не в in-process задачу — рестарт их не теряет
+        self.jobs = jobs
+        self.max_turns = max(1, max_turns)
+        self.idle_seconds = idle_seconds
+        self._turns: dict[int, list[str]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        self._running: dict[int, asyncio.Task] = {}
+        # растёт при forget(): результат уже запущенного апдейта для старой эпохи выбрасываем
+        self._epoch: dict[int, int] = {}
+        self.updates = 0
+        self.turns_total = 0
+
+    def add_turn(self, chat_id: int, user_text: str, answer: str) -> None:
+        self._turns.setdefault(chat_id, []).append(f"USER: {user_text}\nBOT: {answer}")
+        self.turns_total += 1
+        if len(self._turns[chat_id]) >= self.max_turns:
+            self._kick(chat_id)
+        else:
+            self._arm_timer(chat_id)
+
+    def forget(self, chat_id: int) -> None:
+        # память сбросили (завершили диалог) — накопленное больше не нужно
+        self._epoch[chat_id] = self._epoch.get(chat_id, 0) + 1
+        self._turns.pop(chat_id, None)
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        if self.jobs is not None:
+            task = asyncio.create_task(self.repo.jobs_cancel(MEMORY_JOB, str(chat_id)))
+            task.add_done_callback(_log_task_error)
+
+    async def stop(self) -> None:
+        # на выключении дописываем всё, что накопилось
+        for chat_id in list(self._turns):
+            self._kick(chat_id)
+        running = list(self._running.values())
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def _arm_timer(self, chat_id: int) -> None:
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timers[chat_id] = loop.call_later(self.idle_seconds, self._kick, chat_id)
+
+    def _kick(self, chat_id: int) -> None:
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        if chat_id in self._running:
+            # уже идёт апдейт — он заберёт новые реплики следующим заходом
+            return
+        if self.jobs is not None:
+            task = asyncio.create_task(self._enqueue(chat_id))
+        else:
+            task = asyncio.create_task(self._run(chat_id))
+        self._running[chat_id] = task
+        task.add_done_callback(lambda _t, c=chat_id: self._running.pop(c, None))
+
+    async def _enqueue(self, chat_id: int) -> None:
+        turns = self._turns.pop(chat_id, None)
+        if not turns:
+            return
+        try:
+            # одна queued-задача на чат: новые реплики дописываются в неё
+            await self.jobs.enqueue(
+                MEMORY_JOB,
+                {"chat_id": chat_id, "turns": turns},
+                dedupe_key=str(chat_id),
+                merge_key="turns",
+            )
+        except Exception:
+            logger.exception("Failed to enqueue memory update", extra={"chat_id": chat_id})
+
+    async def _run(self, chat_id: int) -> None:
+        while self._turns.get(chat_id):
+            turns = self._turns.pop(chat_id)
+            epoch = self._epoch.get(chat_id, 0)
+            try:
+                await self._apply(chat_id, turns, epoch=epoch)
+            except Exception:
+                logger.exception("Failed to update user memory", extra={"chat_id": chat_id})
+
+    async def run_job(self, payload: dict) -> None:
+        # обработчик задачи memory_update (ошибка -> повтор через очередь)
+        await self._apply(int(payload["chat_id"]), list(payload.get("turns") or []), epoch=None)
+
+    async def _apply(self, chat_id: int, turns: list[str], epoch: int | None) -> None:
+        for _ in range(MEMORY_RACE_ATTEMPTS):
+            profile = await self.repo.get_user_profile(chat_id)
+            if profile is None or profile.end_dialog == 1:
+                # диалог завершён, память сброшена (или пользователя удалили) — старые реплики не возвращаем
+                return
+            existing = profile.memory
+            updated = await build_memory_async(
+                self.memory_llm,
+                "\n\n".join(turns),
+                existing_memory=existing,
+                chat_id=chat_id,
+            )
+            self.updates += 1
+            if epoch is not None and epoch != self._epoch.get(chat_id, 0):
+                return
+            if not updated or updated == (existing or "").strip():
+                return
+            # end_dialog и саму память перепроверяем в момент записи: модель отвечала долго
+            if await self.repo.update_user_memory_if(chat_id, updated, expected=existing):
+                return
+            # память поменялась, пока отвечала модель: перечитываем профиль — завершённый диалог
+            # пропускаем, иначе пересобираем эти реплики поверх свежей памяти
+            logger.info("Memory changed during update, rebuilding", extra={"chat_id": chat_id})
+        if epoch is None:
+            # задача memory_update: повторится через очередь, реплики не теряются
+            raise JobRetry(MEMORY_RACE_RETRY_DELAY, reason="memory kept changing during update")
+        logger.warning("Memory kept changing during update, turns dropped", extra={"chat_id": chat_id})
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.turns_total,
+            "updates": self.updates,
+            "pending_chats": len(self._turns),
+            "running": len(self._running),
+        }
@@ -0,0 +1,94 @@
+# контроль перегрузки перед генерацией: оценка ожидания в очереди к модели и что делать сверх SLO
+
+from __future__ import annotations
+
+import logging
+import math
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+logger = logging.getLogger("overload")
+
+OVERLOAD_OK = "ok"
+# сказать пользователю место в очереди и ожидаемое время, но отвечать как обычно
+OVERLOAD_NOTIFY = "notify"
+# не держать хендлер: отложить сообщение в очередь задач (chat_reply), ответ придёт позже
+OVERLOAD_DEFER = "defer"
+
+# задача очереди для отложенного ответа; dedupe_key — chat_id, тексты сообщений копятся в payload["texts"]
+CHAT_REPLY_JOB = "chat_reply"
+
+
+@dataclass
+class OverloadDecision:
+    action: str
+    position: int = 0
+    eta: float = 0.0
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"{max(5, int(math.ceil(seconds / 5.0)) * 5)} сек"
+    return f"{int(math.ceil(seconds / 60.0))} мин"
+
+
+class OverloadController:
+    """
+    Перед генерацией оценивает ожидание слота модели по очереди планировщика
+    и медиане недавних вызовов (LLMScheduler.estimate_wait):
+    - до slo_seconds — отвечаем как обычно;
+    - дольше — сообщаем место в очереди и примерное время (не чаще notify_cooldown на чат);
+    - дольше defer_seconds — сообщение уходит в долговечную очередь задач, хендлер освобождается.
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        *,
+        slo_seconds: float = 20.0,
+        defer_seconds: float = 60.0,
+        notify_cooldown: float = 60.0,
+    ):
+        self.scheduler = scheduler
+        self.slo_seconds = slo_seconds
+        # 0 — не откладывать, только предупреждать
+        self.defer_seconds = defer_seconds
+        self.notify_cooldown = notify_cooldown
+        self._notified: dict[int, float] = {}
+        self.decisions: Counter = Counter()
+
+    def check(self, chat_id: int, model: str, priority: str) -> OverloadDecision:
+        position, eta = self.scheduler.estimate_wait(model, priority)
+        if eta <= self.slo_seconds:
+            self.decisions[OVERLOAD_OK] += 1
+            return OverloadDecision(OVERLOAD_OK, position, eta)
+
+        if self.defer_seconds > 0 and eta > self.defer_seconds:
+            action = OVERLOAD_DEFER
+        else:
+            now = time.monotonic()
+            last = self._notified.get(chat_id)
+            if last is not None and now - last < self.notify_cooldown:
+                # уже предупредили недавно — не спамим
+                self.decisions[OVERLOAD_OK] += 1
+                return OverloadDecision(OVERLOAD_OK, position, eta)
+            self._notified[chat_id] = now
+            if len(self._notified) > 10_000:
+                self._notified = {c: t for c, t in self._notified.items() if now - t < self.notify_cooldown}
+            action = OVERLOAD_NOTIFY
+
+        self.decisions[action] += 1
+        logger.info(
+            "chat_id=%s | overload=%s | model=%s | priority=%s | position=%s | eta=%.1f",
+            chat_id,
+            action,
+            model,
+            priority,
+            position,
+            eta,
+        )
+        return OverloadDecision(action, position, eta)
+
+    def stats(self) -> dict:
+        return dict(self.decisions)
@@ -0,0 +1,90 @@
+# сверка платежей YooKassa: общая логика для кнопки "✅ Я оплатил" и фоновой проверки
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from app.db.models import UserSubscription
+from app.services.jobs import JobRetry
+from app.services.yookassa_client import YooKassaClient, YooKassaConfig
+
+# фоновая проверка pending-платежа: раз в минуту, до PAYMENT_CHECK_MAX_ATTEMPTS раз (~ полчаса)
+PAYMENT_CHECK_JOB = "payment_check"
+PAYMENT_CHECK_INTERVAL = 60.0
+PAYMENT_CHECK_MAX_ATTEMPTS = 30
+
+
+def make_yookassa_client(settings) -> YooKassaClient:
+    return YooKassaClient(
+        YooKassaConfig(
+            shop_id=settings.yookassa_shop_id,
+            secret_key=settings.yookassa_secret_key,
+            return_url=(settings.yookassa_return_url or "https://t.me/"),
+        )
+    )
+
+
+@dataclass
+class PaymentSync:
+    status: str
+    paid: bool
+    payment: dict[str, Any]
+    meta: dict[str, Any]
+    # подписка после активации (только если активировали именно сейчас)
+    activated: UserSubscription | None = None
+
+
+async def sync_yookassa_payment(repo, client: YooKassaClient, payment_id: str, chat_id: int) -> PaymentSync:
+    """
+    Тянет статус платежа из YooKassa, пишет его в payments и активирует подписку.
+    Активация только при первом переходе в succeeded — повторная проверка
+    (кнопка + фоновая задача) не продлевает подписку второй раз. Статус succeeded
+    и подписка пишутся одной транзакцией: сбой между ними не оставит оплату без подписки.
+    """
+    yk_payment, yk_meta = await client.get_payment(payment_id)
+
+    status = yk_payment.get("status", "unknown")
+    paid = bool(yk_payment.get("paid", False))
+
+    raw_to_store = {"payment": yk_payment, "_meta": yk_meta}
+
+    activated = None
+    if status == "succeeded" and paid:
+        activated = await repo.yk_succeed_and_activate(
+            external_payment_id=payment_id,
+            chat_id=chat_id,
+            raw=raw_to_store,
+            paid_at=datetime.utcnow(),
+        )
+    else:
+        await repo.yk_update_payment(
+            external_payment_id=payment_id,
+            status=status,
+            raw=raw_to_store,
+            paid_at=None,
+            canceled_at=datetime.utcnow() if status == "canceled" else None,
+        )
+
+    return PaymentSync(status=status, paid=paid, payment=yk_payment, meta=yk_meta, activated=activated)
+
+
+def make_payment_check_handler(repo, settings, bot):
+    """Обработчик задачи payment_check: сверяет платёж и сообщает пользователю об активации."""
+
+    async def handle(payload: dict) -> None:
+        payment_id = payload["payment_id"]
+        chat_id = int(payload["chat_id"])
+        sync = await sync_yookassa_payment(repo, make_yookassa_client(settings), payment_id, chat_id)
+        if sync.activated is not None:
+            await bot.send_message(
+                chat_id,
+                "✅ Оплата прошла\n"
+                f"Подписка активна до {sync.activated.end_payment_date}",
+            )
+            return
+        if sync.status in ("pending", "waiting_for_capture"):
+            raise JobRetry(PAYMENT_CHECK_INTERVAL, reason=f"payment {payment_id} is {sync.status}")
+
+    return handle
@@ -0,0 +1,265 @@
+# роутер перед генерацией: шаблонный ответ / mini-модель / основная модель.
+# Локально и без сети: эвристики + маленький наивный байес по словам.
+
+from __future__ import annotations
+
+import logging
+import math
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+logger = logging.getLogger("router")
+
+ROUTE_TEMPLATE = "template"
+ROUTE_MINI = "mini"
+ROUTE_MAIN = "main"
+ROUTES = (ROUTE_TEMPLATE, ROUTE_MINI, ROUTE_MAIN)
+
+_WORD_RE = re.compile(r"[a-zа-яё0-9]+")
+
+# чистые подтверждения/благодарности — на них не нужна модель
+_THANKS_WORDS = {"спасибо", "спс", "благодарю", "мерси", "сенкс", "пасиб", "спасибки", "thanks", "thx"}
+_ACK_WORDS = {
+    "ок", "окей", "ok", "okay", "ага", "угу", "понял", "поняла", "ясно", "ладно", "хорошо",
+    "окейно", "понятно", "принято", "супер", "класс", "отлично",
+}
+# "большое", "тебе" и т.п. не меняют смысла "спасибо"
+_FILLER_WORDS = {"большое", "огромное", "тебе", "вам", "еще", "ещё", "раз", "очень", "все", "всё"}
+
+_THANKS_REPLIES = (
+    "Пожалуйста 🙂 Если захочешь продолжить — я рядом.",
+    "Всегда пожалуйста! Пиши, когда захочется поговорить.",
+    "Рад, если помог 🙂 Я тут, если что.",
+)
+_ACK_REPLIES = (
+    "Хорошо 🙂 Если появятся мысли или вопросы — пиши.",
+    "Договорились. Я рядом, если захочешь продолжить.",
+    "Ок 🙂 Пиши, когда будет что обсудить.",
+)
+
+# всегда основная модель, что бы ни сказал классификатор. Проверяются по тексту в нижнем
+# регистре, ё -> е и с одиночными пробелами; между ключевыми словами допускаем пару других
+# ("хочу просто исчезнуть", "не хочу больше жить") — лишний раз отдать основной модели не страшно
+_GAP = r"(?:[a-zа-я0-9]+ ){0,3}"
+_CRISIS_MARKERS = tuple(
+    re.compile(rf"\b(?:{p})")
+    for p in (
+        r"суицид|самоубий|самоповрежд|селфхарм|паническ|насили|изнасил|передоз|покончить",
+        r"умереть|сдохнуть|повеситься|повешусь|вскрыть вены|вскрою вены",
+        rf"(?:не хочу|не хочется|нет сил|незачем|нет смысла|устала?) {_GAP}жить",
+        r"жить (?:не хочу|не хочется|незачем|больше не могу)",
+        rf"(?:хочу|хочется|хотела?|мечтаю|лучше бы) {_GAP}(?:исчезнуть|пропасть навсегда|не просыпаться|не проснуться|уснуть и не)",
+        r"исчезнуть навсегда|уйти из жизни|свести счеты|не было на свете|лучше без меня",
+        rf"(?:убить|убью|порезать|порежу|режу|резать|навредить|наврежу|причинить боль) {_GAP}(?:себя|себе (?:руки|вены|запястья))",
+        rf"(?:выпрыгнуть|прыгнуть|спрыгнуть|шагнуть) {_GAP}(?:из окна|с крыши|с моста)",
+        rf"(?:наглотаться|выпить все|выпью все|напиться) {_GAP}таблет",
+        rf"(?:бьет|избивает|бил|била|ударил|ударила|душит) {_GAP}меня",
+    )
+)
+
+# обучающая выборка лексической модели: mini — бытовое/лёгкое, main — эмоционально нагруженное
+_SEED_SAMPLES: tuple[tuple[str, str], ...] = (
+    (ROUTE_MINI, "привет как дела"),
+    (ROUTE_MINI, "доброе утро"),
+    (ROUTE_MINI, "что посоветуешь посмотреть вечером"),
+    (ROUTE_MINI, "какой фильм посмотреть"),
+    (ROUTE_MINI, "расскажи анекдот"),
+    (ROUTE_MINI, "что почитать перед сном"),
+    (ROUTE_MINI, "как тебя зовут"),
+    (ROUTE_MINI, "ты кто"),
+    (ROUTE_MINI, "сколько стоит подписка"),
+    (ROUTE_MINI, "как пользоваться ботом"),
+    (ROUTE_MINI, "сегодня хорошая погода гулял в парке"),
+    (ROUTE_MINI, "поел и иду спать"),
+    (ROUTE_MINI, "сделал зарядку утром"),
+    (ROUTE_MINI, "скучно подскажи чем заняться"),
+    (ROUTE_MINI, "вернулся с работы"),
+    (ROUTE_MINI, "да все нормально"),
+    (ROUTE_MINI, "все хорошо спасибо что спросил"),
+    (ROUTE_MINI, "сегодня был обычный день"),
+    (ROUTE_MINI, "какие упражнения на дыхание есть"),
+    (ROUTE_MINI, "подскажи рецепт ужина"),
+    (ROUTE_MINI, "доброй ночи"),
+    (ROUTE_MINI, "хочу завести привычку пить воду"),
+    (ROUTE_MAIN, "мне очень плохо и тревожно"),
+    (ROUTE_MAIN, "не могу перестать плакать"),
+    (ROUTE_MAIN, "поссорилась с мамой и чувствую вину"),
+    (ROUTE_MAIN, "меня бросил парень не знаю как жить дальше"),
+    (ROUTE_MAIN, "постоянно тревога перед работой не сплю ночами"),
+    (ROUTE_MAIN, "чувствую себя одиноким никому не нужен"),
+    (ROUTE_MAIN, "у меня депрессия ничего не радует"),
+    (ROUTE_MAIN, "боюсь что со мной что то не так"),
+    (ROUTE_MAIN, "муж кричит на меня и я боюсь"),
+    (ROUTE_MAIN, "злюсь на себя за то что сорвалась"),
+    (ROUTE_MAIN, "как пережить расставание"),
+    (ROUTE_MAIN, "умер близкий человек мне тяжело"),
+    (ROUTE_MAIN, "не понимаю чего хочу от жизни"),
+    (ROUTE_MAIN, "выгорел на работе нет сил"),
+    (ROUTE_MAIN, "стыдно за то что произошло"),
+    (ROUTE_MAIN, "у меня панические атаки"),
+    (ROUTE_MAIN, "кажется я всех раздражаю"),
+    (ROUTE_MAIN, "почему мне так грустно без причины"),
+    (ROUTE_MAIN, "ненавижу себя"),
+    (ROUTE_MAIN, "родители давят и я не знаю что делать"),
+    (ROUTE_MAIN, "ревную и не могу успокоиться"),
+    (ROUTE_MAIN, "помоги разобраться в чувствах"),
+)
+
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall((text or "").lower())
+
+
+def _features(words: list[str]) -> list[str]:
+    # грубый стемминг: первые 5 букв слова — русская морфология без словарей
+    return [w[:5] for w in words]
+
+
+def _is_crisis(text: str) -> bool:
+    norm = " ".join(_words(text.replace("ё", "е").replace("Ё", "Е")))
+    return any(m.search(norm) for m in _CRISIS_MARKERS)
+
+
+class LexicalModel:
+    """Мультиномиальный наивный байес по словам (сглаживание Лапласа). Обучается за миллисекунды."""
+
+    def __init__(self, samples=_SEED_SAMPLES):
+        self._counts: dict[str, Counter] = {}
+        self._totals: dict[str, int] = {}
+        self._docs: Counter = Counter()
+        self._vocab: set[str] = set()
+        for label, text in samples:
+            feats = _features(_words(text))
+            self._counts.setdefault(label, Counter()).update(feats)
+            self._docs[label] += 1
+            self._vocab.update(feats)
+        self._totals = {label: sum(c.values()) for label, c in self._counts.items()}
+        self._n_docs = sum(self._docs.values())
+
+    def predict_proba(self, words: list[str]) -> dict[str, float]:
+        feats = _features(words)
+        v = len(self._vocab) or 1
+        logp = {}
+        for label, counts in self._counts.items():
+            lp = math.log(self._docs[label] / self._n_docs)
+            denom = self._totals[label] + v
+            for f in feats:
+                lp += math.log((counts.get(f, 0) + 1) / denom)
+            logp[label] = lp
+        top = max(logp.values())
+        exp = {k: math.exp(lp - top) for k, lp in logp.items()}
+        norm = sum(exp.values())
+        return {k: e / norm for k, e in exp.items()}
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    reason: str
+    score: float = 0.0
+    # готовый ответ для route == template
+    reply: str | None = None
+    classify_us: float = 0.0
+
+
+@dataclass
+class RouteStats:
+    count: int = 0
+    latency_total: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    reasons: Counter = field(default_factory=Counter)
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_latency": round(self.latency_total / self.count, 3) if self.count else 0.0,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "reasons": dict(self.reasons),
+        }
+
+
+class MessageRouter:
+    """
+    Выбирает, кто отвечает на сообщение:
+    - template — чистое "ок"/"спасибо": шаблон, без модели и без списания запроса;
+    - mini — короткое бытовое сообщение, если лексическая модель уверена (>= mini_threshold);
+    - main — всё остальное, а также длинные и кризисные сообщения.
+    Решения логируются с вероятностью log_sample; по маршрутам копятся счётчики,
+    латентность и токены — чтобы видеть экономию.
+    """
+
+    def __init__(
+        self,
+        *,
+        mini_threshold: float = 0.75,
+        mini_max_chars: int = 280,
+        log_sample: float = 0.1,
+        model: LexicalModel | None = None,
+    ):
+        self.mini_threshold = mini_threshold
+        self.mini_max_chars = mini_max_chars
+        self.log_sample = log_sample
+        self.model = model or LexicalModel()
+        self._stats: dict[str, RouteStats] = {r: RouteStats() for r in ROUTES}
+        self._classify_total_us = 0.0
+        self._classified = 0
+
+    def route(self, text: str) -> RouteDecision:
+        t0 = time.perf_counter()
+        decision = self._decide(text)
+        decision.classify_us = (time.perf_counter() - t0) * 1e6
+        self._classify_total_us += decision.classify_us
+        self._classified += 1
+        self._stats[decision.route].reasons[decision.reason] += 1
+        if self.log_sample > 0 and random.random() < self.log_sample:
+            logger.info(
+                "route=%s | reason=%s | score=%.2f | classify_us=%.0f | len=%s | text='%s'",
+                decision.route,
+                decision.reason,
+                decision.score,
+                decision.classify_us,
+                len(text or ""),
+                (text or "")[:80].replace("\n", " "),
+            )
+        return decision
+
+    def _decide(self, text: str) -> RouteDecision:
+        t = (text or "").strip()
+        words = _words(t)
+
+        if words and len(words) <= 4:
+            meaningful = [w for w in words if w not in _FILLER_WORDS]
+            if meaningful and all(w in _THANKS_WORDS or w in _ACK_WORDS for w in meaningful):
+                thanks = any(w in _THANKS_WORDS for w in meaningful)
+                replies = _THANKS_REPLIES if thanks else _ACK_REPLIES
+                return RouteDecision(ROUTE_TEMPLATE, "thanks" if thanks else "ack", 1.0, reply=random.choice(replies))
+
+        if _is_crisis(t):
+            return RouteDecision(ROUTE_MAIN, "crisis", 1.0)
+        if len(t) > self.mini_max_chars:
+            return RouteDecision(ROUTE_MAIN, "long", 1.0)
+        if not words:
+            return RouteDecision(ROUTE_MAIN, "no_words", 1.0)
+
+        p_mini = self.model.predict_proba(words).get(ROUTE_MINI, 0.0)
+        if p_mini >= self.mini_threshold:
+            return RouteDecision(ROUTE_MINI, "lexical", p_mini)
+        return RouteDecision(ROUTE_MAIN, "lexical", 1.0 - p_mini)
+
+    def record(self, decision: RouteDecision, *, latency: float, input_tokens: int = 0, output_tokens: int = 0) -> None:
+        st = self._stats[decision.route]
+        st.count += 1
+        st.latency_total += latency
+        st.input_tokens += input_tokens
+        st.output_tokens += output_tokens
+
+    def stats(self) -> dict:
+        return {
+            "avg_classify_us": round(self._classify_total_us / self._classified, 1) if self._classified else 0.0,
+            "routes": {r: st.snapshot() for r, st in self._stats.items()},
+        }
@@ -1,24 +1,67 @@
 # ежедневная выжимка (плейсхолдер)
 
-def build_summary(llm, dialog_text: str) -> str:
-    if not dialog_text.strip():
-        return "За сегодня диалогов не было."
-    prompt = f"Переписка за день:\n\n{dialog_text}"
-    return llm.generate(prompt, mode="summary")
+def _summary_prompt(dialog_text: str) -> str:
+    return f"Переписка за день:\n\n{dialog_text}"
 
-def build_memory(llm, dialog_text: str, existing_memory: str | None = None) -> str:
-    if not dialog_text.strip():
-        return (existing_memory or "").strip()
-    mem = (existing_memory or "").strip()
-    prompt = (
+def _memory_prompt(dialog_text: str, mem: str) -> str:
+    return (
         "EXISTING_MEMORY:\n"
         + (mem if mem else "-")
         + "\n\n"
         "DIALOG:\n"
         + dialog_text
     )
-    updated = llm.generate(prompt, mode="memory") or ""
-    updated = updated.strip()
+
+def _context_prompt(dialog_text: str, prev: str) -> str:
+    return (
+        "PREVIOUS_SUMMARY:\n"
+        + (prev if prev else "-")
+        + "\n\n"
+        "DIALOG:\n"
+        + dialog_text
+    )
+
+def _clean_memory(updated: str | None, mem: str) -> str:
+    updated = (updated or "").strip()
     if not updated:
         return mem
     return updated[:800]
+
+def build_summary(llm, dialog_text: str) -> str:
+    if not dialog_text.strip():
+        return "За сегодня диалогов не было."
+    return llm.generate(_summary_prompt(dialog_text), mode="summary")
+
+def build_memory(llm, dialog_text: str, existing_memory: str | None = None) -> str:
+    if not dialog_text.strip():
+        return (existing_memory or "").strip()
+    mem = (existing_memory or "").strip()
+    updated = llm.generate(_memory_prompt(dialog_text, mem), mode="memory")
+    return _clean_memory(updated, mem)
+
+# async-версии для AsyncOpenAIClient (бот)
+
+async def build_summary_async(llm, dialog_text: str, chat_id: int | None = None) -> str:
+    if not dialog_text.strip():
+        return "За сегодня диалогов не было."
+    return await llm.generate(_summary_prompt(dialog_text), mode="summary", chat_id=chat_id)
+
+async def build_memory_async(
+    llm, dialog_text: str, existing_memory: str | None = None, chat_id: int | None = None
+) -> str:
+    if not dialog_text.strip():
+        return (existing_memory or "").strip()
+    mem = (existing_memory or "").strip()
+    updated = await llm.generate(_memory_prompt(dialog_text, mem), mode="memory", chat_id=chat_id)
+    return _clean_memory(updated, mem)
+
+async def build_context_summary_async(
+    llm, dialog_text: str, previous_summary: str | None = None, chat_id: int | None = None
+) -> str:
+    # скользящий пересказ старой части диалога (ContextBuilder)
+    prev = (previous_summary or "").strip()
+    if not dialog_text.strip():
+        return prev
+    updated = await llm.generate(_context_prompt(dialog_text, prev), mode="context", chat_id=chat_id)
+    updated = (updated or "").strip()
+    return updated[:2000] if updated else prev
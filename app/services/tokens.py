@@ -0,0 +1,20 @@
+# грубая оценка токенов без токенизатора — для бюджета контекста, не для биллинга
+
+from __future__ import annotations
+
+import math
+
+# o200k: русский текст ~3 символа на токен, английский ~4; берём с запасом
+CHARS_PER_TOKEN = 3.0
+# служебные токены на одно сообщение в input (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str | None) -> int:
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_message_tokens(text: str | None) -> int:
+    return estimate_tokens(text) + MESSAGE_OVERHEAD
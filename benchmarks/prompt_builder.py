@@ -0,0 +1,95 @@
+# микробенчмарк сборки instructions на сообщение: старый путь (сборка строк + sha256 промпта
+# в хендлере) против PromptBuilder (хэш при импорте, закэшированный суффикс).
+#
+#   python -m benchmarks.prompt_builder [N]
+
+from __future__ import annotations
+
+import hashlib
+import sys
+import timeit
+
+from app.services.prompts import (
+    MEMORY_INSTRUCTIONS,
+    PROMPT_HASH,
+    SUMMARY_INSTRUCTIONS,
+    SYSTEM_PROMPT,
+    PromptBuilder,
+)
+
+MEMORY = "- Работает дизайнером, устаёт от дедлайнов.\n- Есть кот Барсик.\n- Тревожится перед созвонами. " * 6
+USERS = [(f"Пользователь{i}", "женский" if i % 2 else "мужской", 18 + i % 40, MEMORY + str(i)) for i in range(200)]
+
+
+def legacy_build(mode, *, user_name=None, user_gender=None, user_age=None, user_memory=None) -> str:
+    # копия прежнего _build_instructions
+    if mode == "summary":
+        instructions = SUMMARY_INSTRUCTIONS
+    elif mode == "memory":
+        instructions = MEMORY_INSTRUCTIONS
+    else:
+        instructions = SYSTEM_PROMPT
+    if mode == "chat":
+        clean_name = " ".join(str(user_name).split()).strip()[:60] if user_name else ""
+        clean_gender = " ".join(str(user_gender).split()).strip()[:20] if user_gender else ""
+        clean_age = int(user_age) if isinstance(user_age, int) else None
+        details = []
+        if clean_name:
+            details.append(f"- Имя пользователя: {clean_name}")
+        if clean_gender:
+            details.append(f"- Пол пользователя: {clean_gender}")
+        if clean_age is not None:
+            details.append(f"- Возраст пользователя: {clean_age}")
+        if details:
+            instructions = (
+                f"{instructions}\n\n"
+                "Персонализация:\n"
+                + "\n".join(details)
+                + "\n- Подстраивай тон и формы речи под имя/пол/возраст. "
+                  "Обращайся по имени, когда уместно, без чрезмерного повторения."
+            )
+    if mode == "chat" and user_memory:
+        clean_memory = " ".join(str(user_memory).split())
+        clean_memory = clean_memory.strip()[:1200]
+        if clean_memory:
+            instructions = (
+                f"{instructions}\n\n"
+                "Краткая память о пользователе (используй как контекст, не пересказывай буквально):\n"
+                f"{clean_memory}"
+            )
+    return instructions
+
+
+def legacy_message(i: int) -> str:
+    name, gender, age, memory = USERS[i % len(USERS)]
+    # хендлер: __import__ модуля + sha256 всего промпта на каждое сообщение
+    prompt_text = getattr(__import__("app.services.openai_client", fromlist=["SYSTEM_PROMPT"]), "SYSTEM_PROMPT", "")
+    hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12]
+    return legacy_build("chat", user_name=name, user_gender=gender, user_age=age, user_memory=memory)
+
+
+builder = PromptBuilder()
+
+
+def new_message(i: int) -> str:
+    name, gender, age, memory = USERS[i % len(USERS)]
+    _ = PROMPT_HASH
+    return builder.build("chat", user_name=name, user_gender=gender, user_age=age, user_memory=memory)
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    for i in range(len(USERS)):
+        assert legacy_message(i) == new_message(i), "PromptBuilder changed the instructions text"
+
+    counter = iter(range(10**9))
+    old = min(timeit.repeat(lambda: legacy_message(next(counter)), number=n, repeat=3))
+    new = min(timeit.repeat(lambda: new_message(next(counter)), number=n, repeat=3))
+    print(f"messages: {n}, distinct users: {len(USERS)}")
+    print(f"legacy:        {old / n * 1e6:8.2f} us/msg")
+    print(f"PromptBuilder: {new / n * 1e6:8.2f} us/msg  (x{old / new:.1f})")
+    print(f"cache: {builder.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.bot.handlers import on_chat_message
+from app.db.connection import FakeDatabase
+from app.db.repository import Repository
+from app.services.burst import BurstCoalescer
+from app.services.openai_client import LLMResult
+
+CHAT_ID = 7
+WINDOW = 0.05
+
+
+class FakeLLM:
+    """generate_result записывает input; пока gate закрыт, генерация висит."""
+
+    def __init__(self):
+        self.inputs = []
+        self.cancelled = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def generate_result(self, prompt_input, **kwargs):
+        self.inputs.append(prompt_input)
+        try:
+            await self.gate.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(prompt_input)
+            raise
+        return LLMResult(text=f"ответ на: {prompt_input}")
+
+
+class Chat:
+    """Чат с ботом: сообщения-заглушки и всё, что бот отправил в ответ."""
+
+    def __init__(self):
+        self.answers = []
+        # пока delivery закрыт, message.answer висит (ответ "доставляется")
+        self.delivery = asyncio.Event()
+        self.delivery.set()
+        self.delivering = asyncio.Event()
+
+    def message(self, message_id: int, text: str):
+        async def answer(reply, **kwargs):
+            self.delivering.set()
+            await self.delivery.wait()
+            self.answers.append(reply)
+
+        return SimpleNamespace(
+            message_id=message_id,
+            text=text,
+            chat=SimpleNamespace(id=CHAT_ID),
+            from_user=SimpleNamespace(username="user", full_name="User"),
+            answer=answer,
+        )
+
+
+def _setup():
+    db = FakeDatabase(requests_log=[], user_subscriptions={}, users={})
+    repo = Repository(db, tz="Europe/Moscow", free_limit=100, daily_hard_limit=100)
+    llm = FakeLLM()
+    chat = Chat()
+    burst = BurstCoalescer(window=WINDOW)
+    settings = SimpleNamespace(stream_replies=False)
+    memory = SimpleNamespace(add_turn=lambda *args: None)
+
+    def handle(message_id: int, text: str) -> asyncio.Task:
+        return asyncio.create_task(
+            on_chat_message(
+                chat.message(message_id, text),
+                repo,
+                llm,
+                llm,
+                settings,
+                memory_coalescer=memory,
+                burst_coalescer=burst,
+            )
+        )
+
+    return repo, llm, chat, burst, handle
+
+
+def test_burst_is_one_call_in_message_id_order():
+    async def scenario():
+        repo, llm, chat, burst, handle = _setup()
+        # хендлеры стартуют не в порядке message_id
+        tasks = [handle(2, "второе"), handle(1, "первое"), handle(3, "третье")]
+        await asyncio.gather(*tasks)
+        return repo, llm, chat, burst
+
+    repo, llm, chat, burst = asyncio.run(scenario())
+
+    assert llm.inputs == ["первое\nвторое\nтретье"]
+    assert chat.answers == ["ответ на: первое\nвторое\nтретье"]
+    assert burst.stats()["merged"] == 2
+    assert repo.db.user_subscriptions[CHAT_ID].total_requests == 1
+
+
+def test_message_mid_generation_cancels_and_releases():
+    async def scenario():
+        repo, llm, chat, burst, handle = _setup()
+        llm.gate.clear()
+        first = handle(1, "первое")
+        while not llm.inputs:
+            await asyncio.sleep(0.01)
+        reserved = repo.db.user_subscriptions[CHAT_ID].total_requests
+
+        second = handle(2, "второе")
+        await first
+        released = repo.db.user_subscriptions[CHAT_ID].total_requests
+        llm.gate.set()
+        await second
+        return repo, llm, chat, burst, reserved, released
+
+    repo, llm, chat, burst, reserved, released = asyncio.run(scenario())
+
+    assert llm.cancelled == ["первое"]
+    assert reserved == 1
+    # отменённая генерация вернула списанный запрос
+    assert released == 0
+    assert llm.inputs == ["первое", "первое\nвторое"]
+    assert chat.answers == ["ответ на: первое\nвторое"]
+    assert burst.stats()["superseded"] == 1
+    assert repo.db.user_subscriptions[CHAT_ID].total_requests == 1
+
+
+def test_message_during_delivery_waits_and_is_not_merged():
+    async def scenario():
+        repo, llm, chat, burst, handle = _setup()
+        chat.delivery.clear()
+        first = handle(1, "первое")
+        await chat.delivering.wait()
+
+        second = handle(2, "второе")
+        await asyncio.sleep(WINDOW * 3)
+        # первый ответ ещё доставляется — вторая пачка ждёт, к модели не идёт
+        waiting_inputs = list(llm.inputs)
+        chat.delivery.set()
+        await asyncio.gather(first, second)
+        return repo, llm, chat, burst, waiting_inputs
+
+    repo, llm, chat, burst, waiting_inputs = asyncio.run(scenario())
+
+    assert waiting_inputs == ["первое"]
+    assert llm.inputs == ["первое", "второе"]
+    assert llm.cancelled == []
+    assert chat.answers == ["ответ на: первое", "ответ на: второе"]
+    assert burst.stats()["superseded"] == 0
+    assert repo.db.user_subscriptions[CHAT_ID].total_requests == 2
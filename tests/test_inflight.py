@@ -0,0 +1,76 @@
+import asyncio
+
+from app.services.inflight import InflightRegistry
+
+CHAT_ID = 5
+
+
+def test_chat_state_is_dropped_when_tasks_finish():
+    async def scenario():
+        inflight = InflightRegistry()
+
+        async def handler():
+            epoch = inflight.epoch(CHAT_ID)
+            generation = asyncio.create_task(asyncio.sleep(0.01))
+            inflight.track(CHAT_ID, generation)
+            await generation
+            return epoch
+
+        await asyncio.create_task(handler())
+        # колбэки done у задач отрабатывают на следующей итерации цикла
+        await asyncio.sleep(0)
+        return inflight.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["chats"] == 0
+    assert stats["inflight"] == 0
+
+
+def test_epoch_survives_while_handler_holds_it():
+    async def scenario():
+        inflight = InflightRegistry()
+        started = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def handler():
+            epoch = inflight.epoch(CHAT_ID)
+            started.set()
+            # генерации ещё нет (ждём лимиты, burst и т.п.) — отмена всё равно должна сработать
+            await resume.wait()
+            return inflight.is_current(CHAT_ID, epoch)
+
+        task = asyncio.create_task(handler())
+        await started.wait()
+        inflight.cancel(CHAT_ID, "end_dialog")
+        resume.set()
+        current = await task
+        await asyncio.sleep(0)
+        return current, inflight.stats()["chats"]
+
+    current, chats = asyncio.run(scenario())
+    assert current is False
+    assert chats == 0
+
+
+def test_cancel_stops_tracked_generation():
+    async def scenario():
+        inflight = InflightRegistry()
+
+        async def handler():
+            epoch = inflight.epoch(CHAT_ID)
+            generation = asyncio.create_task(asyncio.sleep(10))
+            inflight.track(CHAT_ID, generation)
+            try:
+                await generation
+            except asyncio.CancelledError:
+                return inflight.is_current(CHAT_ID, epoch)
+            return True
+
+        task = asyncio.create_task(handler())
+        await asyncio.sleep(0.01)
+        cancelled = inflight.cancel(CHAT_ID, "end_dialog")
+        return cancelled, await task
+
+    cancelled, current = asyncio.run(scenario())
+    assert cancelled == 1
+    assert current is False
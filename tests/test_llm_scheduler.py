@@ -0,0 +1,79 @@
+import asyncio
+from collections import Counter
+
+from app.services import llm_scheduler
+from app.services.llm_scheduler import (
+    DEFAULT_WEIGHTS,
+    PRIORITY_BACKGROUND,
+    PRIORITY_FREE,
+    PRIORITY_PAID,
+    FairQueue,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def _dispatch_order(monkeypatch, backlog: list[tuple[str, float]], n: int, *, max_wait: float = 10.0, waited: float = 60.0):
+    """
+    Очередь с limit=1: слот занят, в очереди backlog (класс, сдвиг времени постановки).
+    Затем "прошло" waited секунд (все ждут дольше max_wait) и слоты освобождаются по одному.
+    """
+    clock = FakeClock()
+    monkeypatch.setattr(llm_scheduler.time, "monotonic", clock.monotonic)
+
+    async def scenario():
+        fq = FairQueue(1, DEFAULT_WEIGHTS, max_wait)
+        await fq.acquire(PRIORITY_PAID)
+        order: list[str] = []
+
+        async def waiter(priority):
+            await fq.acquire(priority)
+            order.append(priority)
+
+        tasks = []
+        start = clock.now
+        for priority, offset in backlog:
+            clock.now = start + offset
+            tasks.append(asyncio.create_task(waiter(priority)))
+            await asyncio.sleep(0)
+        clock.now = start + waited
+        while len(order) < n:
+            fq.release()
+            await asyncio.sleep(0)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order[:n]
+
+    return asyncio.run(scenario())
+
+
+def test_weighted_split_under_sustained_backlog(monkeypatch):
+    backlog = [(p, 0.0) for p in (PRIORITY_PAID, PRIORITY_FREE, PRIORITY_BACKGROUND) for _ in range(100)]
+    order = _dispatch_order(monkeypatch, backlog, 70)
+    counts = Counter(order)
+    assert counts[PRIORITY_PAID] == 40
+    assert counts[PRIORITY_FREE] == 20
+    assert counts[PRIORITY_BACKGROUND] == 10
+
+
+def test_overload_does_not_degrade_to_fifo(monkeypatch):
+    # 40 free встали раньше 40 paid; все ждут дольше max_wait — paid всё равно получает свою долю
+    backlog = [(PRIORITY_FREE, 0.0)] * 40 + [(PRIORITY_PAID, 1.0)] * 40
+    order = _dispatch_order(monkeypatch, backlog, 30)
+    counts = Counter(order)
+    assert counts[PRIORITY_PAID] == 20
+    assert counts[PRIORITY_FREE] == 10
+
+
+def test_starved_class_is_promoted(monkeypatch):
+    # фон ждёт на max_wait дольше головы paid — получает слот вне очереди
+    backlog = [(PRIORITY_BACKGROUND, 0.0)] + [(PRIORITY_PAID, 20.0)] * 10
+    order = _dispatch_order(monkeypatch, backlog, 3, waited=30.0)
+    assert order[0] == PRIORITY_BACKGROUND
@@ -0,0 +1,43 @@
+import asyncio
+
+from app.services.log_writer import BatchWriter
+
+
+def test_stop_flushes_batch_in_progress():
+    async def scenario():
+        flushed = []
+
+        async def flush(batch):
+            flushed.extend(batch)
+
+        writer = BatchWriter(flush, max_batch=100, flush_interval=5.0)
+        writer.start()
+        for i in range(5):
+            writer.put(i)
+        # _run уже вынул строки в свою пачку и ждёт flush_interval
+        await asyncio.sleep(0.1)
+        await writer.stop()
+        return flushed
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+
+
+def test_stop_waits_for_running_flush():
+    async def scenario():
+        flushed = []
+        started = asyncio.Event()
+
+        async def flush(batch):
+            started.set()
+            await asyncio.sleep(0.1)
+            flushed.extend(batch)
+
+        writer = BatchWriter(flush, max_batch=2, flush_interval=5.0)
+        writer.start()
+        for i in range(5):
+            writer.put(i)
+        await started.wait()
+        await writer.stop()
+        return flushed
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from openai import BadRequestError, NotFoundError
+
+from app.bot.handlers import make_chat_reply_handler
+from app.db.connection import FakeDatabase
+from app.db.repository import Repository
+from app.services.context import ContextBuilder
+from app.services.openai_client import AsyncOpenAIClient
+
+CHAT_ID = 42
+
+
+def _api_error(error_cls, message, body):
+    # без HTTP-ответа: клиенту важны только тип ошибки и body
+    error = error_cls.__new__(error_cls)
+    Exception.__init__(error, message)
+    error.message = message
+    error.body = body
+    return error
+
+
+class FakeResponses:
+    """responses.create, который уже не знает ни одного previous_response_id."""
+
+    def __init__(self, error_cls):
+        self.error_cls = error_cls
+        self.calls = []
+
+    async def create(self, **params):
+        self.calls.append(params)
+        if params.get("previous_response_id"):
+            raise _api_error(self.error_cls, "Previous response not found", {"param": "previous_response_id"})
+        return SimpleNamespace(id=f"resp-{len(self.calls)}", output_text="Ответ", usage=None)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+
+def _repo() -> Repository:
+    db = FakeDatabase(requests_log=[], user_subscriptions={}, users={})
+    return Repository(db, tz="Europe/Moscow", free_limit=100, daily_hard_limit=100)
+
+
+def _context_builder(repo) -> ContextBuilder:
+    return ContextBuilder(repo, summary_llm=None, chain_max_turns=10)
+
+
+@pytest.mark.parametrize("error_cls", [NotFoundError, BadRequestError])
+def test_expired_chain_rebuilds_local_context(error_cls):
+    async def scenario():
+        repo = _repo()
+        await repo.set_end_dialog(CHAT_ID, 0)
+        await repo.log_interaction(CHAT_ID, "Привет", "Привет!", response_id="resp-old", chain_len=1)
+
+        responses = FakeResponses(error_cls)
+        llm = AsyncOpenAIClient(SimpleNamespace(responses=responses), model="test-model")
+        bot = FakeBot()
+        context_builder = _context_builder(repo)
+        handle = make_chat_reply_handler(repo, llm, llm, bot, context_builder=context_builder)
+        await handle({"chat_id": CHAT_ID, "texts": ["Как дела?"]})
+        return responses.calls, bot.sent, context_builder
+
+    calls, sent, context_builder = asyncio.run(scenario())
+
+    # первая попытка — продолжение цепочки, вторая — локальный контекст без previous_response_id
+    assert [c.get("previous_response_id") for c in calls] == ["resp-old", None]
+    assert calls[0]["input"] == "Как дела?"
+    assert calls[1]["input"] == [
+        {"role": "user", "content": "Привет"},
+        {"role": "assistant", "content": "Привет!"},
+        {"role": "user", "content": "Как дела?"},
+    ]
+    assert context_builder.chained == 1
+    assert sent == [(CHAT_ID, "Ответ")]
+
+
+def test_end_dialog_and_clear_context_reset_chain():
+    async def scenario():
+        repo = _repo()
+        context_builder = _context_builder(repo)
+        await repo.set_end_dialog(CHAT_ID, 0)
+
+        await repo.log_interaction(CHAT_ID, "Привет", "Привет!", response_id="resp-1", chain_len=1)
+        chained = (await context_builder.build(CHAT_ID, "Ещё")).previous_response_id
+
+        await repo.set_end_dialog(CHAT_ID, 1)
+        await repo.set_end_dialog(CHAT_ID, 0)
+        after_end = (await context_builder.build(CHAT_ID, "Ещё")).previous_response_id
+
+        await repo.log_interaction(CHAT_ID, "Снова", "Снова привет", response_id="resp-2", chain_len=1)
+        await repo.clear_dialog_context(CHAT_ID)
+        after_clear = await context_builder.build(CHAT_ID, "Ещё")
+        return chained, after_end, after_clear
+
+    chained, after_end, after_clear = asyncio.run(scenario())
+
+    assert chained == "resp-1"
+    assert after_end is None
+    assert after_clear.previous_response_id is None
+    assert after_clear.input == "Ещё"
@@ -0,0 +1,45 @@
+import pytest
+
+from app.services.router import ROUTE_MAIN, ROUTE_MINI, ROUTE_TEMPLATE, MessageRouter
+
+
+@pytest.fixture
+def router():
+    return MessageRouter(log_sample=0.0)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "хочу исчезнуть навсегда",
+        "Хочу просто исчезнуть",
+        "не хочу больше жить",
+        "жить не хочется",
+        "устала жить",
+        "иногда хочется не просыпаться",
+        "думаю убить себя",
+        "порежу себе руки",
+        "всем будет лучше без меня",
+        "наглотаться таблеток",
+        "муж снова бьёт меня",
+        "у меня ПАНИЧЕСКАЯ атака",
+        "мысли о суициде",
+    ],
+)
+def test_crisis_goes_to_main_model(router, text):
+    decision = router.route(text)
+    assert (decision.route, decision.reason) == (ROUTE_MAIN, "crisis")
+
+
+@pytest.mark.parametrize("text", ["ок", "Окей!", "спасибо", "спасибо большое", "ага, понял", "thanks"])
+def test_acknowledgement_gets_template_reply(router, text):
+    decision = router.route(text)
+    assert decision.route == ROUTE_TEMPLATE
+    assert decision.reply
+
+
+@pytest.mark.parametrize("text", ["нарежу себе салат", "какой фильм посмотреть", "подскажи рецепт ужина"])
+def test_everyday_messages_are_not_crisis(router, text):
+    decision = router.route(text)
+    assert decision.reason != "crisis"
+    assert decision.route in (ROUTE_MINI, ROUTE_MAIN)